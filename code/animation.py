@@ -0,0 +1,252 @@
+import numpy as np
+import cv2
+import os
+import os.path
+import re
+import threading
+import queue
+
+
+# Animation of the drawing process. While an animation is active, the
+# scribble and circles effects mark the canvas areas that they draw and
+# write a video frame every time the given number of lines or circles has
+# been drawn. The animation keeps one frame in the video resolution and a
+# grid of dirty flags for its tiles. Only the marked (dirty) tiles of the
+# frame are updated from the canvas, so the memory use does not depend on
+# the length of the video and a frame costs about as much as the drawing
+# that it shows, even if the pen moves around the whole canvas.
+# The frames are written to a video file with cv2.VideoWriter, or to PNG
+# files if the filename is a pattern with a frame number (e.g.
+# frames/frame%05d.png). Encoding a frame takes longer than updating it, so
+# the frames are encoded in a separate thread while the drawing continues
+# (OpenCV releases the GIL). Only few frames wait for the encoding at once.
+# If the encoding fails, the error is raised in the drawing thread by the
+# next write() or close().
+
+
+# Video codecs of the file types
+FOURCC = {'.mp4': 'mp4v', '.m4v': 'mp4v', '.avi': 'MJPG', '.mov': 'mp4v', '.mkv': 'mp4v'}
+
+# Longest side of the video frames. The canvas is reduced by an integer
+# factor to fit in this.
+MAX_FRAME_SIZE = 1280
+
+# Canvas pixels that are read at once when the frame is updated
+BAND_PIXELS = 4 * 1024**2
+
+# Size of the dirty tiles in frame pixels
+TILE = 32
+
+# Frame number pattern of the PNG sequence filenames, e.g. %05d
+FRAME_PATTERN = re.compile(r'%0?\d*d')
+
+
+class Animation(object):
+
+    def __init__(self, filename, size_x, size_y, frames=300, fps=30, hold=1.0):
+        # Frames is the approximate number of frames of the drawing and fps
+        # the frame rate of the video. The last frame is held for hold
+        # seconds.
+        self.filename = filename
+        self.frames = frames
+        self.fps = fps
+        self.hold = hold
+
+        # Canvas pixels per frame pixel. The frame size is even, as the
+        # video codecs need it, and the canvas area is the part of the
+        # canvas that is shown in the frame.
+        self.factor = -(-max(size_x, size_y) // MAX_FRAME_SIZE)
+        frame_x = max(size_x // self.factor // 2 * 2, 2)
+        frame_y = max(size_y // self.factor // 2 * 2, 2)
+        self.area_x = min(frame_x * self.factor, size_x)
+        self.area_y = min(frame_y * self.factor, size_y)
+        self.frame = np.zeros((frame_y, frame_x, 3), dtype=np.uint8)
+
+        # Dirty flags of the frame tiles. Tile is the tile size in canvas 
+        # pixels. 
+        self.tile = TILE * self.factor
+        self.dirty = np.zeros((-(-frame_y // TILE), -(-frame_x // TILE)), dtype=bool)
+
+        self.writer = None
+        self.frame_count = 0
+        if(FRAME_PATTERN.search(filename) is None):
+            ext = os.path.splitext(filename)[1].lower()
+            self.writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*FOURCC.get(ext, 'mp4v')),\
+                fps, (frame_x, frame_y))
+            if(not self.writer.isOpened()):
+                raise ValueError('Could not open video file {}'.format(filename))
+        else:
+            try:
+                filename % 0
+            except (TypeError, ValueError):
+                raise ValueError('Invalid frame number pattern in {}'.format(filename))
+            if(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+        print('Writing animation to {}'.format(filename))
+
+        self.queue = queue.Queue(maxsize=4)
+        self.error = None # error of the encoding thread
+        self.error_raised = False
+        self.thread = threading.Thread(target=self.encode, daemon=True)
+        self.thread.start()
+
+        self.render = None
+        self.step = 1
+        self.next = 1
+
+    def start(self, render, total, done=0):
+        # Start the animation of one drawing. Render(y1, y2, x1, x2) returns
+        # the RGB canvas area, total is the estimated number of drawn items
+        # and done the number of items that are already drawn (when the
+        # drawing continues from a checkpoint). The first frame shows the
+        # whole canvas, so it must be called after the canvas is restored.
+        self.render = render
+        self.step = max(int(total // max(self.frames, 1)), 1)
+        self.next = (done // self.step + 1) * self.step
+        self.dirty[:] = True
+        self.write_frame()
+
+    def mark(self, x1, y1, x2, y2):
+        # Mark the canvas area x1 ... x2, y1 ... y2 changed.
+        tx1, ty1 = self.tile_index(x1, y1)
+        tx2, ty2 = self.tile_index(x2 - 1, y2 - 1)
+        self.dirty[ty1:ty2 + 1, tx1:tx2 + 1] = True
+
+    def mark_points(self, points, colors=None):
+        # Mark the tiles under the line through the points (N x 2 array)
+        # changed. This can be used as a consumer of the PathBuffer. The 
+        # line segments are usually shorter than the tiles, so marking the 
+        # tiles at the corners of the segment boxes covers them. The longer 
+        # segments are marked one by one. 
+        low = np.minimum(points[:-1], points[1:]) - 2
+        high = np.maximum(points[:-1], points[1:]) + 3
+        tx1, ty1 = self.tile_index(low[:, 0], low[:, 1])
+        tx2, ty2 = self.tile_index(high[:, 0], high[:, 1])
+        for tx in (tx1, tx2):
+            for ty in (ty1, ty2):
+                self.dirty[ty, tx] = True
+        for k in np.flatnonzero((tx2 - tx1 > 1) | (ty2 - ty1 > 1)):
+            self.dirty[ty1[k]:ty2[k] + 1, tx1[k]:tx2[k] + 1] = True
+
+    def tile_index(self, x, y):
+        # Tile of the canvas location, clipped to the frame. 
+        tx = np.clip(np.floor_divide(x, self.tile), 0, self.dirty.shape[1] - 1).astype(int)
+        ty = np.clip(np.floor_divide(y, self.tile), 0, self.dirty.shape[0] - 1).astype(int)
+        return tx, ty
+
+    def due(self, count):
+        # True when count drawn items are enough for the next frame.
+        return count >= self.next
+
+    def update(self, count):
+        # Write the frame for count drawn items.
+        self.write_frame()
+        self.next = (count // self.step + 1) * self.step
+
+    def finish(self):
+        # Write the final drawing and hold it for a while.
+        self.write_frame()
+        for i in range(int(self.hold * self.fps)):
+            self.write(self.frame)
+
+    def write_frame(self):
+        # Update the dirty tiles of the frame from the canvas and write it. 
+        # The consecutive dirty tiles of a tile row are updated together. 
+        t = self.tile
+        for ty in np.flatnonzero(self.dirty.any(axis=1)):
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], self.dirty[ty], [0]))))
+            for tx1, tx2 in zip(edges[0::2], edges[1::2]):
+                self.update_area(tx1 * t, ty * t, min(tx2 * t, self.area_x),\
+                    min((ty + 1) * t, self.area_y))
+        self.dirty[:] = False
+        self.write(self.frame)
+
+    def update_area(self, x1, y1, x2, y2):
+        # Update the frame from the canvas area. The corners are at the 
+        # frame pixel boundaries. The area is read from the canvas in bands 
+        # of about BAND_PIXELS. 
+        f = self.factor
+        rows = max(BAND_PIXELS // max(x2 - x1, 1) // f, 1) * f
+        for b1 in range(y1, y2, rows):
+            b2 = min(b1 + rows, y2)
+            region = self.render(b1, b2, x1, x2)
+            if(region.ndim == 2):
+                region = cv2.cvtColor(region, cv2.COLOR_GRAY2RGB)
+            target = self.frame[b1//f:b2//f, x1//f:x2//f]
+            if(f == 1):
+                target[:] = region
+            else:
+                target[:] = cv2.resize(region, (target.shape[1], target.shape[0]),\
+                    interpolation=cv2.INTER_AREA)
+
+    def write(self, frame):
+        # Send copy of the frame to the encoding thread.
+        self.send((self.frame_count, frame.copy()))
+        self.frame_count += 1
+
+    def send(self, item):
+        # Put the item to the encoding queue. If the encoding thread has 
+        # stopped, the queue is not waited for, but its error is raised. 
+        while(self.thread.is_alive()):
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.check()
+
+    def check(self):
+        # Raise the error of the encoding thread, only once. 
+        if(self.error is not None and not self.error_raised):
+            self.error_raised = True
+            raise self.error
+
+    def encode(self):
+        # Encoding thread, writes the frames until None is received or 
+        # writing fails. 
+        try:
+            while(True):
+                item = self.queue.get()
+                if(item is None):
+                    break
+                number, frame = item
+                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                if(self.writer is not None):
+                    self.writer.write(frame)
+                elif(not cv2.imwrite(self.filename % number, frame)):
+                    raise IOError('Could not write animation frame {}'.format(self.filename % number))
+        except Exception as e:
+            self.error = e
+
+    def close(self):
+        if(self.thread is not None):
+            self.send(None)
+            self.thread.join()
+            self.thread = None
+        if(self.writer is not None):
+            self.writer.release()
+            self.writer = None
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# The active animation, None when the drawing is not animated.
+_animation = None
+
+
+def use(animation):
+    # Set the active animation. Returns the old one, so that it can be
+    # restored.
+    global _animation
+    old = _animation
+    _animation = animation
+    return old
+
+
+def active():
+    return _animation
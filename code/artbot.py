@@ -4,99 +4,286 @@ import sys
 import os.path
 
 from utils import load_image, save_image, plot_image
-from utils import histogram_equalize, add_dither_grayscale
-from filters import soften, sharpen
-from dots import dots
-from circles import circles
-from mono_scribble import mono_scribble
-from color_scribble import color_scribble
-from triangulate import triangulate
+from vector_output import is_vector_filename, open_vector_writer
+from pipeline import Preprocessor, EFFECT_INPUTS
+from cache import ResultCache, file_hash
+from checkpoint import Checkpoint
+import instrument
+import largeformat
+import animation
+from animation import Animation
+import effects as effect_registry
 
 
 def main(argv):
 
     # Parse the command line arguments
-    if(len(argv) != 3):
-        print_help()
-        sys.exit()
-    source_filename = argv[0]
-    destination_filename = argv[1]
-    effect = argv[2]
-
-    # Load the source image
-    if(os.path.isfile(source_filename)):
-        img = load_image(source_filename)
-    else:
-        print("Wrong input file name!")
+    args = [a for a in argv if not a.startswith('--')]
+    options = dict((a[2:].split('=', 1) + [''])[:2] for a in argv if a.startswith('--'))
+    if(len(args) != 3):
         print_help()
         sys.exit()
+    source_filename = args[0]
+    destination_filename = args[1]
+    effect = args[2]
+    seed = int(options['seed']) if options.get('seed') else None
+    cache = ResultCache(options['cache']) if options.get('cache') else None
+    preview = 'preview' in options
+    resume = 'resume' in options
+    size = int(options['size']) if options.get('size') else None
+    workdir = options.get('workdir') or None
+    pens = 1
+    if('pens' in options):
+        pens = int(options['pens']) if options['pens'] else os.cpu_count()
+    animation_file = options.get('animation') or None
+    frames = int(options['frames']) if options.get('frames') else 300
+    fps = int(options['fps']) if options.get('fps') else 30
+    optimize_plot = 'optimize-plot' in options
+
+    # Instrumentation: the stage timings and counters are written to the log
+    # file and the stages are profiled to the profile directory.
+    sinks = [instrument.ConsoleSink()]
+    if(options.get('log')):
+        sinks.append(instrument.JsonLinesSink(options['log']))
+    profile_dir = None
+    if('profile' in options):
+        profile_dir = options['profile'] or 'profile'
+    instrument.configure(sinks, profile_dir)
+
+    try:
+        # Check the source image and effects
+        if(not os.path.isfile(source_filename)):
+            print("Wrong input file name!")
+            print_help()
+            sys.exit()
+
+        effects = effect.split(",")
+        for effect in effects:
+            if(effect not in EFFECTS):
+                print("Wrong effect name!")
+                print_help()
+                sys.exit()
+
+        # Process the image and show it before saving
+        render_file(source_filename, destination_filename, effects, display=True,\
+            seed=seed, cache=cache, preview=preview, resume=resume, size=size,\
+            workdir=workdir, pens=pens, animation_file=animation_file, frames=frames,\
+            fps=fps, optimize_plot=optimize_plot)
+    finally:
+        for sink in sinks:
+            if(hasattr(sink, 'close')):
+                sink.close()
+
+
+def render_file(source_filename, destination_filename, effects, display=False,\
+    seed=None, cache=None, preview=False, resume=False, size=None, workdir=None, pens=1,\
+    animation_file=None, frames=300, fps=30, optimize_plot=False):
+    # Load the source image, process it with each effect in the effects list
+    # and save the results. The preprocessing steps that are shared between 
+    # the effects are done only once. With many effects the effect name is 
+    # added to the destination file names. The result image is shown before 
+    # saving if display is True. 
+    # Seed for the random numbers, same seed gives always the same result. 
+    # If cache (ResultCache) is given, the results and preprocessing products 
+    # are stored to it and taken from it when the same image is processed 
+    # again. The results of the effects that use random numbers are cached 
+    # only when the seed is given. 
+    # Preview renders smaller and faster version of the result. 
+    # The long running effects save checkpoints next to the result file. If 
+    # resume is True, those continue from the checkpoint of the interrupted run 
+    # if it was made from the same input file with the same seed and settings. 
+    # Size overrides the resolution (longest side) of the effects. Sizes above 
+    # LARGE_FORMAT_SIZE are rendered in the large-format mode, where the big 
+    # images are memory-mapped files in workdir (see largeformat.py). 
+    # Pens is the number of parallel pens of the scribble effects. 
+    # If animation_file is given, the drawing process of the scribble and 
+    # circles effects is written to it as video (or PNG sequence) of about 
+    # frames frames at fps frames per second (see animation.py). 
+    # If optimize_plot is True, the primitives of the vector output are 
+    # reordered to minimize the pen-up travel (see plot_order.py). Then the 
+    # whole drawing is kept in memory instead of streaming it to the file. 
+    if(isinstance(effects, str)):
+        effects = [effects]
+    input_hash = None
+    if(cache is not None):
+        input_hash = file_hash(source_filename)
+    preprocessor = None
+
+    workspace = None
+    if(size is not None and size > LARGE_FORMAT_SIZE):
+        workspace = largeformat.Workspace(workdir)
+    old_workspace = largeformat.use(workspace)
+
+    try:
+        for effect in effects:
+            filename = destination_filename
+            if(len(effects) > 1):
+                base, ext = os.path.splitext(destination_filename)
+                filename = "{}_{}{}".format(base, effect, ext)
+
+            # Settings that change the result, for the cache key and checkpoints
+            params = {'inputs': EFFECT_INPUTS[effect], 'preview': preview, 'size': size}
+            if(pens != 1 and effect_registry.supports_pens(effect)):
+                params['pens'] = pens
+            if(optimize_plot and is_vector_filename(filename) and effect not in LINE_EFFECTS):
+                params['optimize_plot'] = True
+
+            cache_key = None
+            random = effect_registry.uses_random(effect)
+            if(cache is not None and (seed is not None or not random)\
+                and animation_file is None):
+                modules = RESULT_MODULES + (effect_registry.module(effect),)
+                if('pens' in params):
+                    modules += ('multi_pen',)
+                if('optimize_plot' in params):
+                    modules += ('plot_order',)
+                cache_key = cache.key(input_hash, effect, params, seed if random else None,\
+                    modules)
+                if(cache.get_file(cache_key, filename)):
+                    if(display and not is_vector_filename(filename)):
+                        plot_image(load_image(filename))
+                    continue
+
+            with instrument.stage(effect):
+                with instrument.stage('preprocess'):
+                    if(preprocessor is None):
+                        preprocessor = Preprocessor(load_image(source_filename), cache, input_hash)
+                    print("Processing image")
+                    inputs = preprocessor.inputs(effect, preview, size)
+
+                if(is_vector_filename(filename)):
+                    # Stream the drawing directly to the vector file. Scribble is one 
+                    # continuous line, the other effects can be reordered for the 
+                    # plotter. 
+                    size_y, size_x = inputs[0].shape[0:2]
+                    writer = open_vector_writer(filename, size_x, size_y)
+                    if(optimize_plot and effect not in LINE_EFFECTS):
+                        from plot_order import PlotOrderer
+                        writer = PlotOrderer(writer)
+                    with writer, instrument.stage('render'):
+                        run_effect(inputs, effect, writer, seed)
+                else:
+                    checkpoint = None
+                    if(effect_registry.supports_checkpoint(effect)):
+                        if(input_hash is None):
+                            input_hash = file_hash(source_filename)
+                        checkpoint = Checkpoint(filename + '.checkpoint',\
+                            {'input': input_hash, 'seed': seed, 'params': params})
+                        if(not resume):
+                            checkpoint.remove()
+                    movie = None
+                    if(animation_file is not None and effect_registry.supports_animation(effect)\
+                        and pens == 1):
+                        movie_filename = animation_file
+                        if(len(effects) > 1):
+                            base, ext = os.path.splitext(animation_file)
+                            movie_filename = "{}_{}{}".format(base, effect, ext)
+                        size_y, size_x = inputs[0].shape[0:2]
+                        movie = Animation(movie_filename, size_x, size_y, frames, fps)
+                    old_movie = animation.use(movie)
+                    try:
+                        with instrument.stage('render'):
+                            result = run_effect(inputs, effect, seed=seed, checkpoint=checkpoint,\
+                                pens=pens)
+                    finally:
+                        animation.use(old_movie)
+                        if(movie is not None):
+                            movie.close()
+                    if(display and workspace is None):
+                        plot_image(result)
+                    with instrument.stage('save'):
+                        if(workspace is not None and filename.lower().endswith('.png')):
+                            largeformat.write_png(filename, result)
+                        else:
+                            save_image(filename, result)
+                    if(checkpoint is not None):
+                        checkpoint.remove()
+
+            if(cache_key is not None):
+                cache.put_file(cache_key, filename)
+    finally:
+        largeformat.use(old_workspace)
+        if(workspace is not None):
+            workspace.close()
+
+
+# Names of the effects, see effects.py
+EFFECTS = effect_registry.names()
+
+# Larger images are rendered in the large-format mode
+LARGE_FORMAT_SIZE = 8000
+
+# Effects that draw continuous lines, their vector output is written in the
+# drawing order. The other effects are reordered for the plotter.
+LINE_EFFECTS = ("scribble", "color_scribble", "cmy_scribble", "rgb_scribble")
+
+# Modules that produce the results of all effects, in addition to the effect
+# module. Changes in those invalidate the cached results (see cache.py).
+RESULT_MODULES = ("pipeline", "utils", "vector_output")
 
-    # Process the image
-    if(effect == "circles"):
-        print("Processing image")
-        scaling = 3000 / max(img.shape[0], img.shape[1])
-        tmp = cv2.resize(img, (0,0), fx=scaling, fy=scaling)        
-        result = circles(tmp)
-
-    elif(effect == "dots"):
-        print("Processing image")
-        scaling = 4000 / max(img.shape[0], img.shape[1])
-        tmp = cv2.resize(img, (0,0), fx=scaling, fy=scaling)
-        tmp = cv2.cvtColor(tmp, cv2.COLOR_RGB2GRAY)
-        tmp = histogram_equalize(tmp) # works only on grayscale images
-        tmp = cv2.cvtColor(tmp, cv2.COLOR_GRAY2RGB)
-        result = dots(tmp)
-
-    elif(effect == "scribble"):
-        print("Processing image")
-        scaling = 3000 / max(img.shape[0], img.shape[1])
-        tmp = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        #tmp = add_dither_grayscale(tmp, 3) # may be needed for images with flat color areas
-        tmp = cv2.resize(tmp, (0,0), fx=scaling, fy=scaling)
-        tmp = histogram_equalize(tmp)
-        result = mono_scribble(tmp)
-
-    elif(effect == "color_scribble"):
-        print("Processing image")
-        scaling = 3000 / max(img.shape[0], img.shape[1])
-        tmp = cv2.resize(img, (0,0), fx=scaling, fy=scaling)
-        result = color_scribble(tmp)
-
-    elif(effect == "color_triangles"):
-        print("Processing image")
-        scaling = 4000 / max(img.shape[0], img.shape[1])
-        tmp = cv2.resize(img, (0,0), fx=scaling, fy=scaling)
-        result = triangulate(tmp, BW=False)
-   
-    elif(effect == "triangles"):
-        print("Processing image")
-        scaling = 4000 / max(img.shape[0], img.shape[1])
-        tmp = cv2.resize(img, (0,0), fx=scaling, fy=scaling)
-        result = triangulate(tmp, BW=True)
-
-    else: 
-        print("Wrong effect name!")
-        print_help()
-        sys.exit()
 
-    # Show the image and then save it
-    plot_image(result)
-    save_image(destination_filename, result)
+def run_effect(inputs, effect, vector_out=None, seed=None, checkpoint=None, pens=1):
+    # Run the effect for the preprocessed input images (see pipeline.py). 
+    # Returns the result image, or None if the result was written to 
+    # vector_out writer. The effect module is imported on the first use. 
+    # The scribble effects are drawn with pens pens (see multi_pen.py). 
+    return effect_registry.run(effect, inputs, vector_out, seed, checkpoint, pens)
 
 
 def print_help(): 
     
     docstring = """
 Run the program using command: 
-python3 artbot.py inputfile outputfile effect
+python3 artbot.py inputfile outputfile effect [--seed=N] [--cache=dir] [--preview]
+    [--resume] [--log=file] [--profile[=dir]] [--size=N] [--workdir=dir] [--pens[=N]]
+    [--animation=file] [--frames=N] [--fps=N] [--optimize-plot]
     
 where: 
     inputfile is the input image file name. 
     outputfile is the filename that is used to save the result image. 
-    effect is the name of the processing effect. 
+    effect is the name of the processing effect. Many effects can be given
+        as comma separated list (e.g. dots,triangles), then the effect name 
+        is added to the output file names. 
+    --seed is the seed for the random numbers. The same seed gives always 
+        the same result, by default the result is different every time. 
+    --cache is the directory for the result cache. The results of the runs 
+        with a seed are stored to the cache and returned from it when the 
+        same image is processed again with the same settings. 
+    --preview renders quickly a small (800 pixels) version of the result. 
+    --resume continues the interrupted processing from the last checkpoint. 
+        Circles and scribble effects save checkpoints (outputfile.checkpoint) 
+        every minute. 
+    --log writes the duration and the counters of each processing stage 
+        to the file as JSON lines. 
+    --profile profiles each processing stage with cProfile and saves the 
+        statistics to the directory (default: profile), one file per stage. 
+        The profile of a stage excludes the time spent in its sub-stages. 
+    --size is the resolution (longest side in pixels) of the result. By 
+        default each effect uses its own resolution (3000 or 4000 pixels). 
+        Sizes above 8000 pixels are rendered in the large-format mode, 
+        where the images are kept in memory-mapped files and PNG output 
+        is written in bands. The memory use of dots stays about the same 
+        with any size, the other effects keep some state that grows with 
+        the size. 
+    --workdir is the directory for the memory-mapped files of the 
+        large-format mode (default: system temporary directory). 
+    --pens draws the scribble effects with N pens (default: one per CPU 
+        core) in parallel processes, each pen in its own part of the image. 
+        Not used with the vector output and checkpoints. 
+    --animation writes the drawing process of the scribble and circles 
+        effects to the video file (.mp4 or .avi), or to PNG files if the 
+        name has a frame number pattern (e.g. frames/frame%05d.png). 
+        Not used with --pens. 
+    --frames is the approximate number of frames of the animation 
+        (default: 300) and --fps the frame rate (default: 30). 
+    --optimize-plot reorders the vector output of the effects other than 
+        scribble to minimize the pen-up travel of the plotter. The whole 
+        drawing is then kept in memory until it is written. 
 
 File formats: 
     Supports all image formats (jpg, png, etc) that are supported by OpenCV. 
+    Output files with extension .svg, .hpgl (.hpg, .plt) or .gcode (.gco, .nc) 
+    are written as vector drawings for pen plotters. 
     
 Effects: 
     circles
@@ -107,6 +294,12 @@ Effects:
         Draws single color scribble line on white background.
     color_scribble
         Draws colored line on black background. 
+    cmy_scribble
+        Draws cyan, magenta and yellow lines on white background, one pen 
+        per color. 
+    rgb_scribble
+        Draws red, green and blue lines on black background, one pen per 
+        color. 
     triangles
         Grayscale triangulated image
     color_triangles
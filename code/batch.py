@@ -0,0 +1,200 @@
+# Standard modules
+import sys
+import os
+import os.path
+import glob
+import json
+import hashlib
+import time
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+MANIFEST_EXTENSIONS = ('.txt', '.lst')
+
+
+def main(argv):
+
+    # Parse the command line arguments
+    args = [a for a in argv if not a.startswith('--')]
+    options = dict((a[2:].split('=', 1) + [''])[:2] for a in argv if a.startswith('--'))
+    if(len(args) != 3):
+        print_help()
+        sys.exit()
+    inputs = find_inputs(args[0])
+    effects = args[1].split(',')
+    output_dir = args[2]
+    workers = int(options.get('workers') or os.cpu_count() or 1)
+    out_format = options.get('format') or 'png'
+    summary_filename = options.get('summary') or os.path.join(output_dir, 'summary.jsonl')
+    seed = int(options['seed']) if options.get('seed') else None
+    cache_dir = options.get('cache') or None
+    preview = 'preview' in options
+    resume = 'resume' in options
+
+    if(not inputs):
+        print("No input files found!")
+        sys.exit(1)
+
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = make_jobs(inputs, effects, output_dir, out_format, seed, cache_dir, preview,\
+        resume)
+    print('Running {} jobs with {} workers'.format(len(jobs), workers))
+
+    start_time = time.time()
+    failed = 0
+    with open(summary_filename, 'w') as summary:
+        for result in run_jobs(jobs, workers):
+            summary.write(json.dumps(result) + '\n')
+            summary.flush()
+            if(result['status'] != 'ok'):
+                failed += 1
+            print('{status:6} {seconds:7.2f} s  {effect} {input} -> {output} {error}'.format(**result))
+
+    print('Done {} jobs in {:.1f} s, {} failed. Summary saved to {}'.format(len(jobs),\
+        time.time() - start_time, failed, summary_filename))
+
+
+def find_inputs(source):
+    # Source can be a directory, a manifest file that lists the input files
+    # (one per line, paths relative to the manifest file) or a glob pattern.
+    if(os.path.isdir(source)):
+        names = sorted(os.listdir(source))
+        return [os.path.join(source, n) for n in names\
+            if os.path.splitext(n)[1].lower() in IMAGE_EXTENSIONS]
+
+    if(os.path.isfile(source) and os.path.splitext(source)[1].lower() in MANIFEST_EXTENSIONS):
+        base = os.path.dirname(source)
+        with open(source) as f:
+            lines = [l.strip() for l in f]
+        return [os.path.join(base, l) for l in lines if l and not l.startswith('#')]
+
+    return sorted(glob.glob(source))
+
+
+def make_jobs(inputs, effects, output_dir, out_format, seed=None, cache_dir=None,\
+    preview=False, resume=False):
+    # One job for each input file and effect combination.
+    jobs = []
+    for source, name in zip(inputs, output_names(inputs)):
+        for effect in effects:
+            output = os.path.join(output_dir, '{}_{}.{}'.format(name, effect, out_format))
+            jobs.append({'input': source, 'effect': effect, 'output': output,\
+                'seed': seed, 'cache': cache_dir, 'preview': preview, 'resume': resume})
+    return jobs
+
+
+def output_names(inputs):
+    # Base names of the result files for the input files. The inputs that 
+    # have the same name without the extension (e.g. from different 
+    # directories) get a short hash of their path added to the name. 
+    names = [os.path.splitext(os.path.basename(source))[0] for source in inputs]
+    counts = {}
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+    result = []
+    for source, name in zip(inputs, names):
+        if(counts[name] > 1):
+            path = os.path.abspath(source).encode('utf-8')
+            name = '{}_{}'.format(name, hashlib.sha1(path).hexdigest()[:8])
+        result.append(name)
+    return result
+
+
+def run_jobs(jobs, workers, retries=2):
+    # Run the jobs in process pool and yield the results as those complete.
+    # If a worker process dies (e.g. out of memory), the pool is broken and
+    # the unfinished jobs are run again in a new pool. After the retries the
+    # remaining jobs are run one at a time, so that one bad input can fail
+    # only its own job. The rerun jobs continue from their checkpoints. 
+    pending = jobs
+    for attempt in range(retries + 1):
+        if(not pending):
+            return
+        isolated = attempt == retries
+        broken = []
+        for job_batch in ([[job] for job in pending] if isolated else [pending]):
+            with ProcessPoolExecutor(max_workers=1 if isolated else workers,\
+                initializer=init_worker) as pool:
+                futures = dict((pool.submit(run_job, job), job) for job in job_batch)
+                for future in as_completed(futures):
+                    job = futures[future]
+                    try:
+                        yield future.result()
+                    except BrokenProcessPool:
+                        if(isolated):
+                            yield job_result(job, 'crashed', 0.0, 'worker process died')
+                        else:
+                            broken.append(dict(job, resume=True))
+        pending = broken
+
+
+# Result caches of the worker process by directory
+_caches = {}
+
+
+def init_worker():
+    # Worker processes never open a display.
+    os.environ['MPLBACKEND'] = 'Agg'
+
+
+def run_job(job):
+    # Process one image in a worker process. All errors are reported in the
+    # result instead of raising those.
+    import artbot
+    from cache import ResultCache
+
+    start_time = time.time()
+    try:
+        if(job['effect'] not in artbot.EFFECTS):
+            raise ValueError('Unknown effect {}'.format(job['effect']))
+        cache = None
+        if(job.get('cache')):
+            # One cache object per worker, so that it keeps its size estimate
+            # between the jobs (see cache.py).
+            if(job['cache'] not in _caches):
+                _caches[job['cache']] = ResultCache(job['cache'])
+            cache = _caches[job['cache']]
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                artbot.render_file(job['input'], job['output'], job['effect'],\
+                    seed=job.get('seed'), cache=cache, preview=job.get('preview', False),\
+                    resume=job.get('resume', False))
+        return job_result(job, 'ok', time.time() - start_time)
+    except Exception as e:
+        return job_result(job, 'error', time.time() - start_time, repr(e))
+
+
+def job_result(job, status, seconds, error=''):
+    return {'input': job['input'], 'effect': job['effect'], 'output': job['output'],\
+        'status': status, 'seconds': round(seconds, 3), 'error': error}
+
+
+def print_help():
+
+    docstring = """
+Run the batch processing using command:
+python3 batch.py inputs effects outputdir [--workers=N] [--format=png] [--summary=file]
+    [--seed=N] [--cache=dir] [--preview] [--resume]
+
+where:
+    inputs is a directory, a glob pattern (e.g. "photos/*.jpg") or a manifest
+        file (.txt or .lst) that lists one input file per line.
+    effects is a comma separated list of effect names, see artbot.py.
+    outputdir is the directory for the result files. Results are saved as
+        <input name>_<effect>.<format>. Inputs with the same name get 
+        also a short hash of their path to the name. 
+    --workers is the number of worker processes, default is the core count.
+    --format is the output file format (e.g. png, jpg or svg), default png.
+    --summary is the summary file name, default outputdir/summary.jsonl. It
+        contains one JSON line per job with status, timing and output path.
+    --seed, --cache, --preview and --resume are passed to each job, see 
+        artbot.py. The jobs that are rerun after a crash always resume. 
+    """
+    print(docstring)
+
+
+if(__name__ == "__main__"):
+    main(sys.argv[1:])
@@ -0,0 +1,429 @@
+# Standard modules
+import sys
+import os
+import os.path
+import io
+import json
+import time
+import platform
+import resource
+import contextlib
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+# Benchmark runner for the effects and the preprocessing helpers. Every
+# benchmark case is run in its own fresh process, so that the peak memory
+# use (RSS) of the case can be measured. All random numbers use fixed seeds.
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+    '..', 'sample_images', 'frog_800.jpg')
+
+EFFECT_NAMES = ("circles", "dots", "scribble", "color_scribble", "triangles", "color_triangles")
+HELPER_NAMES = ("histogram_equalize", "add_dither_grayscale", "soften", "sharpen")
+DEFAULT_SIZES = (512, 1024, 2048)
+
+# Memory growth differences smaller than this (MB) are measurement noise and
+# never reported as regressions.
+MEMORY_NOISE_MB = 4.0
+
+# Instrumentation counters of the drawn items of the effects
+ITEM_COUNTERS = ('circles', 'dots', 'triangles', 'curves')
+
+# Allowed relative difference of the line darkness at the multi-pen seams
+SEAM_TOLERANCE = 0.05
+
+
+def main(argv):
+
+    # Parse the command line arguments
+    args = [a for a in argv if not a.startswith('--')]
+    options = dict((a[2:].split('=', 1) + [''])[:2] for a in argv if a.startswith('--'))
+    if(args or 'help' in options):
+        print_help()
+        sys.exit()
+    if('sizes' in options):
+        sizes = [int(s) for s in options['sizes'].split(',') if s]
+    else:
+        sizes = DEFAULT_SIZES
+    only = options['only'].split(',') if options.get('only') else None
+    seed = int(options.get('seed') or 1)
+    output = options.get('output') or 'benchmark.json'
+    tolerance = float(options.get('tolerance') or 0.2)
+
+    if(options.get('server')):
+        effects = only or ['dots', 'circles', 'triangles']
+        workers = int(options.get('workers') or 2)
+        report = {'meta': environment(),\
+            'server': server_comparison(effects, int(options['server']), workers, seed)}
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Results saved to {}'.format(output))
+        return
+
+    if(options.get('pens')):
+        report = {'meta': environment(), 'pens': pen_comparison(int(options['pens']), seed)}
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Results saved to {}'.format(output))
+        if(not report['pens']['seams_ok']):
+            sys.exit(1)
+        return
+
+    cases = make_cases(sizes, only, seed, full='no-full' not in options)
+    print('Running {} benchmark cases'.format(len(cases)))
+    results = []
+    for case in cases:
+        result = run_case_isolated(case)
+        results.append(result)
+        print(format_result(result))
+
+    report = {'meta': environment(), 'results': results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Results saved to {}'.format(output))
+
+    if(options.get('baseline')):
+        with open(options['baseline']) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], tolerance)
+        if(regressions):
+            sys.exit(1)
+
+
+def make_cases(sizes, only=None, seed=1, full=True):
+    # Each effect is run with the sample image at the resolution that is used
+    # in artbot.py (full) and with synthetic images of the given sizes. The
+    # helpers are run with the sample image and the synthetic images.
+    cases = []
+    for name in EFFECT_NAMES + HELPER_NAMES:
+        if(only is not None and name not in only):
+            continue
+        kind = 'effect' if name in EFFECT_NAMES else 'helper'
+        if(full):
+            cases.append({'name': '{}/frog'.format(name), 'kind': kind, 'target': name,\
+                'image': 'frog', 'size': None, 'seed': seed})
+        for size in sizes:
+            cases.append({'name': '{}/synthetic_{}'.format(name, size), 'kind': kind,\
+                'target': name, 'image': 'synthetic', 'size': size, 'seed': seed})
+    return cases
+
+
+def synthetic_image(size, seed):
+    # RGB test image with gradients, shapes and noise. The longest side is
+    # size pixels, aspect ratio is 3:2.
+    import numpy as np
+    import cv2
+    rng = np.random.default_rng(seed)
+    size_x = size
+    size_y = size * 2 // 3
+    y, x = np.mgrid[0:size_y, 0:size_x]
+    img = np.zeros((size_y, size_x, 3), dtype=np.float32)
+    img[:, :, 0] = 255.0 * x / size_x
+    img[:, :, 1] = 255.0 * y / size_y
+    img[:, :, 2] = 127.5 + 127.5 * np.sin(x / size_x * 12.0) * np.cos(y / size_y * 9.0)
+    img = img.astype(np.uint8)
+    for i in range(20):
+        center = (int(rng.integers(size_x)), int(rng.integers(size_y)))
+        radius = int(rng.integers(size // 40 + 1, size // 6 + 2))
+        color = [int(c) for c in rng.integers(0, 256, size=3)]
+        cv2.circle(img, center, radius, color, thickness=-1)
+    noise = rng.integers(-10, 11, size=img.shape)
+    return np.clip(img.astype(int) + noise, 0, 255).astype(np.uint8)
+
+
+def run_case_isolated(case):
+    # Run the case in a new process.
+    with ProcessPoolExecutor(max_workers=1,\
+        mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(run_case, case).result()
+
+
+def run_case(case):
+    # Run one benchmark case and return the result record. This is run in
+    # the worker process.
+    import numpy as np
+    import cv2
+    from utils import load_image, histogram_equalize, add_dither_grayscale
+    from filters import soften, sharpen
+    from pipeline import Preprocessor, EFFECT_INPUTS
+    import artbot
+    import instrument
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        if(case['image'] == 'frog'):
+            img = load_image(SAMPLE_IMAGE)
+        else:
+            img = synthetic_image(case['size'], case['seed'])
+        preprocessor = Preprocessor(img)
+
+        # Input images of the case
+        if(case['kind'] == 'effect'):
+            products = EFFECT_INPUTS[case['target']]
+            if(case['image'] == 'frog'):
+                inputs = preprocessor.inputs(case['target'])
+            else:
+                size = max(img.shape[0], img.shape[1])
+                inputs = [preprocessor.get(name, size) for (name, _) in products]
+        else:
+            size = max(img.shape[0], img.shape[1])
+            if(case['target'] in ('histogram_equalize', 'add_dither_grayscale')):
+                inputs = [preprocessor.get('gray', size)]
+            else:
+                inputs = [preprocessor.get('rgb', size)]
+
+    # The counters of the case are collected from the stage events.
+    stages = []
+    instrument.configure([instrument.CallbackSink(stages.append, kinds=('stage',))])
+
+    rss_before = peak_rss_mb()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), instrument.stage(case['target']):
+        target = case['target']
+        if(case['kind'] == 'effect'):
+            artbot.run_effect(inputs, target, seed=case['seed'])
+        elif(target == 'histogram_equalize'):
+            histogram_equalize(inputs[0])
+        elif(target == 'add_dither_grayscale'):
+            add_dither_grayscale(inputs[0], 3, rng=np.random.default_rng(case['seed']))
+        elif(target == 'soften'):
+            soften(inputs[0])
+        elif(target == 'sharpen'):
+            sharpen(inputs[0])
+    seconds = time.perf_counter() - start_time
+
+    # Throughput. Effects report the count of the drawn items, for the
+    # helpers it is megapixels.
+    pixels = inputs[0].shape[0] * inputs[0].shape[1]
+    items, unit = pixels / 1e6, 'megapixels'
+    if(case['kind'] == 'effect'):
+        items, unit = item_count(stages[-1]['counters'])
+
+    return {'name': case['name'], 'target': case['target'], 'image': case['image'],\
+        'shape': list(inputs[0].shape), 'seed': case['seed'], 'seconds': round(seconds, 4),\
+        'peak_rss_mb': round(peak_rss_mb(), 1), 'rss_before_mb': round(rss_before, 1),\
+        'items': items, 'unit': unit, 'counters': stages[-1]['counters'],\
+        'throughput': round(items / seconds, 2) if seconds > 0 else None}
+
+
+def item_count(counters):
+    # Count of drawn items from the counters of the effect stage.
+    for name in ITEM_COUNTERS:
+        if(name in counters):
+            return counters[name], name
+    return 0, 'items'
+
+
+def server_comparison(effects, jobs, workers, seed):
+    # Latency and throughput of the render server (server.py) compared to
+    # running artbot.py in a new process for every image. The jobs render
+    # previews of the sample image with the given effects. Latency is the
+    # median time of one job when the jobs are run one at a time, throughput
+    # is measured with all jobs submitted at once and workers jobs running in
+    # parallel.
+    import server
+    import threading
+    names = [effects[i % len(effects)] for i in range(jobs)]
+    artbot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'artbot.py')
+    environ = dict(os.environ, MPLBACKEND='Agg')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def run_process(k):
+            start_time = time.perf_counter()
+            subprocess.run([sys.executable, artbot_path, SAMPLE_IMAGE,\
+                os.path.join(tmp, '{}.png'.format(k)), names[k], '--preview',\
+                '--seed={}'.format(seed)], env=environ, stdout=subprocess.DEVNULL, check=True)
+            return time.perf_counter() - start_time
+
+        latency = [run_process(k) for k in range(jobs)]
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(run_process, range(jobs)))
+        baseline = {'latency_median': statistics.median(latency),\
+            'throughput': jobs / (time.perf_counter() - start_time)}
+
+    start_time = time.perf_counter()
+    render_server = server.RenderServer(workers)
+    startup = time.perf_counter() - start_time
+    httpd = render_server.listen('127.0.0.1', 0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        client = server.RenderClient(port=httpd.server_address[1])
+        with open(SAMPLE_IMAGE, 'rb') as f:
+            data = f.read()
+
+        def run_job(k):
+            job_start = time.perf_counter()
+            job_id = client.submit(data, names[k], seed=seed, params={'preview': True})
+            status = client.wait(job_id)
+            if(status['state'] != 'done'):
+                raise RuntimeError('Job failed: {}'.format(status))
+            client.result(job_id)
+            return time.perf_counter() - job_start
+
+        latency = [run_job(k) for k in range(jobs)]
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(jobs) as pool:
+            list(pool.map(run_job, range(jobs)))
+        served = {'latency_median': statistics.median(latency),\
+            'throughput': jobs / (time.perf_counter() - start_time), 'startup': startup}
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        render_server.shutdown()
+
+    print('{:12} {:>16} {:>16}'.format('', 'latency (s)', 'throughput (1/s)'))
+    print('{:12} {latency_median:16.3f} {throughput:16.2f}'.format('process', **baseline))
+    print('{:12} {latency_median:16.3f} {throughput:16.2f}'.format('server', **served))
+    print('Server start up {:.2f} s, {} jobs ({}), {} workers'.format(startup, jobs,\
+        ', '.join(effects), workers))
+    return {'jobs': jobs, 'effects': effects, 'workers': workers,\
+        'process': baseline, 'server': served}
+
+
+def pen_comparison(pens, seed, size=1200, level=140):
+    # Scribble of a flat gray field with one pen and with pens pens (see
+    # multi_pen.py). Reports the wall times and the seam uniformity: the mean
+    # line darkness at the seams of the regions relative to the rest of
+    # the image, 1.0 when the seams do not show. The same ratio of the one
+    # pen drawing shows the level of the random variation.
+    import numpy as np
+    import instrument
+    import multi_pen
+    from mono_scribble import mono_scribble
+
+    field = np.full((size, size), level, dtype=np.uint8)
+    instrument.configure([])
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.perf_counter()
+        single = mono_scribble(field, seed=seed)
+        single_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        multi = multi_pen.multi_pen('scribble', field, pens=pens, seed=seed)
+        multi_seconds = time.perf_counter() - start_time
+
+    # The seams are the middle halves of the blend zones, where no region 
+    # has more than 3/4 of the weight, and the rest is where one region has 
+    # the full weight. The image border is left out, the lines are denser 
+    # there. 
+    regions = multi_pen.pen_regions(multi_pen.drawing_need('scribble', field), pens,\
+        multi_pen.overlap_width(size, size))
+    weight = np.zeros(field.shape, dtype=np.float32)
+    for (y1, y2, x1, x2, row_weights, col_weights) in regions:
+        np.maximum(weight[y1:y2, x1:x2], np.outer(row_weights, col_weights),\
+            out=weight[y1:y2, x1:x2])
+    inner = np.zeros(field.shape, dtype=bool)
+    inner[20:-20, 20:-20] = True
+    seams = inner & (weight < 0.75)
+    rest = inner & (weight >= 0.999)
+
+    def seam_ratio(img):
+        darkness = 255.0 - img[:, :, 0]
+        return float(darkness[seams].mean() / darkness[rest].mean())
+
+    result = {'pens': len(regions), 'size': size, 'level': level,\
+        'single_seconds': round(single_seconds, 3), 'multi_seconds': round(multi_seconds, 3),\
+        'speedup': round(single_seconds / multi_seconds, 2),\
+        'seam_ratio': round(seam_ratio(multi), 4), 'single_seam_ratio': round(seam_ratio(single), 4)}
+    result['seams_ok'] = abs(result['seam_ratio'] - 1) <= SEAM_TOLERANCE
+    print('One pen {single_seconds:.2f} s, {pens} pens {multi_seconds:.2f} s, '\
+        'speedup {speedup:.2f}x on {cores} cores'.format(cores=os.cpu_count(), **result))
+    print('Seam darkness ratio {:.3f} (one pen {:.3f}), {}'.format(result['seam_ratio'],\
+        result['single_seam_ratio'], 'OK' if result['seams_ok'] else 'SEAMS VISIBLE'))
+    return result
+
+
+def peak_rss_mb():
+    # Peak resident memory of this process. Linux reports kilobytes and
+    # macOS bytes.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if(sys.platform == 'darwin'):
+        return rss / 1024.0**2
+    return rss / 1024.0
+
+
+def environment():
+    import numpy as np
+    import cv2
+    from cache import code_version
+    return {'python': platform.python_version(), 'numpy': np.__version__,\
+        'opencv': cv2.__version__, 'platform': platform.platform(),\
+        'cpu_count': os.cpu_count(), 'code_version': code_version(),\
+        'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def format_result(result):
+    return '{name:36} {seconds:8.3f} s {peak_rss_mb:8.1f} MB (+{:.1f}) {throughput:>12} {unit}/s'.\
+        format(case_memory(result), **result)
+
+
+def case_memory(result):
+    # Memory (MB) that the case used on top of the process memory before it,
+    # the peak RSS for the result files that do not have the RSS before.
+    return result['peak_rss_mb'] - result.get('rss_before_mb', 0.0)
+
+
+def compare(results, baseline, tolerance):
+    # Compare the results to the baseline results. The case is regressed if
+    # its time or memory use is more than tolerance (relative) worse than in
+    # the baseline. The memory use is the growth of the peak RSS during the
+    # case, so the memory of the interpreter and the loaded modules does not
+    # hide the changes. Returns the names of the regressed cases.
+    base = dict((r['name'], r) for r in baseline)
+    regressions = []
+    print('\nComparison to baseline (tolerance {:.0f}%):'.format(tolerance * 100))
+    for result in results:
+        old = base.get(result['name'])
+        if(old is None):
+            continue
+        time_ratio = result['seconds'] / max(old['seconds'], 1e-9)
+        memory, old_memory = case_memory(result), case_memory(old)
+        rss_ratio = max(memory, 0.0) / max(old_memory, 1e-9)
+        regressed = time_ratio > 1 + tolerance or (rss_ratio > 1 + tolerance\
+            and memory - old_memory > MEMORY_NOISE_MB)
+        if(regressed):
+            regressions.append(result['name'])
+        print('{:36} time {:6.2f}x  memory {:6.2f}x  {}'.format(result['name'],\
+            time_ratio, rss_ratio, 'REGRESSION' if regressed else ''))
+    print('{} regressions'.format(len(regressions)))
+    return regressions
+
+
+def print_help():
+
+    docstring = """
+Run the benchmarks using command:
+python3 benchmark.py [--sizes=512,1024,2048] [--only=names] [--no-full] [--seed=1]
+    [--output=benchmark.json] [--baseline=file] [--tolerance=0.2]
+python3 benchmark.py --server=N [--only=effects] [--workers=2] [--output=file]
+python3 benchmark.py --pens=N [--seed=1] [--output=file]
+
+where:
+    --sizes is comma separated list of the synthetic image sizes (longest side).
+    --only is comma separated list of the effects and helpers to run:
+        circles, dots, scribble, color_scribble, triangles, color_triangles,
+        histogram_equalize, add_dither_grayscale, soften, sharpen.
+    --no-full skips the sample image runs at the full effect resolution.
+    --seed is the random seed of the effects and the synthetic images.
+    --output is the result file. It contains the wall time, peak memory use
+        (RSS) and throughput (drawn items per second) of every case.
+    --baseline is earlier result file to compare with. Exit status is 1 if
+        any case is more than tolerance slower or uses more memory. The 
+        memory use is the growth of the peak RSS during the case.
+    --server compares the render server (server.py) to running artbot.py
+        in a new process for every image with N preview jobs of the given
+        effects (default dots, circles and triangles). Reports the median 
+        latency of one job and the throughput with workers parallel jobs.
+    --pens compares the scribble with one pen and with N pens (multi_pen.py)
+        on a flat gray field. Reports the speedup and checks that the line 
+        darkness at the seams of the pen regions is within 5% of the rest. 
+        Exit status is 1 if the seams show.
+    """
+    print(docstring)
+
+
+if(__name__ == "__main__"):
+    main(sys.argv[1:])
@@ -0,0 +1,191 @@
+import numpy as np
+import os
+import os.path
+import ast
+import glob
+import hashlib
+import json
+import shutil
+
+
+# On-disk cache for the rendered results and the intermediate products.
+# The entries are addressed by the hash of everything that affects the
+# result: the input file content, the effect, its parameters, the random seed
+# and the version of the code. The code version is the hash of the source
+# files of the modules that produce the result and the program modules those
+# import, so old entries are never used with changed code, but a change in
+# one effect does not invalidate the results of the other effects.
+# The cache size is limited, the least recently used entries are removed
+# when the limit is exceeded. File modification time is used as the last
+# use time.
+
+
+DEFAULT_CACHE_SIZE = 2 * 1024**3 # bytes
+
+# The cache directory is scanned for the eviction when the estimated size
+# of the cache exceeds the limit, and after every RESCAN_STORES stores, as
+# other processes may write to the same cache. The eviction removes entries
+# until the cache is below EVICT_TARGET of the limit, so that a full cache is
+# not scanned again on the next store.
+RESCAN_STORES = 100
+EVICT_TARGET = 0.9
+
+_code_versions = {}
+
+
+def code_version(modules=None):
+    # Hash of the program source files. If modules (names of the program
+    # modules) is given, only those and the program modules that they import
+    # are hashed. 
+    key = tuple(sorted(modules)) if modules is not None else None
+    if(key not in _code_versions):
+        code_dir = os.path.dirname(os.path.abspath(__file__))
+        if(modules is None):
+            filenames = sorted(glob.glob(os.path.join(code_dir, '*.py')))
+        else:
+            filenames = module_files(code_dir, modules)
+        digest = hashlib.sha256()
+        for filename in filenames:
+            digest.update(os.path.basename(filename).encode('utf-8'))
+            with open(filename, 'rb') as f:
+                digest.update(f.read())
+        _code_versions[key] = digest.hexdigest()[:16]
+    return _code_versions[key]
+
+
+def module_files(code_dir, modules):
+    # Source files of the named modules and of the program modules that 
+    # those import, also inside the functions. 
+    found = set()
+    todo = list(modules)
+    while(todo):
+        name = todo.pop()
+        filename = os.path.join(code_dir, name + '.py')
+        if(name in found or not os.path.isfile(filename)):
+            continue
+        found.add(name)
+        with open(filename, 'rb') as f:
+            tree = ast.parse(f.read(), filename)
+        for node in ast.walk(tree):
+            if(isinstance(node, ast.Import)):
+                todo.extend(alias.name.split('.')[0] for alias in node.names)
+            elif(isinstance(node, ast.ImportFrom) and node.module and node.level == 0):
+                todo.append(node.module.split('.')[0])
+    return [os.path.join(code_dir, name + '.py') for name in sorted(found)]
+
+
+def file_hash(filename):
+    # Hash of the file content.
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.estimated_size = None # bytes, None until the directory is scanned
+        self.stores = 0 # stores since the last scan
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, input_hash, effect, params=None, seed=None, modules=None):
+        # Cache key for the given input, effect, parameters and seed.
+        # Parameters must be JSON serializable. Modules are the names of the
+        # program modules that produce the result (see code_version), by 
+        # default all. 
+        desc = json.dumps({'input': input_hash, 'effect': effect, 'params': params,\
+            'seed': seed, 'code': code_version(modules)}, sort_keys=True)
+        return hashlib.sha256(desc.encode('utf-8')).hexdigest()
+
+    def path(self, key, ext):
+        return os.path.join(self.directory, key[:2], key + ext)
+
+    def get_file(self, key, filename):
+        # Copy the cached result to filename. Returns False if the result is
+        # not in the cache.
+        ext = os.path.splitext(filename)[1].lower()
+        path = self.path(key, ext)
+        if(not self.touch(path)):
+            return False
+        shutil.copyfile(path, filename)
+        print('Result loaded from cache {}'.format(path))
+        return True
+
+    def put_file(self, key, filename):
+        # Store copy of the result file.
+        ext = os.path.splitext(filename)[1].lower()
+        path = self.path(key, ext)
+        def write(f):
+            with open(filename, 'rb') as source:
+                shutil.copyfileobj(source, f)
+        self.store(path, write)
+
+    def get_array(self, key):
+        # Cached numpy array or None.
+        path = self.path(key, '.npy')
+        if(not self.touch(path)):
+            return None
+        return np.load(path)
+
+    def put_array(self, key, array):
+        path = self.path(key, '.npy')
+        self.store(path, lambda tmp: np.save(tmp, array))
+
+    def touch(self, path):
+        # Mark the entry used. Returns False if the entry does not exist.
+        try:
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def store(self, path, write):
+        # Write the entry to temporary file first and rename it, so that
+        # other processes never see partially written entries.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            write(f)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+        self.stores += 1
+        if(self.estimated_size is not None):
+            self.estimated_size += size
+        if(self.estimated_size is None or self.estimated_size > self.max_size\
+            or self.stores >= RESCAN_STORES):
+            self.evict()
+
+    def entries(self):
+        # List of (last use time, size, path) of the cache entries.
+        result = []
+        for path in glob.glob(os.path.join(self.directory, '*', '*')):
+            if(path.endswith('.tmp')):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            result.append((stat.st_mtime, stat.st_size, path))
+        return result
+
+    def evict(self):
+        # Remove the least recently used entries until the cache fits to the
+        # size limit, with some free space.
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        if(total <= self.max_size):
+            entries = []
+        for mtime, size, path in entries:
+            if(total <= self.max_size * EVICT_TARGET):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.estimated_size = total
+        self.stores = 0
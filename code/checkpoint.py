@@ -0,0 +1,131 @@
+import numpy as np
+import os
+import os.path
+import glob
+import pickle
+import time
+
+import largeformat
+
+
+# Arrays larger than this are saved to their own .npy files next to the
+# checkpoint file and the pickled state refers to those. The files are written
+# and read band by band, so the big memory-mapped canvases of the large-format
+# mode are not copied to the process memory as a whole.
+ARRAY_FILE_BYTES = 16 * 1024**2
+
+
+class Checkpoint(object):
+    # Saves the state of a long running effect periodically to a file, so that
+    # the processing can be continued from there if it is interrupted. The
+    # state is a dictionary of numpy arrays and other picklable values and it
+    # must contain everything that is needed to continue with identical result.
+    # The effects call due() in their main loop and save() when it returns
+    # True. At start they call load() to get the saved state, if any.
+    # Identity is a picklable value that identifies the run (e.g. the hash of
+    # the input file, the seed and the effect parameters). It is saved with
+    # the state and a checkpoint with different identity is not loaded.
+
+    def __init__(self, filename, identity=None, interval=60.0):
+        self.filename = filename
+        self.identity = identity
+        self.interval = interval # seconds between the saves
+        self.last_save = time.time()
+        self.count = 0 # saves, for the array file names
+
+    def due(self):
+        return time.time() - self.last_save >= self.interval
+
+    def save(self, state):
+        # Write to temporary file first, so that an interruption during the
+        # save never destroys the previous checkpoint. The array files have
+        # new names on every save and the old ones are removed only after the
+        # new checkpoint is in place.
+        self.count += 1
+        arrays = []
+        state = self.store_arrays(dict(state, identity=self.identity), arrays)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.filename)
+        for name in self.array_files():
+            if(name not in arrays):
+                os.remove(name)
+        self.last_save = time.time()
+
+    def store_arrays(self, state, arrays, prefix=''):
+        # Replace the big arrays in the state (and in its dictionaries) with
+        # references to the array files.
+        result = {}
+        for key, value in state.items():
+            if(isinstance(value, dict)):
+                value = self.store_arrays(value, arrays, prefix + str(key) + '.')
+            elif(isinstance(value, np.ndarray) and value.nbytes > ARRAY_FILE_BYTES):
+                name = '{}.{}-{}.{}{}.npy'.format(self.filename, os.getpid(), self.count,\
+                    prefix, key)
+                write_array(name, value)
+                arrays.append(name)
+                value = ArrayFile(os.path.basename(name))
+            result[key] = value
+        return result
+
+    def load_arrays(self, state):
+        # Inverse of store_arrays, the arrays are opened as read-only
+        # memory-mapped files.
+        result = {}
+        for key, value in state.items():
+            if(isinstance(value, dict)):
+                value = self.load_arrays(value)
+            elif(isinstance(value, ArrayFile)):
+                directory = os.path.dirname(self.filename)
+                value = np.load(os.path.join(directory, value.name), mmap_mode='r')
+            result[key] = value
+        return result
+
+    def load(self, effect):
+        # Saved state of the effect or None. The checkpoints of other effects
+        # and runs are ignored.
+        if(not os.path.isfile(self.filename)):
+            return None
+        with open(self.filename, 'rb') as f:
+            state = pickle.load(f)
+        if(state.get('effect') != effect):
+            return None
+        if(state.get('identity') != self.identity):
+            print('Checkpoint {} is from another input or settings, not resuming'.\
+                format(self.filename))
+            return None
+        try:
+            state = self.load_arrays(state)
+        except (OSError, ValueError):
+            print('Checkpoint {} is incomplete, not resuming'.format(self.filename))
+            return None
+        print('Resuming {} from checkpoint {}'.format(effect, self.filename))
+        return state
+
+    def array_files(self):
+        return glob.glob(glob.escape(self.filename) + '.*.npy')
+
+    def remove(self):
+        if(os.path.isfile(self.filename)):
+            os.remove(self.filename)
+        for name in self.array_files():
+            os.remove(name)
+
+
+class ArrayFile(object):
+    # Reference to an array file in the saved state.
+
+    def __init__(self, name):
+        self.name = name
+
+
+def write_array(filename, arr):
+    # Save the array in .npy format, one band at a time.
+    header = {'descr': np.lib.format.dtype_to_descr(arr.dtype), 'fortran_order': False,\
+        'shape': arr.shape}
+    with open(filename, 'wb') as f:
+        np.lib.format.write_array_header_2_0(f, header)
+        for y1, y2 in largeformat.bands(arr):
+            np.ascontiguousarray(arr[y1:y2]).tofile(f)
+            largeformat.trim()
@@ -1,13 +1,29 @@
 import numpy as np
 import cv2
 import math
-from random import randrange
+import random
 import sys
+from collections import deque
 
-from utils import ProgressReport, fill_image, measure_time
+import instrument
+import largeformat
+import animation
+from utils import ProgressReport, measure_time
 
 
-def circles(source_img):
+# Image size (longest side) that the drawing parameters are tuned for. 
+REFERENCE_SIZE = 3000
+
+def circles(source_img, vector_out=None, seed=None, scale=None, checkpoint=None):
+    # If vector_out writer is given, the circle outlines are written to it 
+    # instead of drawing the result image and None is returned. 
+    # Seed for the random numbers, same seed gives always the same result. 
+    # The circle size is scaled by scale, by default it is relative to the
+    # image size, so smaller image gives scaled down version of the result. 
+    # If checkpoint (see checkpoint.py) is given, the drawing state is saved 
+    # to it periodically and the drawing is continued from the saved state. 
+    # Checkpoints are not used with vector output. 
+    rand_gen = random.Random(seed)
 
     # Some drawing variables
     packing = 1.05 # default = 1.05
@@ -15,188 +31,370 @@ def circles(source_img):
 
     size_x = source_img.shape[1]
     size_y = source_img.shape[0]
-    circle_list = [] 
+    if(scale is None):
+        scale = max(size_x, size_y) / REFERENCE_SIZE
 
     # Calculate background color for output image and initialize
     # the output image. 
-    background_color = np.mean(source_img, axis=(0,1)) * 0.2
-    target_img = np.full(source_img.shape, 0, dtype=np.uint8)
-    fill_image(target_img, background_color)
+    background_color = largeformat.mean(source_img, axis=(0,1)) * 0.2
+    if(vector_out is None):
+        target_img = largeformat.full(source_img.shape, background_color, dtype=np.uint8)
+    else:
+        target_img = None
 
     # Define one circle as a starting points.
     # All circles will inherit radius from this. 
-    radius = 18
-    active = True
-    start_x = randrange(int(size_x / 2)) + int(size_x / 4)
-    start_y = randrange(int(size_y / 2)) + int(size_y / 4)
-    tstamp = 0
-    circle_list.append([start_x, start_y, radius, active, tstamp])
+    # The radius and the circle locations are not rounded to whole pixels, 
+    # so the packing is the same in all scales. 
+    radius = max(18 * scale, 2)
+    start_x = rand_gen.randrange(int(size_x / 2)) + int(size_x / 4)
+    start_y = rand_gen.randrange(int(size_y / 2)) + int(size_y / 4)
 
     # Estimate the number of circles to be drawn. The 1350 is valid for circles 
     # with radius 18. 
-    estimate = size_x * size_y / 1350
+    estimate = size_x * size_y / (1350 * (radius / 18.0)**2)
     status_print = ProgressReport(estimate, 'circles effect')
 
     # Make look-up tables to speed up the computing. 
-    sin_list = []
-    cos_list = []
-    for a in range(360):
-        sin_list.append(math.sin((a/180.0) * math.pi) * 2 * packing * radius)
-        cos_list.append(math.cos((a/180.0) * math.pi) * 2 * packing * radius)
+    angle_table = np.arange(360) / 180.0 * math.pi
+    sin_table = np.sin(angle_table) * 2 * packing * radius
+    cos_table = np.cos(angle_table) * 2 * packing * radius
 
+    # Spatial index for the placed circles. The grid cell size equals the search 
+    # range, so all circles that can limit a new circle are in the 3x3 cell 
+    # neighbourhood of the candidate location. 
     search_range = 2 * radius
+    grid = CircleGrid(size_x, size_y, search_range)
+    grid.add(start_x, start_y, radius)
+
+    # Active frontier. Circles are processed in the order they were created and 
+    # new circles are born only around the circles in this queue. 
+    frontier = deque([0])
     circle_count = 0
     i = 0
+    rejected_inside = 0 # counters for the instrumentation
+    rejected_space = 0
+
+    # The circles are drawn with pre-rendered sprites, in batches of the 
+    # circles that were placed since the last progress update. 
+    if(smooth_circles):
+        sprites = CircleSprites(SMOOTH_LAYERS, source_img.shape[2])
+    else:
+        sprites = CircleSprites(FLAT_LAYERS, source_img.shape[2])
+    placed = []
+
+    # Continue from the checkpoint if there is one
+    if(vector_out is not None):
+        checkpoint = None
+    state = None
+    if(checkpoint is not None):
+        state = checkpoint.load('circles')
+    if(state is not None and state['img'].shape == target_img.shape):
+        target_img[:] = state['img']
+        grid.restore(state['grid'])
+        frontier = deque(state['frontier'])
+        rand_gen.setstate(state['rand'])
+        circle_count = state['circle_count']
+        i = state['i']
+
+    # If the drawing is animated (see animation.py), the sprites mark their 
+    # areas to the animation and the frames are written after the batches. 
+    # The first frame shows the restored drawing. 
+    movie = animation.active() if vector_out is None else None
+    sprites.movie = movie
+    if(movie is not None):
+        movie.start(lambda y1, y2, x1, x2: target_img[y1:y2, x1:x2], estimate, circle_count)
 
     # Main loop for the algorithm
-    while(i < len(circle_list)):
+    while(frontier):
 
         if(i%10 == 0):
-            # Report status
+            # Draw the placed circles and report status
+            if(target_img is not None):
+                sprites.draw_batch(target_img, source_img, placed)
+            placed = []
+            if(movie is not None and movie.due(circle_count)):
+                movie.update(circle_count)
             status_print.update(circle_count)
+            largeformat.trim()
+            if(checkpoint is not None and checkpoint.due()):
+                checkpoint.save({'effect': 'circles', 'img': target_img,\
+                    'grid': grid.state(), 'frontier': list(frontier),\
+                    'rand': rand_gen.getstate(), 'circle_count': circle_count, 'i': i})
 
         # Params for the active circle. New circles will born around this. 
-        cpx = circle_list[i][0]
-        cpy = circle_list[i][1]
-        radius = circle_list[i][2]
-        active = circle_list[i][3]
-
-        # Process only active circles.
-        if(active): 
-
-            # Sweeo all angles around the circle to find places for new circles. 
-            rand = randrange(360) 
-            for angle in range(rand, 360+rand, 5):
-
-                target_x = cpx + cos_list[angle%360]
-                target_y = cpy + sin_list[angle%360]
-
-                if((0 <= target_x < size_x)):
-                    if((0 <= target_y < size_y)): # Split to two phases to improve speed
-                        target_x = int(target_x)
-                        target_y = int(target_y)
-
-                        # Check that how much there is space available
-                        avail_r, err = find_max_r(circle_list, (target_x, target_y),\
-                            search_range, radius)
-                        if(err == True):
-                            continue
-                        if(avail_r >= radius * packing):
-                            # Create new circle
-                            circle_count += 1 
-                            circle_list.append([target_x, target_y, radius, True, i])      
-
-                            if(smooth_circles):
-                                l1_color = (source_img[target_y, target_x] * 1.0).tolist()
-                                l2_color = (source_img[target_y, target_x] * 0.95).tolist()
-                                l3_color = (source_img[target_y, target_x] * 0.90).tolist()
-                                l4_color = (source_img[target_y, target_x] * 0.85).tolist()
-                                l5_color = (source_img[target_y, target_x] * 0.75).tolist()
-                                line_color = (source_img[target_y, target_x] * 0.5).tolist()
-
-                                cv2.circle(target_img, (target_x, target_y), radius,\
-                                    l5_color, thickness = -1, lineType=cv2.LINE_AA)
-
-                                cv2.circle(target_img, (target_x, target_y), int(radius * 0.85),\
-                                    l4_color, thickness = -1, lineType=cv2.LINE_AA)
-
-                                cv2.circle(target_img, (target_x, target_y), int(radius * 0.7),\
-                                    l3_color, thickness = -1, lineType=cv2.LINE_AA)
-
-                                cv2.circle(target_img, (target_x, target_y), int(radius * 0.6),\
-                                    l2_color, thickness = -1, lineType=cv2.LINE_AA)
-                                cv2.circle(target_img, (target_x, target_y), int(radius * 0.4),\
-                                    l1_color, thickness = -1, lineType=cv2.LINE_AA)
-
-                                cv2.circle(target_img, (target_x, target_y), radius,\
-                                    line_color, thickness = 1, lineType=cv2.LINE_AA)
-                            else:
-                                # Flat circle. 
-                                l1_color = (source_img[target_y, target_x]).tolist()
-                                line_color = (source_img[target_y, target_x] * 0.5).tolist()
-                                cv2.circle(target_img, (target_x, target_y), radius,\
-                                    l1_color, thickness = -1, lineType=cv2.LINE_AA)
-                                cv2.circle(target_img, (target_x, target_y), radius,\
-                                    line_color, thickness = 1, lineType=cv2.LINE_AA)
-          
-            # Deactivate the circle when all possible new circles have been generated around it
-            circle_list[i][3] = False 
-
-
-        # Remove very old circles from the cirle_list. This improves processing speed 10x - 100x when working 
-        # with large images. The algorithm is not scientifically proven... It just happens to work. 
-        # Target is to remove circles that are surrounded with circles, i.e. there is no point to keep those
-        # included in the new circle calculations. 
-        if(i%20 == 0):
-            j = 0
-            while(j < len(circle_list)):
-                if(circle_list[j][4] < (i - 100) and circle_list[j][3] == False):
-                    circle_list.pop(j)
-                    i -= 1
+        c = frontier.popleft()
+        cpx = grid.xs[c]
+        cpy = grid.ys[c]
+        radius = grid.rs[c]
+
+        # Sweep all angles around the circle to find places for new circles. 
+        # The space next to the already placed circles is computed for all the
+        # sweep locations at once. 
+        rand = rand_gen.randrange(360) 
+        angles = np.arange(rand, 360+rand, 5) % 360
+        sweep_x = cpx + cos_table[angles]
+        sweep_y = cpy + sin_table[angles]
+        inside = (0 <= sweep_x) & (sweep_x < size_x) & (0 <= sweep_y) & (sweep_y < size_y)
+        # The locations are truncated to whole pixels of the reference size, 
+        # which are whole pixels in the full size result. 
+        sweep_x = np.floor(sweep_x[inside] / scale) * scale
+        sweep_y = np.floor(sweep_y[inside] / scale) * scale
+        sweep_dist, sweep_err = find_max_r_batch(grid, sweep_x, sweep_y, search_range)
+        rejected_inside += int(np.count_nonzero(sweep_err))
+        born = []
+
+        for k in range(len(sweep_x)):
+            if(sweep_err[k]):
+                continue
+            target_x = sweep_x[k]
+            target_y = sweep_y[k]
+
+            # Circles that were created during this sweep are not included 
+            # in the batch result, so check those separately. 
+            smallest_dist = sweep_dist[k]
+            err = False
+            for n in born:
+                dx = target_x - grid.xs[n]
+                dy = target_y - grid.ys[n]
+                if(abs(dx) > search_range or abs(dy) > search_range):
+                    continue
+                dist = math.sqrt(dx**2 + dy**2) - grid.rs[n]
+                if(dist <= 0):
+                    err = True
+                    break
+                smallest_dist = min(smallest_dist, dist)
+            if(err == True):
+                rejected_inside += 1
+                continue
+
+            # Available radius. The radius of the active circle is used if there 
+            # was no other circles around. The distance is truncated to whole 
+            # pixels of the reference size, so the packing of the scaled circles 
+            # is the same as in the full size result, where the distance is 
+            # truncated to int. 
+            if(smallest_dist == np.inf):
+                avail_r = radius
+            else:
+                avail_r = int(smallest_dist / scale) * scale
+
+            if(avail_r >= radius * packing):
+                # Create new circle
+                circle_count += 1 
+                n = grid.add(target_x, target_y, radius)
+                frontier.append(n)
+                born.append(n)
+
+                if(vector_out is not None):
+                    vector_out.circle(target_x, target_y, radius,\
+                        source_img[int(target_y), int(target_x)])
                 else:
-                    j += 1
-        
+                    placed.append((target_x, target_y, radius))
+            else:
+                rejected_space += 1
+
+        # The circle drops out of the frontier when all possible new circles 
+        # have been generated around it. It stays in the grid, so it still 
+        # limits the circles that are placed later. 
         i += 1
     
+    if(target_img is not None):
+        sprites.draw_batch(target_img, source_img, placed)
+    if(movie is not None):
+        movie.finish()
     status_print.finished()
+    print("Drawing the image using {} circles".format(circle_count + 1))
+    instrument.count('circles', circle_count + 1)
+    instrument.count('sweeps', i)
+    instrument.count('rejected_inside', rejected_inside)
+    instrument.count('rejected_space', rejected_space)
     return target_img
 
 
-
-def find_max_r(circle_list, coord, max_search, max_r):
-    # This method scans through the circle list and finds the maximum available radius
-    # in the new circle location (coord)
-
-    # Center point for the studied circle location
-    cp_x = coord[0]
-    cp_y = coord[1]
-
-    
-    # Find the smalles distance from cp_x/y to any existing circle edge
-    smallest_dist = None
-    err = False
-    for circle in circle_list:
-        # x and y location and radius of the circle in the circle_list.
-        x = circle[0]
-        y = circle[1]
-        r = circle[2]
-
-        # Distance in x-direction
-        dx = cp_x - x 
-        
-        # Break the search if the list items are too far in either direction
-        if(dx > max_search):
-            continue
-        if(dx < -1 * max_search):
-            continue
-
-        # Distance in y-direction
-        dy = cp_y - y 
-
-        if(dy > max_search):
-            continue
-        if(dy < -1 * max_search):
-            continue
-
-        # Available distance
-        dist = math.sqrt(dx**2 + dy**2) - r
-
-        if(dist <= 0):
-            # the location is inside other circle. 
-            err = True
-            break
-
-        if(smallest_dist == None): 
-            smallest_dist = dist
-
-        if(dist <= smallest_dist):
-            smallest_dist = dist 
-
-    if(smallest_dist == None):
-        # Nothin was found, i.e. there was no other circles around
-        return max_r, err
-    else: 
-        # Return the available radius
-        return int(smallest_dist), err
-
-
+# Shading layers of the circles as (radius scale, color scale, thickness),
+# drawn in this order. Thickness -1 is a filled disc. 
+SMOOTH_LAYERS = ((1.0, 0.75, -1), (0.85, 0.85, -1), (0.7, 0.9, -1), (0.6, 0.95, -1),\
+    (0.4, 1.0, -1), (1.0, 0.5, 1))
+FLAT_LAYERS = ((1.0, 1.0, -1), (1.0, 0.5, 1))
+
+
+class CircleSprites(object):
+    # Pre-rendered circle sprites. The anti-aliased shading layers are drawn 
+    # only once for each radius and reduced to two maps: the transmittance of 
+    # the background and the gain of the circle color. All layer colors are 
+    # scaled versions of the same source color, so drawing the layers one by 
+    # one on top of the background gives background * transmittance + 
+    # color * gain. Each circle is then drawn with two multiplications and 
+    # one addition over the sprite area instead of a cv2.circle call per 
+    # layer. The maps are repeated for every color channel, so that the 
+    # operations do not need numpy broadcasting, which is slow for small 
+    # arrays. 
+
+    def __init__(self, layers, channels=3):
+        self.layers = layers
+        self.channels = channels
+        self.sprites = {}
+        self.movie = None # animation that gets the drawn areas
+
+    def sprite(self, radius):
+        # Transmittance and gain maps for the radius, with the circle center 
+        # at (radius + 2, radius + 2). 
+        sprite = self.sprites.get(radius)
+        if(sprite is not None):
+            return sprite
+        center = radius + 2
+        size = 2 * center + 1
+        transmittance = np.ones((size, size), dtype=np.float32)
+        gain = np.zeros((size, size), dtype=np.float32)
+        mask = np.zeros((size, size), dtype=np.uint8)
+        for (radius_scale, color_scale, thickness) in self.layers:
+            mask[:] = 0
+            cv2.circle(mask, (center, center), int(radius * radius_scale), 255,\
+                thickness=thickness, lineType=cv2.LINE_AA)
+            alpha = mask / np.float32(255)
+            transmittance *= 1 - alpha
+            gain = gain * (1 - alpha) + alpha * color_scale
+        sprite = (np.repeat(transmittance[:, :, np.newaxis], self.channels, axis=2),\
+            np.repeat(gain[:, :, np.newaxis], self.channels, axis=2), center)
+        self.sprites[radius] = sprite
+        return sprite
+
+    def draw_batch(self, canvas, source_img, circles):
+        # Draw the circles, list of (x, y, radius), in the given order. The 
+        # colors of the whole batch are picked with one indexing operation. 
+        if(not circles):
+            return
+        # The sprites are drawn at whole pixels and radii. 
+        xs = [int(x) for x, y, radius in circles]
+        ys = [int(y) for x, y, radius in circles]
+        radii = [int(round(radius)) for x, y, radius in circles]
+        colors = source_img[ys, xs].tolist()
+        for x, y, radius, color in zip(xs, ys, radii, colors):
+            self.draw(canvas, x, y, radius, color)
+
+    def draw(self, canvas, x, y, radius, color):
+        transmittance, gain, center = self.sprite(radius)
+        x1 = max(x - center, 0)
+        y1 = max(y - center, 0)
+        x2 = min(x + center + 1, canvas.shape[1])
+        y2 = min(y + center + 1, canvas.shape[0])
+        sx = x1 - (x - center)
+        sy = y1 - (y - center)
+        area = (slice(sy, sy + y2 - y1), slice(sx, sx + x2 - x1))
+        if(self.movie is not None):
+            self.movie.mark(x1, y1, x2, y2)
+        patch = canvas[y1:y2, x1:x2]
+        cv2.add(cv2.multiply(patch, transmittance[area], dtype=cv2.CV_32F),\
+            cv2.multiply(gain[area], tuple(color)), dst=patch, dtype=cv2.CV_8U)
+
+
+class CircleGrid(object):
+    # Uniform grid index over a compact circle store. The circle centers and radii
+    # are kept in NumPy arrays and every grid cell holds a fixed number of slots 
+    # with indices to those arrays (-1 = empty slot). Circles never overlap, so 
+    # only few circles fit in one cell. The slot count is doubled if that ever 
+    # turns out to be too small. 
+
+    def __init__(self, size_x, size_y, cell_size, capacity=1024, slots=4):
+        self.cell_size = cell_size
+        self.cols = int(size_x // cell_size) + 1
+        self.rows = int(size_y // cell_size) + 1
+        self.cells = np.full((self.rows, self.cols, slots), -1, dtype=np.int32)
+        self.fill = np.zeros((self.rows, self.cols), dtype=np.int32)
+        self.xs = np.zeros(capacity, dtype=np.float32)
+        self.ys = np.zeros(capacity, dtype=np.float32)
+        self.rs = np.zeros(capacity, dtype=np.float32)
+        self.count = 0
+
+    def add(self, x, y, r):
+        # Store a new circle and return its index. 
+        if(self.count == len(self.xs)):
+            self.xs = np.concatenate((self.xs, np.zeros_like(self.xs)))
+            self.ys = np.concatenate((self.ys, np.zeros_like(self.ys)))
+            self.rs = np.concatenate((self.rs, np.zeros_like(self.rs)))
+        index = self.count
+        self.xs[index] = x
+        self.ys[index] = y
+        self.rs[index] = r
+        self.count += 1
+
+        cx = int(x // self.cell_size)
+        cy = int(y // self.cell_size)
+        slot = self.fill[cy, cx]
+        if(slot == self.cells.shape[2]):
+            extra = np.full(self.cells.shape, -1, dtype=np.int32)
+            self.cells = np.concatenate((self.cells, extra), axis=2)
+        self.cells[cy, cx, slot] = index
+        self.fill[cy, cx] = slot + 1
+        return index
+
+    def state(self):
+        # The stored circles and the grid, for checkpoints. 
+        return {'cells': self.cells.copy(), 'fill': self.fill.copy(),\
+            'xs': self.xs[:self.count].copy(), 'ys': self.ys[:self.count].copy(),\
+            'rs': self.rs[:self.count].copy()}
+
+    def restore(self, state):
+        self.cells = state['cells'].copy()
+        self.fill = state['fill'].copy()
+        self.count = len(state['xs'])
+        capacity = max(len(self.xs), self.count)
+        self.xs = np.zeros(capacity, dtype=np.float32)
+        self.ys = np.zeros(capacity, dtype=np.float32)
+        self.rs = np.zeros(capacity, dtype=np.float32)
+        self.xs[:self.count] = state['xs']
+        self.ys[:self.count] = state['ys']
+        self.rs[:self.count] = state['rs']
+
+    def neighbours(self, x1, y1, x2, y2):
+        # Indices of the circles in the cells that touch the area x1...x2, y1...y2
+        # and in the cells next to those. 
+        cx1 = max(int(x1 // self.cell_size) - 1, 0)
+        cy1 = max(int(y1 // self.cell_size) - 1, 0)
+        cx2 = int(x2 // self.cell_size) + 2
+        cy2 = int(y2 // self.cell_size) + 2
+        block = self.cells[cy1:cy2, cx1:cx2].ravel()
+        return block[block >= 0]
+
+
+def find_max_r(grid, coord, max_search, max_r):
+    # This method finds the maximum available radius in the new circle location 
+    # (coord). Returns the radius and error flag, which is True if the location 
+    # is inside some other circle. 
+    dist, err = find_max_r_batch(grid, np.array([coord[0]]), np.array([coord[1]]),\
+        max_search)
+    if(err[0]):
+        return max_r, True
+    if(dist[0] == np.inf):
+        # Nothing was found, i.e. there was no other circles around
+        return max_r, False
+    return int(dist[0]), False
+
+
+def find_max_r_batch(grid, cp_x, cp_y, max_search):
+    # Finds the smallest distance from each location in cp_x/y arrays to any 
+    # existing circle edge. Only the circles in the grid cells around the 
+    # locations are studied. Returns the distance array (inf when there was 
+    # no circles around) and error flag array, which is True for the locations 
+    # that are inside some other circle. 
+
+    if(len(cp_x) == 0):
+        return np.zeros(0), np.zeros(0, dtype=bool)
+
+    # Collect the circles around the bounding box of the studied locations.
+    near = grid.neighbours(cp_x.min(), cp_y.min(), cp_x.max(), cp_y.max())
+
+    # Distances in x- and y-directions. Ignore the circles that are outside 
+    # of the search window. 
+    dx = cp_x[:, None] - grid.xs[near][None, :]
+    dy = cp_y[:, None] - grid.ys[near][None, :]
+    in_range = (np.abs(dx) <= max_search) & (np.abs(dy) <= max_search)
+
+    # Available distance to the circle edges
+    dist = np.sqrt(dx**2 + dy**2) - grid.rs[near][None, :]
+    dist[~in_range] = np.inf
+    if(dist.shape[1] == 0):
+        smallest_dist = np.full(len(cp_x), np.inf)
+    else:
+        smallest_dist = dist.min(axis=1)
+    return smallest_dist, smallest_dist <= 0
@@ -1,11 +1,20 @@
 import numpy as np
-from random import randrange
+import random
 import math
 import cv2
+from scribble_engine import DirectionSearch, PathBuffer, DarkPyramid
+import instrument
+import largeformat
+import animation
 from utils import ProgressReport, fill_image
+from preprocess import clamp_invert
 
 
-def color_scribble(source_img):
+# Image size (longest side) that the drawing parameters are tuned for. 
+REFERENCE_SIZE = 3000
+
+
+def color_scribble(source_img, vector_out=None, seed=None, checkpoint=None, scale=None):
     # This algorithm is mostly the same as mono_scribble. Mainly the color processing
     # is different. See the mono_scribble for more comprehensive comments. 
 
@@ -18,31 +27,34 @@ def color_scribble(source_img):
 
     # Make working grayscale copy of the source img, since the working 
     # image will be destroyed during the process
-    pic = cv2.cvtColor(source_img, cv2.COLOR_RGB2GRAY)
+    pic = cv2.cvtColor(source_img, cv2.COLOR_RGB2GRAY,\
+        dst=largeformat.empty(source_img.shape[0:2]))
 
     # Image size params
     size_x = pic.shape[1]
     size_y = pic.shape[0]
+    if(scale is None):
+        scale = max(size_x, size_y) / REFERENCE_SIZE
     
     # Invert the working image and attenuate the high values to avoid 
     # white areas to be left untouched by the algorithm 
     # (all value 255 areas will be avoided by it).
-    for y in range(size_y):
-        for x in range(size_x):
-            pix = 255 - pic[y, x]
-            if(pix > 250):
-                pix = 250   
-            pic[y, x] = pix
+    clamp_invert(pic, 250, invert=True, out=pic)
 
-    # Create empty array for the target image    
-    background_color = np.mean(source_img, axis=(0,1)) * background_coeff
-    img = np.full((size_y, size_x, 3), background_color, dtype=np.uint8)
+    # The line is drawn to a coverage mask. The line color always comes from 
+    # the source image, so the result image is computed from the mask, the 
+    # source image and the background color at the end. 
+    background_color = largeformat.mean(source_img, axis=(0,1)) * background_coeff
+    if(vector_out is None):
+        mask = largeformat.full((size_y, size_x), 0, dtype=np.uint8)
+    else:
+        mask = None
 
 
     # Calculate estimate of the required line segment qty
-    pic_mean = np.mean(pic)
+    pic_mean = largeformat.mean(pic)
     pix_qty = pic.shape[0] * pic.shape[1]
-    loop_qty = int(pix_qty * (255 - pic_mean) / 2200)
+    loop_qty = int(pix_qty * (255 - pic_mean) / (2200 * scale))
 
     # Prepare the progress printing
     status_print = ProgressReport(loop_qty, 'color scribble effect')
@@ -55,24 +67,86 @@ def color_scribble(source_img):
         sin360_table.append(math.sin((a/180) * math.pi))
         cos360_table.append(math.cos((a/180) * math.pi))
 
-    # Select random location for starting the drawing
-    cur_x = randrange(size_x)
-    cur_y = randrange(size_y)
+    # Prepare the direction search for the working image
+    search = DirectionSearch(pic)
+
+    # Index for finding the remaining areas to be drawn when there is nothing 
+    # left around the pen. 
+    pyramid = DarkPyramid(pic)
+
+    # Select random location for starting the drawing. Same seed gives 
+    # always the same drawing. 
+    rand_gen = random.Random(seed)
+    cur_x = rand_gen.randrange(size_x)
+    cur_y = rand_gen.randrange(size_y)
+
+    # The line is stored to path buffer and drawn to the mask in large 
+    # batches. For the vector output the line segment colors are picked from 
+    # the original image. 
+    if(vector_out is None):
+        path = PathBuffer(mask, color=255)
+    else:
+        path = PathBuffer(None, color_source=source_img)
+        path.consumers.append(lambda points, colors: vector_out.polyline(points, colors=colors))
+    path.add(cur_x, cur_y)
 
     # Some working parameters
     new_angle = 0 
     old_angle = 0 
-    speed = 0.4
     old_angle = 0
     new_angle = 0
-    distance = speed * 50 
+    distance = 20 * scale
     clearing_radius = 4
 
+    # Scaled pen geometry, see mono_scribble
+    nsteps = max(int(round(10 * scale)), 2)
+    speed = 15 * scale / nsteps
+    clearing_scale = math.sqrt(scale)
+
     # Start the main drawing loop 
     early_stop = False
     loop_counter = 0
-
-    for t in range(loop_qty):
+    first_t = 0
+    expansions = 0 # counters for the instrumentation
+    jumps = 0
+    cleared = 0
+
+    # Continue from the checkpoint if there is one
+    if(vector_out is not None):
+        checkpoint = None
+    state = None
+    if(checkpoint is not None):
+        state = checkpoint.load('color_scribble')
+    if(state is not None and 'mask' in state and state['pic'].shape == pic.shape):
+        pic[:] = state['pic']
+        mask[:] = state['mask']
+        pyramid.build()
+        path.restore(state['path'])
+        rand_gen.setstate(state['rand'])
+        first_t = state['t']
+        loop_qty = state['loop_qty']
+        status_print.finish_value = loop_qty
+        loop_counter = state['loop_counter']
+        cur_x, cur_y = state['pen']
+        old_angle = state['old_angle']
+        distance = state['distance']
+
+    # Animation, see mono_scribble. The frames are computed from the mask. 
+    movie = animation.active() if vector_out is None else None
+    if(movie is not None):
+        def render_frame(y1, y2, x1, x2):
+            area = np.empty((y2 - y1, x2 - x1, 3), dtype=np.uint8)
+            return coverage_image(mask[y1:y2, x1:x2], source_img[y1:y2, x1:x2],\
+                background_color, out=area)
+        path.consumers.append(movie.mark_points)
+        movie.start(render_frame, loop_qty, first_t)
+
+    for t in range(first_t, loop_qty):
+        if(checkpoint is not None and t%100 == 0 and checkpoint.due()):
+            checkpoint.save({'effect': 'color_scribble', 'pic': pic, 'mask': mask,\
+                'path': path.state(), 'rand': rand_gen.getstate(), 't': t,\
+                'loop_qty': loop_qty, 'loop_counter': loop_counter,\
+                'pen': (cur_x, cur_y), 'old_angle': old_angle, 'distance': distance})
         loop_counter += 1
 
         # Calculate new direction for the line by searching the 
@@ -80,47 +154,42 @@ def color_scribble(source_img):
         searching = True
         rotat_step = 6 # degrees step for searching
         search_dist = distance # how far to look in searching
+        jump_dist = distance * 2 # search range limit before jumping to the closest dark area
         range_max = 180 # initial angle range for the search
 
         while(searching):
-            darkest_pix = 255 # initialize the max possible value
-
-            # This loop scans the original image for new direction
-            for a in range(0, range_max, rotat_step): # a = angle in degrees
-                tmp_a = int(old_angle + a - range_max/2) # temporary angle variable
-
-                tx = int(cur_x + cos360_table[tmp_a%360] * search_dist)
-                ty = int(cur_y + sin360_table[tmp_a%360] * search_dist)
-                pix = 255
-
-                # Pick the pixel color from the original image
-                if(0 < tx < size_x):
-                    if(0 < ty < size_y):
-                        pix = pic[ty, tx]
-
-                # Check that is the pixel value the darkest found so far
-                if(pix <= darkest_pix):
-                    darkest_pix = pix
-                    new_angle = tmp_a 
-                    ptx = tx 
-                    pty = ty 
-
-            if(darkest_pix < 255): # True = something was found
-                searching = False
-
-            else: # Nothing usable was found, so expand the search  
+            # Scan the working image for new direction. All the angles of 
+            # one search step are picked at once. 
+            darkest_pix, new_angle, ptx, pty = search.scan(cur_x, cur_y,\
+                old_angle, search_dist, range_max, rotat_step)
+
+            # Check that was there new direction found
+            if(darkest_pix < 255): 
+                searching = False # Stop the search.
+            elif(search_dist < jump_dist): 
+                expansions += 1
+                # Nothing usable was found, so expand the search range
                 if(rotat_step > 1):
                     rotat_step -=1
-                search_dist += 2
+                search_dist += 2 * scale
                 range_max += 1 
-            if(range_max >360): #360
-                range_max = 360
-
-            # If the search goes beyond the image area, it is likely
-            # that all drawing is done and it is time to stop early. 
-            if(search_dist > max(size_x, size_y)):
+                if(range_max >360):
+                    range_max = 360
+            elif(pyramid.root() >= 255):
+                # All pixels in the pic array are 255, i.e. all drawing 
+                # is done and it is time to stop early. This is the 
+                # primary way to stop the algorithm. 
                 early_stop = True
                 searching = False
+            else:
+                # Nothing was found nearby. Turn towards the closest area 
+                # that still needs drawing.
+                ptx, pty = pyramid.nearest(cur_x, cur_y)
+                jumps += 1
+                darkest_pix = int(pic[pty, ptx])
+                target_angle = math.degrees(math.atan2(pty - cur_y, ptx - cur_x))
+                new_angle = old_angle + (target_angle - old_angle + 180) % 360 - 180
+                searching = False
         # End of search loop.
 
         if(early_stop):
@@ -138,15 +207,15 @@ def color_scribble(source_img):
         # ensures that we won't be drawing the same area many times. 
         # Note that this may be bit different location than the line end point.
         clearing_color = darkest_pix + 80
-        clearing_radius = int(clearing_color/30)    
+        clearing_radius = int((clearing_color/30 - 0.5) * clearing_scale + 0.5)
         if(clearing_color > 255):
             clearing_color = 255
 
         cv2.circle(pic, (ptx, pty), clearing_radius, int(clearing_color), -1)
+        cleared += 1
+        pyramid.mark(ptx, pty, clearing_radius)
 
 
-        speed = 1.5
-        nsteps = 10
         loc_bias = 0
         if(out_of_area):
             loc_bias = 0
@@ -154,38 +223,52 @@ def color_scribble(source_img):
         distance = speed * nsteps * 1.7                 
         delta_angle = new_angle - old_angle
         angle_step = delta_angle / nsteps
-        prev_x = cur_x
-        prev_y = cur_y
         old_x = cur_x 
         old_y = cur_y
 
-        line_color = [0,0,0] # initial value just in case that the color picking fails. 
-  
         for pt in range(nsteps):
             old_angle += angle_step
             angle = int(old_angle)
 
             cur_x += cos360_table[angle%360] * speed + loc_bias
             cur_y += sin360_table[angle%360] * speed + loc_bias
-            
-            # Pick the line segment color from original image.
-            if((0 <= cur_x < size_x) and (0 <= cur_y <size_y)):
-                line_color = source_img[int(cur_y), int(cur_x)].tolist()
-
-            cv2.line(img, (int(cur_x), int(cur_y)),\
-                (int(prev_x), int(prev_y)), line_color, 1, lineType=cv2.LINE_AA)
-
-            prev_x = cur_x
-            prev_y = cur_y
+            path.add(cur_x, cur_y)
     
         if(t%100 == 0):
             status_print.update(t)
-
+            largeformat.trim()
+            if(movie is not None and movie.due(t)):
+                path.flush()
+                movie.update(t)
+
+    path.flush()
+    if(movie is not None):
+        movie.finish()
     status_print.finished()
 
     if(early_stop):
         print("Got the image processing ready faster than planned")
 
     print("Did draw total {} curves".format(loop_counter))
-
+    instrument.count('curves', loop_counter - first_t)
+    instrument.count('search_expansions', expansions)
+    instrument.count('jumps', jumps)
+    instrument.count('cleared_areas', cleared)
+    instrument.count('early_stops', 1 if early_stop else 0)
+
+    if(vector_out is not None):
+        return None
+    return coverage_image(mask, source_img, background_color)
+
+
+def coverage_image(mask, source_img, background_color, out=None):
+    # Result image from the line coverage mask (0 - 255): 
+    # background * (1 - coverage) + source * coverage. 
+    img = out if out is not None else largeformat.empty(source_img.shape, dtype=np.uint8)
+    background = np.asarray(background_color, dtype=np.float32)
+    rows = largeformat.band_rows(img, row_bytes=img.strides[0] * 8) # float32 temporaries
+    for y1, y2 in largeformat.bands(img, rows):
+        coverage = mask[y1:y2, :, np.newaxis] * np.float32(1 / 255)
+        img[y1:y2] = background + (source_img[y1:y2] - background) * coverage + 0.5
+        largeformat.trim()
     return img 
\ No newline at end of file
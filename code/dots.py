@@ -1,33 +1,292 @@
 import numpy as np
 import cv2
+import math
+import instrument
+import largeformat
 
-from utils import ProgressReport, fill_image
 
+# Ink colors for the color screens
+INK_COLORS = {
+    'cyan': [0, 255, 255],
+    'magenta': [255, 0, 255],
+    'yellow': [255, 255, 0],
+    'black': [0, 0, 0],
+}
 
-def dots(source_img):
-    step = 20
-    max_radius = 14
+# Screen angles for the color separations, in degrees
+SCREEN_ANGLES = {'cyan': 15, 'magenta': 75, 'yellow': 0, 'black': 45}
+
+# Image size (longest side) that the drawing parameters are tuned for. 
+REFERENCE_SIZE = 4000
+
+# Number of dot sizes, the dot radius is level / DOT_LEVELS * max_radius. 
+DOT_LEVELS = 14
+
+
+def dots(source_img, vector_out=None, step=None, max_radius=None, screens=None, scale=None):
+    # Halftone effect. The image is divided to step x step cells, every other
+    # row is shifted by half cell. Each cell is drawn as one dot whose radius
+    # depends on the cell brightness.
+    # Step and max_radius are by default 20 and 14 pixels multiplied by scale. 
+    # By default scale is relative to the image size, so smaller image gives 
+    # scaled down version of the result. 
+    # Screens defines the inks: None draws black dots using the average of the
+    # color channels, 'cmy' and 'cmyk' draw each ink with its own screen that
+    # is rotated to its traditional angle.
+    # If vector_out writer is given, the dots are written to it instead of
+    # drawing the result image and None is returned.
     background_color = [255, 255, 255]
     circle_color = [0, 0, 0]
 
     size_x = source_img.shape[1]
     size_y = source_img.shape[0]
+    if(scale is None):
+        scale = max(size_x, size_y) / REFERENCE_SIZE
+    if(step is None):
+        step = max(int(round(20 * scale)), 2)
+    if(max_radius is None):
+        max_radius = 14 * scale
+
+    # Ink separation. Each layer is (brightness image, ink color, screen angle),
+    # where brightness 255 means no ink. Color image as brightness means the
+    # average of the channels.
+    if(screens is None):
+        layers = [(source_img, circle_color, 0)]
+    else:
+        layers = [(img, INK_COLORS[ink], SCREEN_ANGLES[ink])\
+            for ink, img in separate_inks(source_img, screens)]
+
+    # Compose the result image. Each ink layer multiplies the image with its
+    # transmittance, like overprinted inks. The axis aligned screens are 
+    # computed in tiles (see screen_tiles), the rotated ones at once. 
+    result = None
+    dot_count = 0
+    for brightness, color, angle in layers:
+        if(angle == 0):
+            screen = screen_tiles(brightness, step, max_radius, vector_out is None)
+        else:
+            transmit, centers = halftone_screen(brightness, step, max_radius, angle,\
+                vector_out is None)
+            screen = [(0, size_y, 0, size_x, transmit, centers)]
+
+        for y1, y2, x1, x2, transmit, centers in screen:
+            dot_count += len(centers)
+
+            if(vector_out is not None):
+                for x, y, r in centers:
+                    if(r > 0):
+                        vector_out.circle(x, y, r, color, fill=True)
+                continue
+
+            if(len(layers) == 1 and color == [0, 0, 0] and background_color == [255, 255, 255]):
+                # Black ink on white, the transmittance is the result
+                if(result is None):
+                    result = largeformat.empty((size_y, size_x, 3))
+                result[y1:y2, x1:x2] = transmit[:, :, None]
+                continue
+            if(result is None):
+                result = np.full((size_y, size_x, 3), 1.0, dtype=np.float32)
+            transmit = transmit.astype(np.float32) / 255.0
+            ink = np.array(color, dtype=np.float32) / 255.0
+            result[y1:y2, x1:x2] *= transmit[:, :, None] + ink[None, None, :] * (1.0 - transmit[:, :, None])
+
+    print("Drawing the image using {} dots".format(dot_count))
+    instrument.count('dots', dot_count)
+    if(vector_out is not None):
+        return None
+
+    if(result.dtype == np.uint8):
+        return result
+    result *= np.array(background_color, dtype=np.float32)
+    return np.rint(result).astype(np.uint8)
+
+
+def separate_inks(source_img, screens):
+    # Returns list of (ink name, brightness image) pairs for CMY or CMYK inks.
+    rgb = source_img.astype(np.float32) / 255.0
+    cmy = 1.0 - rgb
+    layers = []
+    if(screens == 'cmyk'):
+        # Gray component is drawn with black ink
+        k = np.min(cmy, axis=2)
+        scale = np.where(k < 1.0, 1.0 / np.maximum(1.0 - k, 1e-6), 0.0)
+        cmy = (cmy - k[:, :, None]) * scale[:, :, None]
+        layers.append(('black', 255.0 * (1.0 - k)))
+    elif(screens != 'cmy'):
+        raise ValueError('Unknown screens {}'.format(screens))
+
+    for i, ink in enumerate(('cyan', 'magenta', 'yellow')):
+        layers.append((ink, 255.0 * (1.0 - cmy[:, :, i])))
+    return layers
+
+
+def dot_sprites(max_radius, levels):
+    # Pre-rendered antialiased dots for every dot size 0...levels. Returns
+    # the transmittance (255 = no ink) array of size (levels + 1, P, P),
+    # the dot center is at P // 2. The radii are drawn with 1/16 pixel 
+    # accuracy. 
+    size = 2 * int(math.ceil(max_radius)) + 3
+    sprites = np.full((levels + 1, size, size), 255, dtype=np.uint8)
+    for level in range(levels + 1):
+        r = int(round(level * max_radius / levels * 16))
+        cv2.circle(sprites[level], ((size // 2) * 16, (size // 2) * 16), r, 0,\
+            thickness = -1, lineType=cv2.LINE_AA, shift=4)
+    return sprites
+
+
+def cell_means(integral, y1, y2, x1, x2, channels=1):
+    # Average value of the cells y1...y2 x x1...x2 from integral image. For
+    # multichannel image the integral is taken from the sum of the channels
+    # and the average is taken over the channels too.
+    sums = integral[y2][:, x2] - integral[y1][:, x2] - integral[y2][:, x1] + integral[y1][:, x1]
+    if(channels > 1):
+        sums = sums / channels
+    counts = (y2 - y1)[:, None] * (x2 - x1)[None, :]
+    return sums / counts
+
+
+def screen_tiles(brightness, step, max_radius, render=True):
+    # Axis aligned halftone screen computed in tiles, so that the working
+    # memory does not depend on the image size. Each tile is computed from the
+    # image area around it, so the dots that cross the tile edges are the same
+    # as with the whole image. In the normal mode (see largeformat.py) the 
+    # whole image is one tile. Yields (first row, end row, first column, end 
+    # column, transmittance of the tile, dots of the tile). 
+    size_y = brightness.shape[0]
+    size_x = brightness.shape[1]
+    if(not largeformat.active()):
+        transmit, centers = halftone_screen(brightness, step, max_radius, 0, render)
+        yield 0, size_y, 0, size_x, transmit, centers
+        return
+
+    # The tiles start at even cell rows and at cell columns. The integral 
+    # image (float64) of the tile and its pads takes most of the memory. 
+    sprite_size = 2 * int(math.ceil(max_radius)) + 3
+    pad = -(-(sprite_size + 2 * step) // (2 * step)) * 2 * step
+    side = int(math.sqrt(largeformat.BAND_BYTES / 8)) - 2 * pad
+    side = max(side // (2 * step), 1) * 2 * step
+
+    for y1 in range(0, size_y, side):
+        y2 = min(y1 + side, size_y)
+        top = max(y1 - pad, 0)
+        bottom = min(y2 + pad, size_y)
+        for x1 in range(0, size_x, side):
+            x2 = min(x1 + side, size_x)
+            left = max(x1 - pad, 0)
+            right = min(x2 + pad, size_x)
+            transmit, centers = halftone_screen(brightness[top:bottom, left:right], step,\
+                max_radius, 0, render)
+            if(render):
+                transmit = transmit[y1 - top:y2 - top, x1 - left:x2 - left]
+            # The last cells can have their centers outside the image
+            y_end = y2 if y2 < size_y else math.inf
+            x_end = x2 if x2 < size_x else math.inf
+            centers = [(x + left, y + top, r) for x, y, r in centers\
+                if y1 <= y + top < y_end and x1 <= x + left < x_end]
+            yield y1, y2, x1, x2, transmit, centers
+            largeformat.trim(force=True)
+
+
+def halftone_screen(brightness, step, max_radius, angle=0, render=True):
+    # Computes one halftone screen. Returns the transmittance image (255 = no
+    # ink, None if render is False) and the list of dots (x, y, radius) in the
+    # image coordinates. The screen is rotated by angle degrees.
+    size_y = brightness.shape[0]
+    size_x = brightness.shape[1]
+
+    if(angle != 0):
+        # Rotate the image so that the screen is axis aligned.
+        center = (size_x / 2.0, size_y / 2.0)
+        rot = cv2.getRotationMatrix2D(center, angle, 1.0)
+        cos_a = abs(rot[0, 0])
+        sin_a = abs(rot[0, 1])
+        rot_x = int(math.ceil(size_x * cos_a + size_y * sin_a))
+        rot_y = int(math.ceil(size_x * sin_a + size_y * cos_a))
+        rot[0, 2] += rot_x / 2.0 - center[0]
+        rot[1, 2] += rot_y / 2.0 - center[1]
+        rotated = cv2.warpAffine(brightness.astype(np.float32), rot, (rot_x, rot_y),\
+            flags=cv2.INTER_LINEAR, borderValue=(255.0, 255.0, 255.0))
+        transmit, centers = halftone_screen(rotated, step, max_radius, 0, render)
+
+        # Rotate the result back
+        inverse = cv2.invertAffineTransform(rot)
+        if(render):
+            transmit = cv2.warpAffine(transmit, inverse, (size_x, size_y),\
+                flags=cv2.INTER_LINEAR, borderValue=255)
+        centers = [(inverse[0, 0] * x + inverse[0, 1] * y + inverse[0, 2],\
+            inverse[1, 0] * x + inverse[1, 1] * y + inverse[1, 2], r) for x, y, r in centers\
+            if r > 0]
+        centers = [(x, y, r) for x, y, r in centers if 0 <= x < size_x and 0 <= y < size_y]
+        return transmit, centers
+
+    # The channel sums are exact in float32, so the cell means are the same 
+    # as with the integral of every channel. 
+    channels = 1
+    if(brightness.ndim == 3):
+        channels = brightness.shape[2]
+        brightness = np.sum(brightness, axis=2, dtype=np.float32)
+    integral = cv2.integral(brightness, sdepth=cv2.CV_64F)
+    sprites = dot_sprites(max_radius, DOT_LEVELS)
+    size = sprites.shape[1]
+    half = size // 2
+
+    # Transmittance image with margins for the dots at the edges
+    margin = size + 2 * step
+    if(render):
+        transmit = np.full((size_y + 2 * margin, size_x + 2 * margin), 255, dtype=np.uint8)
+    centers = []
 
-    target_img = np.full(source_img.shape, 0, dtype=np.uint8)
-    fill_image(target_img, background_color)
+    # Cells on the even and odd rows. Odd rows are shifted by half cell.
+    for parity in (0, 1):
+        y1 = np.arange(parity * step, size_y, 2 * step)
+        x1 = np.arange(int(parity * step / 2), size_x, step)
+        if(len(y1) == 0 or len(x1) == 0):
+            continue
+        y2 = np.minimum(y1 + step, size_y)
+        x2 = np.minimum(x1 + step, size_x)
 
-    status_print = ProgressReport(size_y, 'dots effect')
+        # All dot sizes at once
+        avg = cell_means(integral, y1, y2, x1, x2, channels).astype(int)
+        level = (((255.0 - avg) / 255.0) * DOT_LEVELS).astype(int)
+        level = np.clip(level, 0, DOT_LEVELS)
+        cx = (x1 + step / 2.0).astype(int)
+        cy = (y1 + step / 2.0).astype(int)
 
-    for y in range(0, size_y, step):
-        for x in range(int(((y/step)%2)*step/2), size_x, step):
-            rgb_avg = int(np.mean(source_img[y:y+step, x:x+step, 0:2]))
-            radius = int((( 255.0 - rgb_avg) / 255.0) * max_radius)
-            xcoord = int((x + step/2.0))
-            ycoord = int((y + step/2.0))
-            cv2.circle(target_img, (xcoord, ycoord), radius,\
-                circle_color, thickness = -1, lineType=cv2.LINE_AA)
+        grid_y, grid_x = np.meshgrid(cy, cx, indexing='ij')
+        centers.extend(zip(grid_x.ravel().tolist(), grid_y.ravel().tolist(),\
+            (level * (max_radius / DOT_LEVELS)).ravel().tolist()))
+        if(not render):
+            continue
 
-        status_print.update(y)
+        # The dots can be larger than the cells, so the cells are drawn in
+        # phases where the dots of one phase can't overlap. Each phase is
+        # composed to one image from the sprites with reshaping. The phases
+        # are multiplied to the transmittance. Where the antialiased edges of
+        # the dots overlap, this is the same as painting the ink over the
+        # earlier dots (value * (1 - coverage)), except for the rounding: at
+        # 4000 pixels 0.3% of the pixels differ by at most 2 levels from
+        # cv2.circle painting.
+        ky = -(-size // (2 * step))
+        kx = -(-size // step)
+        span_y = 2 * step * ky
+        span_x = step * kx
+        for a in range(ky):
+            for b in range(kx):
+                lv = level[a::ky, b::kx]
+                if(lv.size == 0):
+                    continue
+                tiles = np.full(lv.shape + (span_y, span_x), 255, dtype=np.uint8)
+                tiles[:, :, :size, :size] = sprites[lv]
+                layer = tiles.transpose(0, 2, 1, 3).reshape(lv.shape[0] * span_y,\
+                    lv.shape[1] * span_x)
+                top = cy[a] - half + margin
+                left = cx[b] - half + margin
+                area = transmit[top:top + layer.shape[0], left:left + layer.shape[1]]
+                cv2.multiply(area, layer[:area.shape[0], :area.shape[1]], dst=area,\
+                    scale=1/255.0)
 
-    status_print.finished()
-    return target_img
\ No newline at end of file
+    if(render):
+        transmit = transmit[margin:margin + size_y, margin:margin + size_x]
+    else:
+        transmit = None
+    return transmit, centers
@@ -0,0 +1,125 @@
+# Registry of the effects. Each effect is run by a small function that imports
+# the effect module only when the effect is used, so that the start of the
+# program does not load the modules and their heavy dependencies (scipy etc.)
+# for the effects that are not selected. A new effect is added by writing its
+# run function and registering it with the effect decorator. Long running
+# programs can import the effect modules in advance with preload().
+# The run functions get the preprocessed input images (see pipeline.py), the
+# vector writer or None, the random seed and the checkpoint (see checkpoint.py)
+# and return the result image, or None if the result was written to the
+# vector writer. The effects that support the multi-pen mode (see
+# multi_pen.py) get also the number of pens.
+
+import importlib
+
+_effects = {}
+
+
+def effect(name, module, checkpoint=False, pens=False, animation=False, random=True):
+    # Decorator that registers the run function of the effect. Module is the
+    # name of the effect module. Checkpoint tells whether the effect can save
+    # checkpoints, pens whether it can be drawn with multiple pens,
+    # animation whether it can write the drawing process as animation and
+    # random whether the result depends on the random seed.
+    def register(run):
+        _effects[name] = (run, module, checkpoint, pens, animation, random)
+        return run
+    return register
+
+
+def names():
+    return tuple(_effects)
+
+
+def supports_checkpoint(name):
+    return _effects[name][2]
+
+
+def supports_pens(name):
+    return _effects[name][3]
+
+
+def supports_animation(name):
+    return _effects[name][4]
+
+
+def uses_random(name):
+    return _effects[name][5]
+
+
+def module(name):
+    return _effects[name][1]
+
+
+def preload(names=None):
+    # Import the modules of the effects (all by default).
+    for name in (names or _effects):
+        importlib.import_module(_effects[name][1])
+
+
+def run(name, inputs, vector_out=None, seed=None, checkpoint=None, pens=1):
+    run_function, module, can_checkpoint, multi_pen, animation, random = _effects[name]
+    if(not can_checkpoint):
+        checkpoint = None
+    if(multi_pen):
+        return run_function(inputs, vector_out, seed, checkpoint, pens)
+    return run_function(inputs, vector_out, seed, checkpoint)
+
+
+@effect("circles", "circles", checkpoint=True, animation=True)
+def run_circles(inputs, vector_out, seed, checkpoint):
+    from circles import circles
+    return circles(inputs[0], vector_out, seed=seed, checkpoint=checkpoint)
+
+
+@effect("dots", "dots", random=False)
+def run_dots(inputs, vector_out, seed, checkpoint):
+    # Dots effect does not use random numbers.
+    from dots import dots
+    return dots(inputs[0], vector_out)
+
+
+@effect("scribble", "mono_scribble", checkpoint=True, pens=True, animation=True)
+def run_scribble(inputs, vector_out, seed, checkpoint, pens):
+    if(pens != 1 and vector_out is None):
+        from multi_pen import multi_pen
+        return multi_pen("scribble", inputs[0], pens, seed=seed)
+    from mono_scribble import mono_scribble
+    #tmp = add_dither_grayscale(inputs[0], 3) # may be needed for images with flat color areas
+    return mono_scribble(inputs[0], vector_out, seed=seed, checkpoint=checkpoint)
+
+
+@effect("color_scribble", "color_scribble", checkpoint=True, pens=True,\
+    animation=True)
+def run_color_scribble(inputs, vector_out, seed, checkpoint, pens):
+    if(pens != 1 and vector_out is None):
+        from multi_pen import multi_pen
+        return multi_pen("color_scribble", inputs[0], pens, seed=seed)
+    from color_scribble import color_scribble
+    return color_scribble(inputs[0], vector_out, seed=seed, checkpoint=checkpoint)
+
+
+@effect("cmy_scribble", "separation")
+def run_cmy_scribble(inputs, vector_out, seed, checkpoint):
+    from separation import separation_scribble
+    return separation_scribble(inputs[0], 'cmy', vector_out, seed=seed)
+
+
+@effect("rgb_scribble", "separation")
+def run_rgb_scribble(inputs, vector_out, seed, checkpoint):
+    from separation import separation_scribble
+    return separation_scribble(inputs[0], 'rgb', vector_out, seed=seed)
+
+
+@effect("color_triangles", "triangulate")
+def run_color_triangles(inputs, vector_out, seed, checkpoint):
+    from triangulate import triangulate
+    return triangulate(inputs[0], BW=False, vector_out=vector_out, equalized=inputs[1],\
+        seed=seed)
+
+
+@effect("triangles", "triangulate")
+def run_triangles(inputs, vector_out, seed, checkpoint):
+    from triangulate import triangulate
+    return triangulate(inputs[0], BW=True, vector_out=vector_out, equalized=inputs[1],\
+        seed=seed)
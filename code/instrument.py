@@ -0,0 +1,209 @@
+import sys
+import os
+import os.path
+import io
+import json
+import time
+import cProfile
+import pstats
+
+
+# Instrumentation for the processing. The code reports its progress, the
+# processing stages and counters of interesting events with the functions
+# of this module, and those are passed as events to the sinks:
+#   stage      processing stage finished, with its duration and counters
+#   progress   progress of a long running loop
+#   message    free text message
+# Each event is a dictionary with at least 'event', 'name' and 'time' keys.
+# Without sinks the functions return immediately. The hot loops should
+# accumulate their counters to local variables and report those once, at
+# the end of the stage.
+# If profiling is enabled, every stage is run with its own cProfile profiler
+# and the statistics are saved to the profile directory, one file per stage.
+# Only one profiler can be active at a time, so the profiler of a stage is
+# paused while its sub-stages run: the profile of a stage covers the time
+# spent in the stage outside its sub-stages. 
+
+
+class ConsoleSink(object):
+    # Human readable output. The progress is updated on the same line on a
+    # terminal, otherwise it is written on new lines at every 10 percent.
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.last_percent = {}
+
+    def __call__(self, event):
+        stream = self.stream or sys.stdout
+        kind = event['event']
+        if(kind == 'progress'):
+            percent = int(event['percent'])
+            tty = hasattr(stream, 'isatty') and stream.isatty()
+            if(event.get('done')):
+                stream.write('{}Computing {}: Done\n'.format('\r' if tty else '', event['name']))
+                self.last_percent.pop(event['name'], None)
+            elif(tty):
+                stream.write('\rComputing {}: {:2d}%'.format(event['name'], percent))
+            elif(percent // 10 != self.last_percent.get(event['name'], -1) // 10):
+                stream.write('Computing {}: {:2d}%\n'.format(event['name'], percent))
+            self.last_percent[event['name']] = percent
+            stream.flush()
+        elif(kind == 'message'):
+            stream.write(event['text'] + '\n')
+            stream.flush()
+        elif(kind == 'profile'):
+            stream.write('Profile of {} saved to {}\n'.format(event['name'], event['path']))
+
+
+class JsonLinesSink(object):
+    # Writes every event as one JSON line to the file.
+
+    def __init__(self, filename):
+        self.file = open(filename, 'a')
+
+    def __call__(self, event):
+        self.file.write(json.dumps(event, default=str) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CallbackSink(object):
+    # Calls the function with every event.
+
+    def __init__(self, callback, kinds=None):
+        self.callback = callback
+        self.kinds = kinds # event kinds to pass, None for all
+
+    def __call__(self, event):
+        if(self.kinds is None or event['event'] in self.kinds):
+            self.callback(event)
+
+
+class Instrument(object):
+
+    def __init__(self, sinks=None, profile_dir=None):
+        self.sinks = list(sinks or [])
+        self.profile_dir = profile_dir
+        self.stages = [] # stack of (name, start time, counters)
+        self.profiler = None
+
+    def emit(self, event):
+        event['time'] = time.time()
+        for sink in self.sinks:
+            sink(event)
+
+    def stage_name(self):
+        return '/'.join(s[0] for s in self.stages)
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def count(self, name, value=1):
+        # Add value to the counter of the current stage.
+        if(not self.sinks or not self.stages):
+            return
+        counters = self.stages[-1][2]
+        counters[name] = counters.get(name, 0) + value
+
+    def progress(self, name, value, total, done=False):
+        if(not self.sinks):
+            return
+        percent = 100.0 if done else min(value / max(total, 1e-9) * 100.0, 99.0)
+        self.emit({'event': 'progress', 'name': name, 'stage': self.stage_name(),\
+            'value': value, 'total': total, 'percent': percent, 'done': done})
+
+    def message(self, text):
+        if(not self.sinks):
+            return
+        self.emit({'event': 'message', 'name': self.stage_name(), 'text': text})
+
+
+class Stage(object):
+    # Context manager for one processing stage.
+
+    def __init__(self, instrument, name):
+        self.instrument = instrument
+        self.name = name
+        self.profiler = None
+        self.parent_profiler = None
+
+    def __enter__(self):
+        ins = self.instrument
+        ins.stages.append((self.name, time.perf_counter(), {}))
+        if(ins.profile_dir is not None):
+            # Pause the profiler of the enclosing stage
+            self.parent_profiler = ins.profiler
+            if(self.parent_profiler is not None):
+                self.parent_profiler.disable()
+            self.profiler = cProfile.Profile()
+            ins.profiler = self.profiler
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        ins = self.instrument
+        if(self.profiler is not None):
+            self.profiler.disable()
+            self.save_profile()
+            ins.profiler = self.parent_profiler
+            if(self.parent_profiler is not None):
+                self.parent_profiler.enable()
+        full_name = ins.stage_name()
+        name, start, counters = ins.stages.pop()
+        if(ins.sinks):
+            ins.emit({'event': 'stage', 'name': full_name, 'seconds': time.perf_counter() - start,\
+                'counters': counters, 'failed': exc_type is not None})
+
+    def save_profile(self):
+        # Save the raw statistics (.prof) and the top functions as text.
+        ins = self.instrument
+        os.makedirs(ins.profile_dir, exist_ok=True)
+        base = os.path.join(ins.profile_dir, ins.stage_name().replace('/', '.'))
+        self.profiler.dump_stats(base + '.prof')
+        text = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=text)
+        stats.sort_stats('cumulative').print_stats(30)
+        with open(base + '.txt', 'w') as f:
+            f.write(text.getvalue())
+        if(ins.sinks):
+            ins.emit({'event': 'profile', 'name': ins.stage_name(), 'path': base + '.prof'})
+
+
+# The instrument that is used by the program. By default the progress is
+# written to the console.
+_current = Instrument([ConsoleSink()])
+
+
+def current():
+    return _current
+
+
+def configure(sinks=None, profile_dir=None):
+    # Replace the instrument. Returns the old one, so that it can be restored.
+    global _current
+    old = _current
+    _current = Instrument(sinks, profile_dir)
+    return old
+
+
+def restore(instrument):
+    global _current
+    _current = instrument
+
+
+def stage(name):
+    return _current.stage(name)
+
+
+def count(name, value=1):
+    _current.count(name, value)
+
+
+def progress(name, value, total, done=False):
+    _current.progress(name, value, total, done)
+
+
+def message(text):
+    _current.message(text)
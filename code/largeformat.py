@@ -0,0 +1,243 @@
+import numpy as np
+import cv2
+import os
+import os.path
+import mmap
+import tempfile
+import shutil
+import struct
+import time
+import zlib
+
+
+# Large-format mode for the mural size images (20000 - 40000 pixels). The
+# effects allocate their working images and canvases with the functions of
+# this module. Normally those are ordinary numpy arrays, but when a workspace
+# is active, the arrays are memory-mapped files in the workspace directory.
+# The pages of the mapped files are released from the process memory with
+# trim(), which the effects call periodically from their main loops, and the
+# tile rendering and band-wise writing call after every band. The data stays
+# in the files, so the images do not make the memory use of the process grow
+# with the image size. The other state of the effects is not mapped: the
+# triangulation, the circle grid and the scribble pyramid still grow with
+# the image size. Note that drawing touches one memory page per image row,
+# so even small shapes can bring lots of pages to the memory.
+
+
+# Rows in one band of the band-wise processing are chosen so that one band
+# takes about this much memory.
+BAND_BYTES = 64 * 1024**2
+
+# The mapped pages are released in trim() when the process memory use
+# (resident set size) is above this.
+MEMORY_LIMIT = 512 * 1024**2
+
+# Minimum time between the releases of the mapped pages in trim(), used if
+# the memory use of the process is not available.
+TRIM_INTERVAL = 0.1 # seconds
+
+
+class Workspace(object):
+    # Directory for the files of the memory-mapped arrays. The directory is
+    # removed when the workspace is closed.
+
+    def __init__(self, directory=None):
+        self.directory = tempfile.mkdtemp(prefix='artbot_', dir=directory)
+        self.maps = []
+        self.count = 0
+        self.last_trim = time.time()
+
+    def array(self, shape, dtype, fill=None):
+        # New array that is backed by a file. The file is removed right away,
+        # the mapping keeps the data available until the array is released.
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        filename = os.path.join(self.directory, 'array{}.bin'.format(self.count))
+        self.count += 1
+        with open(filename, 'w+b') as f:
+            f.truncate(size)
+            buffer = mmap.mmap(f.fileno(), size)
+        os.remove(filename)
+        self.maps.append(buffer)
+        arr = np.ndarray(shape, dtype=dtype, buffer=buffer)
+        if(fill is not None):
+            for y1, y2 in bands(arr):
+                arr[y1:y2] = fill
+                self.release()
+        return arr
+
+    def release(self):
+        # Drop the mapped pages from the process memory. The dirty pages are
+        # written to the files by the operating system.
+        if(not hasattr(mmap, 'MADV_DONTNEED')):
+            return
+        for buffer in self.maps:
+            if(not buffer.closed):
+                buffer.madvise(mmap.MADV_DONTNEED)
+        self.last_trim = time.time()
+
+    def close(self):
+        # The arrays must not be used after this.
+        self.maps = []
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# The active workspace, None in the normal mode.
+_workspace = None
+
+
+def use(workspace):
+    # Set the active workspace. Returns the old one, so that it can be
+    # restored.
+    global _workspace
+    old = _workspace
+    _workspace = workspace
+    return old
+
+
+def active():
+    return _workspace is not None
+
+
+def full(shape, fill, dtype=np.uint8):
+    # Like np.full, but the array is memory-mapped in the large-format mode.
+    if(_workspace is None):
+        return np.full(shape, fill, dtype=dtype)
+    return _workspace.array(shape, dtype, fill)
+
+
+def empty(shape, dtype=np.uint8):
+    if(_workspace is None):
+        return np.empty(shape, dtype=dtype)
+    return _workspace.array(shape, dtype)
+
+
+def copy(img):
+    # Copy of the image, memory-mapped in the large-format mode.
+    if(_workspace is None):
+        return img.copy()
+    result = _workspace.array(img.shape, img.dtype)
+    for y1, y2 in bands(img):
+        result[y1:y2] = img[y1:y2]
+        _workspace.release()
+    return result
+
+
+def trim(force=False):
+    # Release the mapped pages if the memory use is above MEMORY_LIMIT, or
+    # always if force is True. Does nothing in the normal mode.
+    if(_workspace is None):
+        return
+    if(force):
+        _workspace.release()
+        return
+    resident = resident_memory()
+    if(resident is None):
+        if(time.time() - _workspace.last_trim >= TRIM_INTERVAL):
+            _workspace.release()
+    elif(resident > MEMORY_LIMIT):
+        _workspace.release()
+
+
+def resident_memory():
+    # Resident set size of the process in bytes, None if not available.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def mean(img, axis=None):
+    # Like np.mean, but the image is read in bands in the large-format mode.
+    if(_workspace is None):
+        return np.mean(img, axis=axis)
+    total = 0.0
+    for y1, y2 in bands(img):
+        total = total + np.sum(img[y1:y2], axis=axis, dtype=np.float64)
+        trim()
+    count = img.size if axis is None else np.prod([img.shape[a] for a in axis])
+    return total / count
+
+
+def band_rows(img, multiple=1, row_bytes=None):
+    # Number of rows in one band of the image, a multiple of multiple. In
+    # the normal mode the whole image is one band. Row_bytes is the memory
+    # that the processing needs per image row, by default the row size.
+    size_y = img.shape[0]
+    if(_workspace is None):
+        return max(size_y, 1)
+    if(row_bytes is None):
+        row_bytes = img.strides[0]
+    rows = max(BAND_BYTES // max(row_bytes, 1), 16)
+    return max(rows // multiple, 1) * multiple
+
+
+def bands(img, rows=None):
+    # Yields (first row, end row) of the horizontal bands of the image.
+    size_y = img.shape[0]
+    if(rows is None):
+        rows = band_rows(img)
+    for y1 in range(0, size_y, rows):
+        yield y1, min(y1 + rows, size_y)
+
+
+def resize(img, size):
+    # Resize the image so that its longest side is size pixels. The result
+    # is computed in bands with bilinear interpolation, like cv2.resize.
+    scaling = size / max(img.shape[0], img.shape[1])
+    size_x = int(round(img.shape[1] * scaling))
+    size_y = int(round(img.shape[0] * scaling))
+    result = empty((size_y, size_x) + img.shape[2:], img.dtype)
+    scale_x = img.shape[1] / size_x
+    scale_y = img.shape[0] / size_y
+    for y1, y2 in bands(result):
+        # Maps the band pixel centers to the source image
+        matrix = np.array([[scale_x, 0.0, 0.5 * scale_x - 0.5],\
+            [0.0, scale_y, (y1 + 0.5) * scale_y - 0.5]])
+        cv2.warpAffine(img, matrix, (size_x, y2 - y1), dst=result[y1:y2],\
+            flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        trim(force=True)
+    return result
+
+
+def write_png(filename, img, level=6):
+    # Write RGB or grayscale uint8 image to PNG file band by band, so that
+    # the whole image is never in memory at once. Every row uses the Sub
+    # filter (difference to the pixel on the left), which compresses the
+    # drawings well and is cheap to compute with numpy.
+    print('Saving the image to file {}'.format(filename))
+    size_y = img.shape[0]
+    size_x = img.shape[1]
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+    compressor = zlib.compressobj(level)
+
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        write_chunk(f, b'IHDR', struct.pack('>IIBBBBB', size_x, size_y, 8, color_type, 0, 0, 0))
+        for y1, y2 in bands(img, max(BAND_BYTES // max(size_x * channels, 1), 16)):
+            band = np.ascontiguousarray(img[y1:y2]).reshape(y2 - y1, size_x * channels)
+            rows = np.empty((y2 - y1, size_x * channels + 1), dtype=np.uint8)
+            rows[:, 0] = 1 # Sub filter
+            rows[:, 1:channels + 1] = band[:, :channels]
+            np.subtract(band[:, channels:], band[:, :-channels], out=rows[:, channels + 1:])
+            data = compressor.compress(rows.tobytes())
+            if(data):
+                write_chunk(f, b'IDAT', data)
+            trim(force=True)
+        write_chunk(f, b'IDAT', compressor.flush())
+        write_chunk(f, b'IEND', b'')
+
+
+def write_chunk(f, kind, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(kind)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
@@ -1,13 +1,29 @@
 import numpy as np
-from random import randrange
+import random
 import math
 import cv2
+from scribble_engine import DirectionSearch, PathBuffer, DarkPyramid
+import instrument
+import largeformat
+import animation
 from utils import ProgressReport
+from preprocess import clamp_invert
 
 
-def mono_scribble(source_img):
+# Image size (longest side) that the drawing parameters are tuned for. 
+REFERENCE_SIZE = 3000
+
+
+def mono_scribble(source_img, vector_out=None, seed=None, checkpoint=None, scale=None):
 
     # This effect takes grayscale image as input. 
+    # If vector_out writer is given, the line is written to it instead of 
+    # drawing the result image and None is returned. 
+    # If checkpoint (see checkpoint.py) is given, the drawing state is saved 
+    # to it periodically and the drawing is continued from the saved state. 
+    # Checkpoints are not used with vector output. 
+    # The pen geometry is scaled by scale, by default it is relative to the 
+    # image size, so smaller image gives scaled down version of the result. 
 
     # Define target color theme:
     # Sepia theme
@@ -20,28 +36,31 @@ def mono_scribble(source_img):
 
     # Make copy of the source img, since the working omage will be 
     # destroyed during the process
-    pic = source_img.copy()
+    pic = largeformat.copy(source_img)
 
     # Max values for x and y. 
     size_x = pic.shape[1]
     size_y = pic.shape[0]
+    if(scale is None):
+        scale = max(size_x, size_y) / REFERENCE_SIZE
     
     # Attenuate the high values to avoid white areas to be left untouched.
     # The algorithm won't draw areas that are 255. 
-    for y in range(size_y):
-        for x in range(size_x):
-            if(pic[y, x] > 250):
-                pic[y, x] = 250   
+    clamp_invert(pic, 250, out=pic)
 
     # Create empty array for the target image
-    img = np.full((size_y, size_x, 3), background_color, dtype=np.uint8)
+    if(vector_out is None):
+        img = largeformat.full((size_y, size_x, 3), background_color, dtype=np.uint8)
+    else:
+        img = None
     
     # Calculate estimate of the required line segment qty
     # This is empirical formula and typically overestimates the complexity, 
     # which means that the algorithm stops by itself before reaching this limit. 
-    pic_mean = np.mean(pic)
+    # The curve count per area follows the scaled clearing area (see below). 
+    pic_mean = largeformat.mean(pic)
     pix_qty = pic.shape[0] * pic.shape[1]
-    loop_qty = int(pix_qty * (255 - pic_mean) / 2200)
+    loop_qty = int(pix_qty * (255 - pic_mean) / (2200 * scale))
 
     # Prepare the progress printing
     status_print = ProgressReport(loop_qty, 'mono scribble effect')
@@ -55,23 +74,85 @@ def mono_scribble(source_img):
         cos360_table.append(math.cos((a/180) * math.pi))
 
 
-    # Select random location for starting the drawing
-    cur_x = randrange(size_x)
-    cur_y = randrange(size_y)
+    # Prepare the direction search for the working image
+    search = DirectionSearch(pic)
+
+    # Index for finding the remaining areas to be drawn when there is nothing 
+    # left around the pen. 
+    pyramid = DarkPyramid(pic)
+
+    # Select random location for starting the drawing. Same seed gives 
+    # always the same drawing. 
+    rand_gen = random.Random(seed)
+    cur_x = rand_gen.randrange(size_x)
+    cur_y = rand_gen.randrange(size_y)
+
+    # The line is stored to path buffer and drawn to the image in large batches.
+    path = PathBuffer(img, line_color)
+    if(vector_out is not None):
+        path.consumers.append(lambda points: vector_out.polyline(points, line_color))
+    path.add(cur_x, cur_y)
 
     # Some starting params. 
     new_angle = 0 
     old_angle = 0 
-    speed = 0.4
     old_angle = 0
     new_angle = 0
-    distance = speed * 50 
+    distance = 20 * scale
     clearing_radius = 4
 
+    # The curves are 15 pixels long at scale 1 and made of 10 line segments. 
+    # The line is always one pixel wide, so the scaled down line would be 
+    # too dark if the curves were as many as in the full size result. The 
+    # cleared areas are scaled by scale instead of scale^2, so there are 
+    # 1/scale times more of the 1/scale times shorter curves per area, and 
+    # the tone stays the same. 
+    nsteps = max(int(round(10 * scale)), 2)
+    speed = 15 * scale / nsteps
+    clearing_scale = math.sqrt(scale)
+
     # Start the main drawing loop 
     early_stop = False
     loop_counter = 0
-    for t in range(loop_qty):
+    first_t = 0
+    expansions = 0 # counters for the instrumentation
+    jumps = 0
+    cleared = 0
+
+    # Continue from the checkpoint if there is one
+    if(vector_out is not None):
+        checkpoint = None
+    state = None
+    if(checkpoint is not None):
+        state = checkpoint.load('scribble')
+    if(state is not None and state['pic'].shape == pic.shape):
+        pic[:] = state['pic']
+        img[:] = state['img']
+        pyramid.build()
+        path.restore(state['path'])
+        rand_gen.setstate(state['rand'])
+        first_t = state['t']
+        loop_qty = state['loop_qty']
+        status_print.finish_value = loop_qty
+        loop_counter = state['loop_counter']
+        cur_x, cur_y = state['pen']
+        old_angle = state['old_angle']
+        distance = state['distance']
+
+    # If the drawing is animated (see animation.py), the areas of the drawn 
+    # lines are marked to the animation and the frames are written between 
+    # the progress updates. The first frame shows the restored drawing. 
+    movie = animation.active() if vector_out is None else None
+    if(movie is not None):
+        path.consumers.append(movie.mark_points)
+        movie.start(lambda y1, y2, x1, x2: img[y1:y2, x1:x2], loop_qty, first_t)
+
+    for t in range(first_t, loop_qty):
+        if(checkpoint is not None and t%100 == 0 and checkpoint.due()):
+            checkpoint.save({'effect': 'scribble', 'pic': pic, 'img': img,\
+                'path': path.state(), 'rand': rand_gen.getstate(), 't': t,\
+                'loop_qty': loop_qty, 'loop_counter': loop_counter,\
+                'pen': (cur_x, cur_y), 'old_angle': old_angle, 'distance': distance})
         loop_counter += 1
 
         # Calculate new direction for the line by searching the 
@@ -79,49 +160,42 @@ def mono_scribble(source_img):
         searching = True
         rotat_step = 6 # degree step size for searching
         search_dist = distance # how far to look in searching
+        jump_dist = distance * 2 # search range limit before jumping to the closest dark area
         range_max = 180 # initial angle range for the search
 
         while(searching):
-            darkest_pix = 255 # initialize the max possible value
-
-            # This loop scans the original image for new direction
-            for a in range(0, range_max, rotat_step): # a = angle in degrees
-
-                tmp_a = int(old_angle + a - range_max/2) # temporary angle variable
-                tx = int(cur_x + cos360_table[tmp_a%360] * search_dist)
-                ty = int(cur_y + sin360_table[tmp_a%360] * search_dist)
-                pix = 255
-
-                # Pick the pixel color from the image
-                if(0 < tx < size_x):
-                    if(0 < ty < size_y):
-                        pix = pic[ty, tx]
-
-                # Check that is the pixel value the darkest found so far
-                if(pix <= darkest_pix):
-                    darkest_pix = pix
-                    new_angle = tmp_a 
-                    ptx = tx 
-                    pty = ty 
+            # Scan the working image for new direction. All the angles of 
+            # one search step are picked at once. 
+            darkest_pix, new_angle, ptx, pty = search.scan(cur_x, cur_y,\
+                old_angle, search_dist, range_max, rotat_step)
 
             # Check that was there new direction found
             if(darkest_pix < 255): 
                 searching = False # Stop the search.
-            else: # Nothing usable was found, so expand the search range
+            elif(search_dist < jump_dist): 
+                expansions += 1
+                # Nothing usable was found, so expand the search range
                 if(rotat_step > 1):
                     rotat_step -=1
-                search_dist += 2
+                search_dist += 2 * scale
                 range_max += 1 
-            if(range_max >360):
-                range_max = 360
-
-            # If the search goes beyond the image area, it is likely
-            # that all drawing is done and it is time to stop early. 
-            # All pixels in the pic array should be 255 in this phase.
-            # This is the primary way to stop the algorithm. 
-            if(search_dist > max(size_x, size_y)):
+                if(range_max >360):
+                    range_max = 360
+            elif(pyramid.root() >= 255):
+                # All pixels in the pic array are 255, i.e. all drawing 
+                # is done and it is time to stop early. This is the 
+                # primary way to stop the algorithm. 
                 early_stop = True
                 searching = False
+            else:
+                # Nothing was found nearby. Turn towards the closest area 
+                # that still needs drawing.
+                ptx, pty = pyramid.nearest(cur_x, cur_y)
+                jumps += 1
+                darkest_pix = int(pic[pty, ptx])
+                target_angle = math.degrees(math.atan2(pty - cur_y, ptx - cur_x))
+                new_angle = old_angle + (target_angle - old_angle + 180) % 360 - 180
+                searching = False
         # End of search loop.
 
         if(early_stop):
@@ -142,16 +216,16 @@ def mono_scribble(source_img):
         # ensures that we won't be drawing the same area many times. 
         # Note that this may be bit different location than the line end point.
         clearing_color = darkest_pix + 80
-        clearing_radius = int(clearing_color/30)
+        clearing_radius = int((clearing_color/30 - 0.5) * clearing_scale + 0.5)
         if(clearing_color > 255):
             clearing_color = 255
 
         cv2.circle(pic, (ptx, pty), clearing_radius, int(clearing_color), -1)
+        cleared += 1
+        pyramid.mark(ptx, pty, clearing_radius)
 
 
         # Line drawing parameters
-        speed = 1.5 # Drawing speed
-        nsteps = 10 # Line segments per one curve
         loc_bias = 0  # Can use bias in the location calculation
 
         if(out_of_area):
@@ -162,8 +236,6 @@ def mono_scribble(source_img):
                  
         delta_angle = new_angle - old_angle
         angle_step = delta_angle / nsteps
-        prev_x = cur_x
-        prev_y = cur_y
         old_x = cur_x 
         old_y = cur_y
     
@@ -174,21 +246,29 @@ def mono_scribble(source_img):
             cur_x += cos360_table[angle%360] * speed + loc_bias
             cur_y += sin360_table[angle%360] * speed + loc_bias
             
-            cv2.line(img, (int(cur_x), int(cur_y)),\
-                (int(prev_x), int(prev_y)), line_color, 1, lineType=cv2.LINE_AA)
-
-            prev_x = cur_x
-            prev_y = cur_y
+            path.add(cur_x, cur_y)
     
         # Update the progress report
         if(t%100 == 0):
             status_print.update(t)
-
+            largeformat.trim()
+            if(movie is not None and movie.due(t)):
+                path.flush()
+                movie.update(t)
+
+    path.flush()
+    if(movie is not None):
+        movie.finish()
     status_print.finished()
 
     if(early_stop):
         print("Got the image processing ready faster than planned")
 
     print("Did draw total {} curves".format(loop_counter))
+    instrument.count('curves', loop_counter - first_t)
+    instrument.count('search_expansions', expansions)
+    instrument.count('jumps', jumps)
+    instrument.count('cleared_areas', cleared)
+    instrument.count('early_stops', 1 if early_stop else 0)
 
     return img 
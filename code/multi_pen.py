@@ -0,0 +1,269 @@
+import numpy as np
+import cv2
+import os
+import sys
+import math
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import instrument
+import largeformat
+from utils import ProgressReport
+from mono_scribble import REFERENCE_SIZE
+
+
+# Multi-pen mode of the scribble effects. The image is split to a grid of
+# overlapping regions and each region is drawn by its own pen in a separate
+# worker process. The regions are chosen so that each one needs about the
+# same amount of drawing, which keeps all the workers busy until the end.
+# Every pen draws its whole region, overlaps included, and the canvases are
+# blended across the overlaps with weights that fall linearly from 1 to 0
+# and add up to 1. Both canvases have the full line density in the overlap,
+# so the blend has the same density as the rest of the image and the seams
+# do not show. The pen draws denser lines next to the edges of its region,
+# so the regions extend one more overlap width beyond the blend, where their
+# weight is 0. (The density of the scribble does not follow the darkness of
+# the working image linearly, so sharing the darkness between the pens
+# would not give even density.)
+# The pens report their progress to the main process and stop when the main
+# process fails or is cancelled. The vector output and checkpoints are not
+# supported, the effects use the single pen for them.
+
+
+# Width of the blend between the regions, relative to the longest side of
+# the image.
+OVERLAP = 0.02
+
+# Minimum overlap in pixels
+MIN_OVERLAP = 16
+
+
+def multi_pen(effect, source_img, pens=None, workers=None, seed=None):
+    # Draw the scribble effect ("scribble" or "color_scribble") with pens
+    # pens, by default one per CPU core, in workers processes (by default
+    # one per pen, at most the number of CPU cores).
+    cores = os.cpu_count() or 1
+    pens = pens or cores
+    workers = workers or min(pens, cores)
+    size_y = source_img.shape[0]
+    size_x = source_img.shape[1]
+
+    regions = pen_regions(drawing_need(effect, source_img), pens, overlap_width(size_y, size_x))
+
+    # The pens draw with the pen geometry of the whole image
+    scale = max(size_x, size_y) / REFERENCE_SIZE
+
+    # The blended canvases are added to the result image
+    img = largeformat.full((size_y, size_x, 3), 0, dtype=np.uint8)
+
+    status_print = ProgressReport(100 * len(regions), '{} with {} pens'.format(effect, len(regions)))
+    with pen_pool(workers) as pool:
+        futures = {}
+        for k, region in enumerate(regions):
+            y1, y2, x1, x2 = region[0:4]
+            region_seed = None if seed is None else seed * len(regions) + k
+            future = pool.submit(k, draw_region, effect, source_img[y1:y2, x1:x2], scale,\
+                region_seed)
+            futures[future] = region
+
+        for future in pool.as_completed(futures, status_print):
+            canvas, counters = future.result()
+            blend(img, canvas, *futures[future])
+            for name, value in counters.items():
+                instrument.count(name, value)
+            largeformat.trim()
+
+    status_print.finished()
+    instrument.count('pens', len(regions))
+    return img
+
+
+def overlap_width(size_y, size_x):
+    # Width of the blend in pixels, even. 
+    return max(int(max(size_x, size_y) * OVERLAP) // 2 * 2, MIN_OVERLAP)
+
+
+def drawing_need(effect, source_img):
+    # Amount of drawing that each pixel needs, like the darkness of the
+    # working image of the effect.
+    if(source_img.ndim == 3):
+        gray = cv2.cvtColor(source_img, cv2.COLOR_RGB2GRAY)
+    else:
+        gray = source_img
+    if(effect == "scribble"):
+        return 255.0 - np.minimum(gray, 250)
+    return 255.0 - np.minimum(255 - gray, 250)
+
+
+def pen_regions(need, pens, overlap):
+    # Split the image to pens regions. The image is first split to rows and
+    # each row to columns so that the drawing need is divided evenly. Returns
+    # list of (y1, y2, x1, x2, row weights, column weights), where the
+    # regions are extended by overlap/2 (the blend) and overlap (the margin)
+    # over the cuts.
+    rows, cols = pen_grid(need.shape[0], need.shape[1], pens)
+    half = overlap // 2
+    regions = []
+    row_cuts = balanced_cuts(need.sum(axis=1), rows)
+    for r in range(rows):
+        cy1, cy2 = row_cuts[r], row_cuts[r + 1]
+        y1, y2, row_weights = region_weights(cy1, cy2, need.shape[0], half, overlap)
+        col_cuts = balanced_cuts(need[cy1:cy2].sum(axis=0), cols)
+        for c in range(cols):
+            x1, x2, col_weights = region_weights(col_cuts[c], col_cuts[c + 1],\
+                need.shape[1], half, overlap)
+            regions.append((y1, y2, x1, x2, row_weights, col_weights))
+    return regions
+
+
+def pen_grid(size_y, size_x, pens):
+    # Rows and columns of the region grid, the regions as square as possible.
+    best = None
+    for rows in range(1, pens + 1):
+        if(pens % rows != 0):
+            continue
+        cols = pens // rows
+        error = abs(math.log((size_y / rows) / (size_x / cols)))
+        if(best is None or error < best[0]):
+            best = (error, rows, cols)
+    return best[1], best[2]
+
+
+def balanced_cuts(need, parts):
+    # Positions that split the profile need into parts with equal sums.
+    # Every part gets at least one pixel.
+    total = np.cumsum(need + 1e-3)
+    targets = total[-1] * np.arange(1, parts) / parts
+    cuts = np.searchsorted(total, targets) + 1
+    cuts = np.minimum(np.maximum(cuts, np.arange(1, parts)),\
+        len(need) - parts + np.arange(1, parts))
+    cuts = np.maximum.accumulate(cuts)
+    return [0] + cuts.tolist() + [len(need)]
+
+
+def region_weights(c1, c2, size, half, margin=0):
+    # Region c1 ... c2 extended by half + margin pixels over the inner cuts,
+    # and the weights of its pixels. The weight rises from 0 to 1 over the
+    # cut at c1 and falls from 1 to 0 over the cut at c2, so that the weights
+    # of the neighbour regions add up to 1. The margin outside the overlap 
+    # gets weight 0. 
+    p1 = max(c1 - half - margin, 0)
+    p2 = min(c2 + half + margin, size)
+    pos = np.arange(p1, p2) + 0.5
+    weights = np.ones(p2 - p1, dtype=np.float32)
+    if(c1 > 0):
+        weights = np.minimum(weights, np.clip((pos - (c1 - half)) / (2 * half), 0, 1))
+    if(c2 < size):
+        weights = np.minimum(weights, np.clip(((c2 + half) - pos) / (2 * half), 0, 1))
+    return p1, p2, weights
+
+
+def blend(img, canvas, y1, y2, x1, x2, row_weights, col_weights):
+    # Add the region canvas to the image area y1 ... y2, x1 ... x2, weighted 
+    # with its row and column weights. The weights of the overlapping regions 
+    # add up to 1, so the image is complete when all the regions are added. 
+    # Saturating addition keeps the rounded halves of white from wrapping. 
+    area = img[y1:y2, x1:x2]
+    rows = largeformat.band_rows(area, row_bytes=area.strides[0] * 8) # float32 temporaries
+    for b1, b2 in largeformat.bands(area, rows):
+        weight = row_weights[b1:b2, np.newaxis, np.newaxis] * col_weights[np.newaxis, :, np.newaxis]
+        part = np.rint(canvas[b1:b2] * weight).astype(np.uint8)
+        cv2.add(area[b1:b2], part, dst=area[b1:b2])
+
+
+class PenStopped(Exception):
+    # Raised in the pen when the main process has stopped the pool.
+    pass
+
+
+class PenPool(object):
+    # Pool of worker processes for the pens. The workers are spawned, so they
+    # do not inherit the big images of the main process. The pens send their 
+    # progress to the main process through a queue, and they stop at their 
+    # next progress update when the stop event is set. The pool sets it if 
+    # the main process fails while the pens are drawing, e.g. when the render 
+    # server cancels the job at a progress report, so that it does not need 
+    # to wait for the pens to finish. 
+
+    def __init__(self, workers):
+        context = multiprocessing.get_context('spawn')
+        self.progress = context.Queue()
+        self.stop = context.Event()
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context,\
+            initializer=init_worker, initargs=(self.progress, self.stop))
+        self.percents = {} # progress of the pens
+
+    def submit(self, pen, function, *args):
+        # Run function(*args) as pen number pen. The future gives the result 
+        # of the function and the instrumentation counters of the pen. 
+        self.percents[pen] = 0
+        return self.executor.submit(run_pen, pen, function, *args)
+
+    def as_completed(self, futures, status_print=None):
+        # Yield the futures as they complete. Meanwhile the sum of the pen 
+        # progress percentages is reported to status_print. 
+        pending = set(futures)
+        while(pending):
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            while(True):
+                try:
+                    pen, percent = self.progress.get_nowait()
+                except queue.Empty:
+                    break
+                self.percents[pen] = percent
+            if(status_print is not None):
+                status_print.update(sum(self.percents.values()))
+            for future in done:
+                yield future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if(exc_type is not None):
+            self.stop.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def pen_pool(workers):
+    return PenPool(workers)
+
+
+# Worker process state
+_progress = None
+_stop = None
+
+
+def init_worker(progress, stop):
+    # The pens report to the main process, not to the console.
+    global _progress, _stop
+    os.environ['MPLBACKEND'] = 'Agg'
+    sys.stdout = open(os.devnull, 'w')
+    _progress = progress
+    _stop = stop
+
+
+def run_pen(pen, function, *args):
+    # Run the pen in the worker process. Returns the result of the function 
+    # and the counters of the pen. 
+    counters = {}
+    def send_event(event):
+        if(event['event'] == 'stage'):
+            counters.update(event['counters'])
+            return
+        _progress.put((pen, event['percent']))
+        if(_stop.is_set()):
+            raise PenStopped()
+    instrument.configure([instrument.CallbackSink(send_event, kinds=('stage', 'progress'))])
+    with instrument.stage('pen'):
+        result = function(*args)
+    return result, counters
+
+
+def draw_region(effect, region_img, scale, seed):
+    # Draw one region with a single pen. Returns the canvas.
+    if(effect == "scribble"):
+        from mono_scribble import mono_scribble as scribble
+    else:
+        from color_scribble import color_scribble as scribble
+    return scribble(region_img, seed=seed, scale=scale)
@@ -0,0 +1,106 @@
+import cv2
+
+import largeformat
+from utils import histogram_equalize
+
+
+# Preprocessing products that the effects need. Each product is defined by
+# its name and the target size (longest side of the image in pixels):
+#   rgb        resized RGB image
+#   gray       grayscale version of rgb
+#   clahe      histogram equalized version of gray
+#   clahe_rgb  clahe converted back to RGB
+# Each product depends on the previous one in this list, so when many effects
+# are run for the same image, the shared products are computed only once.
+EFFECT_INPUTS = {
+    "circles": (("rgb", 3000),),
+    "dots": (("clahe_rgb", 4000),),
+    "scribble": (("clahe", 3000),),
+    "color_scribble": (("rgb", 3000),),
+    "cmy_scribble": (("rgb", 3000),),
+    "rgb_scribble": (("rgb", 3000),),
+    "color_triangles": (("rgb", 4000), ("clahe", 4000)),
+    "triangles": (("rgb", 4000), ("clahe", 4000)),
+}
+
+# Longest side of the images in the preview mode. The effects scale their 
+# drawing parameters to the image size, so the preview looks like scaled 
+# down version of the full size result. 
+PREVIEW_SIZE = 800
+
+# In the large-format mode (see largeformat.py) the products larger than this
+# are computed in bands. The histogram equalization can't be done in bands, 
+# so it is done in this size and the result is scaled up. 
+LARGE_BASE_SIZE = 8000
+
+
+class Preprocessor(object):
+    # Computes the preprocessing products for one source image on demand and
+    # keeps those in memory, so that every product is computed only once.
+    # The effects must not modify the products.
+    # If cache (see cache.py) and the hash of the source image file are given, 
+    # the products are also stored to the cache and loaded from it. 
+
+    def __init__(self, img, cache=None, input_hash=None):
+        self.img = img
+        self.products = {}
+        self.cache = cache if input_hash is not None else None
+        self.input_hash = input_hash
+
+    def get(self, name, size):
+        key = (name, size)
+        if(key not in self.products):
+            self.products[key] = self.cached_compute(name, size)
+        return self.products[key]
+
+    def cached_compute(self, name, size):
+        # The large-format products are not cached. 
+        if(self.cache is None or largeformat.active()):
+            return self.compute(name, size)
+        cache_key = self.cache.key(self.input_hash, 'preprocess', {'name': name, 'size': size},\
+            modules=('pipeline',))
+        product = self.cache.get_array(cache_key)
+        if(product is None):
+            product = self.compute(name, size)
+            self.cache.put_array(cache_key, product)
+        return product
+
+    def compute(self, name, size):
+        if(largeformat.active() and size > LARGE_BASE_SIZE):
+            return self.compute_bands(name, size)
+        if(name == "rgb"):
+            scaling = size / max(self.img.shape[0], self.img.shape[1])
+            return cv2.resize(self.img, (0,0), fx=scaling, fy=scaling)
+        if(name == "gray"):
+            return cv2.cvtColor(self.get("rgb", size), cv2.COLOR_RGB2GRAY)
+        if(name == "clahe"):
+            return histogram_equalize(self.get("gray", size)) # works only on grayscale images
+        if(name == "clahe_rgb"):
+            return cv2.cvtColor(self.get("clahe", size), cv2.COLOR_GRAY2RGB)
+        raise ValueError('Unknown preprocessing product {}'.format(name))
+
+    def compute_bands(self, name, size):
+        # Large-format version of compute. 
+        if(name == "rgb"):
+            return largeformat.resize(self.img, size)
+        if(name == "clahe"):
+            return largeformat.resize(self.get("clahe", LARGE_BASE_SIZE), size)
+        if(name == "gray"):
+            source, code, shape = self.get("rgb", size), cv2.COLOR_RGB2GRAY, None
+        elif(name == "clahe_rgb"):
+            source, code, shape = self.get("clahe", size), cv2.COLOR_GRAY2RGB, (3,)
+        else:
+            raise ValueError('Unknown preprocessing product {}'.format(name))
+        result = largeformat.empty(source.shape[0:2] + (shape or ()))
+        for y1, y2 in largeformat.bands(result):
+            cv2.cvtColor(source[y1:y2], code, dst=result[y1:y2])
+            largeformat.trim(force=True)
+        return result
+
+    def inputs(self, effect, preview=False, size=None):
+        # List of the preprocessed input images for the effect. Preview uses 
+        # smaller images. Size overrides the sizes of the effect. 
+        if(size is not None):
+            return [self.get(name, size) for (name, _) in EFFECT_INPUTS[effect]]
+        return [self.get(name, min(size, PREVIEW_SIZE) if preview else size)\
+            for (name, size) in EFFECT_INPUTS[effect]]
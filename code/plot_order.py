@@ -0,0 +1,254 @@
+import numpy as np
+import math
+import time
+from scipy.spatial import cKDTree
+
+# Maximum number of 2-opt passes over the drawing order. The number of passes
+# and not the time limits the refinement, so the same drawing gives always the
+# same output (and the same cached result).
+MAX_PASSES = 8
+
+
+class PlotOrderer(object):
+    # Collects the drawing primitives that are written to a vector writer and
+    # reorders them to minimize the pen-up travel of the plotter before passing
+    # them to the writer. Polylines are split to line segments and the segments
+    # that are drawn many times (e.g. shared triangle edges) are merged. After
+    # the ordering, the segments that continue each other are joined back to
+    # polylines.
+    # This has the same drawing methods as the vector writers, so it can be
+    # given to the effects instead of the writer.
+    # All the primitives are kept in memory until the writer is closed, so
+    # the output is not streamed to the file while it is drawn. 
+
+    def __init__(self, writer, max_passes=MAX_PASSES):
+        self.writer = writer
+        self.max_passes = max_passes # 2-opt refinement passes
+        self.circles = [] # (x, y, r, color, fill)
+        self.segments = [] # (x1, y1, x2, y2, color)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def polyline(self, points, color=None, colors=None):
+        # Colors of the individual segments are ignored, the plotter uses one
+        # pen for the whole line.
+        points = np.asarray(points, dtype=np.float64)
+        for i in range(len(points) - 1):
+            self.segments.append((points[i, 0], points[i, 1],\
+                points[i + 1, 0], points[i + 1, 1], color))
+
+    def circle(self, x, y, r, color=None, fill=False):
+        self.circles.append((float(x), float(y), float(r), color, fill))
+
+    def close(self):
+        if(self.writer is None):
+            return
+        if(self.circles or self.segments):
+            self.write_ordered()
+        self.writer.close()
+        self.writer = None
+
+    def write_ordered(self):
+        # Travel distance of the primitives in the original order
+        entry, exit, pen_down = self.primitives(self.circles, self.segments)
+        up_before = travel_distance(entry, exit)
+        down_before = np.sum(pen_down)
+
+        # Merge the duplicate segments
+        segments = unique_segments(self.segments)
+        entry, exit, pen_down = self.primitives(self.circles, segments)
+        down_after = np.sum(pen_down)
+
+        # Order the primitives
+        start_time = time.time()
+        order, flipped = greedy_order(entry, exit)
+        greedy_up = travel_distance(entry, exit, order, flipped)
+        order, flipped = two_opt(entry, exit, order, flipped, self.max_passes)
+        up_after = travel_distance(entry, exit, order, flipped)
+
+        print('Plot order optimized in {:.1f} s'.format(time.time() - start_time))
+        print('  segments {} -> {}, circles {}'.format(len(self.segments),\
+            len(segments), len(self.circles)))
+        print('  pen-down distance {:.0f} -> {:.0f}'.format(down_before, down_after))
+        print('  pen-up distance {:.0f} -> {:.0f} (greedy {:.0f})'.format(up_before,\
+            up_after, greedy_up))
+
+        self.report = {'pen_down_before': float(down_before), 'pen_down_after': float(down_after),\
+            'pen_up_before': float(up_before), 'pen_up_after': float(up_after)}
+
+        # Write the primitives in the new order. Continuous segments are
+        # joined to polylines.
+        n_circles = len(self.circles)
+        line = []
+        line_color = None
+        for i, flip in zip(order, flipped):
+            if(i < n_circles):
+                self.write_line(line, line_color)
+                line = []
+                x, y, r, color, fill = self.circles[i]
+                self.writer.circle(x, y, r, color, fill)
+                continue
+
+            x1, y1, x2, y2, color = segments[i - n_circles]
+            if(flip):
+                x1, y1, x2, y2 = x2, y2, x1, y1
+            if(line and (line[-1] != (x1, y1) or color != line_color)):
+                self.write_line(line, line_color)
+                line = []
+            if(not line):
+                line = [(x1, y1)]
+                line_color = color
+            line.append((x2, y2))
+        self.write_line(line, line_color)
+
+    def write_line(self, line, color):
+        if(len(line) > 1):
+            self.writer.polyline(np.array(line), color)
+
+    def primitives(self, circles, segments):
+        # Entry and exit points and pen-down lengths of the circles and segments.
+        # The writers start and end the circles at their rightmost point 
+        # (x + r, y). The inner rings of the filled circles are ignored. 
+        n = len(circles) + len(segments)
+        entry = np.zeros((n, 2))
+        exit = np.zeros((n, 2))
+        pen_down = np.zeros(n)
+        if(circles):
+            c = np.array([p[0:3] for p in circles])
+            entry[:len(circles)] = c[:, 0:2]
+            entry[:len(circles), 0] += c[:, 2]
+            exit[:len(circles)] = entry[:len(circles)]
+            pen_down[:len(circles)] = 2 * math.pi * c[:, 2]
+        if(segments):
+            s = np.array([p[0:4] for p in segments])
+            entry[len(circles):] = s[:, 0:2]
+            exit[len(circles):] = s[:, 2:4]
+            pen_down[len(circles):] = np.hypot(s[:, 2] - s[:, 0], s[:, 3] - s[:, 1])
+        return entry, exit, pen_down
+
+
+def unique_segments(segments):
+    # Remove the segments that are drawn more than once, in either direction.
+    seen = set()
+    result = []
+    for seg in segments:
+        a = (round(seg[0], 3), round(seg[1], 3))
+        b = (round(seg[2], 3), round(seg[3], 3))
+        key = (min(a, b), max(a, b))
+        if(key in seen):
+            continue
+        seen.add(key)
+        result.append(seg)
+    return result
+
+
+def travel_distance(entry, exit, order=None, flipped=None):
+    # Total pen-up travel when the primitives are drawn in the given order,
+    # starting from origin. Flipped primitives are drawn from exit to entry.
+    if(order is None):
+        order = np.arange(len(entry))
+        flipped = np.zeros(len(entry), dtype=bool)
+    starts = np.where(flipped[:, None], exit[order], entry[order])
+    ends = np.where(flipped[:, None], entry[order], exit[order])
+    prev = np.vstack((np.zeros((1, 2)), ends[:-1]))
+    return np.sum(np.hypot(starts[:, 0] - prev[:, 0], starts[:, 1] - prev[:, 1]))
+
+
+def greedy_order(entry, exit):
+    # Greedy nearest neighbour ordering. Starting from origin, the next
+    # primitive is always the one that can be started closest to the current
+    # pen location. Primitives can be drawn in either direction. The k-d tree
+    # is rebuilt from the remaining primitives when most of its points are
+    # already used.
+    n = len(entry)
+    cand_xy = np.vstack((entry, exit))
+    cand_prim = np.concatenate((np.arange(n), np.arange(n)))
+    cand_flip = np.concatenate((np.zeros(n, dtype=bool), np.ones(n, dtype=bool)))
+
+    visited = np.zeros(n, dtype=bool)
+    order = np.zeros(n, dtype=int)
+    flipped = np.zeros(n, dtype=bool)
+    pos = (0.0, 0.0)
+
+    alive = np.arange(len(cand_xy))
+    tree = cKDTree(cand_xy[alive])
+    used = 0 # primitives taken after the tree was built
+    for step in range(n):
+        if(len(alive) > 64 and used * 4 > len(alive)):
+            # Half of the tree points are used, rebuild it from the remaining 
+            # candidates. 
+            alive = alive[~visited[cand_prim[alive]]]
+            tree = cKDTree(cand_xy[alive])
+            used = 0
+        k = 8
+        while(True):
+            k = min(k, len(alive))
+            dist, idx = tree.query(pos, k=k)
+            idx = np.atleast_1d(idx)
+            cand = alive[idx[idx < len(alive)]]
+            free = cand[~visited[cand_prim[cand]]]
+            if(len(free) > 0):
+                break
+            k *= 4
+        c = free[0]
+        p = cand_prim[c]
+        visited[p] = True
+        used += 1
+        order[step] = p
+        flipped[step] = cand_flip[c]
+        pos = tuple(entry[p] if cand_flip[c] else exit[p])
+    return order, flipped
+
+
+def two_opt(entry, exit, order, flipped, max_passes=MAX_PASSES, window=50):
+    # Improve the order with 2-opt moves until max_passes passes are done or 
+    # no improvement is found. A move reverses the drawing order and direction of 
+    # the primitives between positions i and j. Only the moves where j is at 
+    # most window positions after i are studied. 
+    order = order.copy()
+    flipped = flipped.copy()
+    n = len(order)
+    if(n < 3):
+        return order, flipped
+
+    # Start and end points of the primitives in the drawing order
+    starts = np.where(flipped[:, None], exit[order], entry[order])
+    ends = np.where(flipped[:, None], entry[order], exit[order])
+
+    improved = True
+    passes = 0
+    while(improved and passes < max_passes):
+        improved = False
+        passes += 1
+        for i in range(n - 1):
+            # Pen location before position i
+            if(i == 0):
+                prev = np.zeros(2)
+            else:
+                prev = ends[i - 1]
+
+            j = np.arange(i + 1, min(i + window, n))
+            old = np.hypot(*(starts[i] - prev))
+            new = np.hypot(*(ends[j] - prev).T)
+
+            # Travel after position j, zero for the last position
+            nxt = np.minimum(j + 1, n - 1)
+            last = j == n - 1
+            old_after = np.where(last, 0.0, np.hypot(*(starts[nxt] - ends[j]).T))
+            new_after = np.where(last, 0.0, np.hypot(*(starts[nxt] - starts[i]).T))
+
+            gain = old + old_after - new - new_after
+            best = np.argmax(gain)
+            if(gain[best] > 1e-9):
+                j = j[best]
+                order[i:j + 1] = order[i:j + 1][::-1]
+                flipped[i:j + 1] = ~flipped[i:j + 1][::-1]
+                starts[i:j + 1], ends[i:j + 1] = ends[i:j + 1][::-1].copy(),\
+                    starts[i:j + 1][::-1].copy()
+                improved = True
+
+    return order, flipped
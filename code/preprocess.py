@@ -0,0 +1,68 @@
+import numpy as np
+import cv2
+
+
+# Vectorized image preprocessing functions. All these take optional output
+# buffer (out), which can also be the input image itself for in-place
+# processing. The result is returned in every case.
+
+
+def dither(img, amount, out=None, rng=None):
+    # Add dither to image pixels. Some effect algorithms may need this
+    # if the image contains large areas of same color.
+    # The dither is ~zero mean in evenly distributed range +/- amount/2.
+    # Works with both grayscale and color images, every channel gets
+    # its own dither.
+    if(rng is None):
+        rng = np.random.default_rng()
+    if(out is None):
+        out = np.empty_like(img)
+
+    noise = rng.integers(0, amount, size=img.shape).astype(np.float32)
+    noise += img
+    noise -= amount / 2
+    np.trunc(noise, out=noise)
+    np.clip(noise, 0, 255, out=noise)
+    out[...] = noise
+    return out
+
+
+def clamp_invert(img, limit, invert=False, out=None):
+    # Limit the pixel values to max value limit. If invert is True, the
+    # image is inverted (255 - value) before the limiting.
+    if(out is None):
+        out = np.empty_like(img)
+    if(invert):
+        np.subtract(255, img, out=out)
+    elif(out is not img):
+        out[...] = img
+    np.minimum(out, limit, out=out)
+    return out
+
+
+def gaussian_kernel_1d(size, sigma):
+    # One dimensional Gaussian kernel that sums to 1.0. The center point is
+    # at size/2.0, like in the two dimensional kernel of filters.py.
+    x = np.arange(size) - size / 2.0
+    kernel = np.exp(-1.0 * x**2 / (2.0 * sigma * sigma))
+    return kernel / np.sum(kernel)
+
+
+def soften(img, kernel_size=10, sigma=2, out=None):
+    # Gaussian blur. The Gaussian kernel is separable, so the image is
+    # filtered with one dimensional kernels in x- and y-directions.
+    kernel = gaussian_kernel_1d(kernel_size, sigma)
+    return cv2.sepFilter2D(img, -1, kernel, kernel, dst=out)
+
+
+SHARPEN_KERNEL = np.array([\
+    [-1, -1, -1, -1, -1],\
+    [-1,  2,  2,  2, -1],\
+    [-1,  2,  8,  2, -1],\
+    [-1,  2,  2,  2, -1],\
+    [-1, -1, -1, -1, -1]]) / 8.0
+
+
+def sharpen(img, out=None):
+    # Sharpening filter. Kernel elements sum to 1.0.
+    return cv2.filter2D(img, -1, SHARPEN_KERNEL, dst=out)
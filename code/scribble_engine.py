@@ -0,0 +1,296 @@
+import numpy as np
+import math
+import cv2
+import heapq
+
+
+class DirectionSearch(object):
+    # Searches the darkest pixel around the pen location for the scribble effects.
+    # The pixels are picked from a ring of angles around the current location.
+    # The ring offsets for each search distance and the angle steps for each
+    # (range, step) pair are computed only once and stored as NumPy arrays, so
+    # that one search step needs only one fancy-indexing call to the image.
+
+    def __init__(self, pic):
+        self.pic = pic
+        self.size_x = pic.shape[1]
+        self.size_y = pic.shape[0]
+
+        # Sin and cos tables with one degree resolution.
+        self.sin360 = np.array([math.sin((a/180) * math.pi) for a in range(360)])
+        self.cos360 = np.array([math.cos((a/180) * math.pi) for a in range(360)])
+
+        self.rings = {}
+        self.spans = {}
+
+    def ring(self, search_dist):
+        # Returns x and y offsets for all 360 angles at distance search_dist.
+        ring = self.rings.get(search_dist)
+        if(ring is None):
+            ring = (self.cos360 * search_dist, self.sin360 * search_dist)
+            self.rings[search_dist] = ring
+        return ring
+
+    def span(self, range_max, rotat_step):
+        # Returns the scanned angles relative to the start of the search range.
+        span = self.spans.get((range_max, rotat_step))
+        if(span is None):
+            span = np.arange(0, range_max, rotat_step)
+            self.spans[(range_max, rotat_step)] = span
+        return span
+
+    def scan(self, cur_x, cur_y, old_angle, search_dist, range_max, rotat_step):
+        # Scans the angles old_angle +/- range_max/2 with rotat_step degree steps
+        # at distance search_dist from the location cur_x, cur_y.
+        # Returns the darkest pixel value, its angle and its x and y coordinates.
+        # Pixels outside the image (and on the first row and column) count as
+        # white (255). If there are many equally dark pixels, the last one in the
+        # scanning order is selected.
+
+        ring_x, ring_y = self.ring(search_dist)
+        angles = ((old_angle + self.span(range_max, rotat_step)) - range_max/2).astype(int)
+        index = angles % 360
+        tx = (cur_x + ring_x[index]).astype(int)
+        ty = (cur_y + ring_y[index]).astype(int)
+
+        # Pick the pixel colors from the image
+        valid = (0 < tx) & (tx < self.size_x) & (0 < ty) & (ty < self.size_y)
+        pix = np.full(len(tx), 255, dtype=self.pic.dtype)
+        pix[valid] = self.pic[ty[valid], tx[valid]]
+
+        # Select the darkest pixel, the last one in case of ties.
+        k = len(pix) - 1 - np.argmin(pix[::-1])
+        return int(pix[k]), int(angles[k]), int(tx[k]), int(ty[k])
+
+
+class PathBuffer(object):
+    # Stores the pen trajectory to a preallocated float32 point array and draws 
+    # it to the canvas in large batches with cv2.polylines instead of drawing 
+    # every line segment separately. The points are continuous, i.e. each 
+    # batch starts from the last point of the previous one. 
+    # If color_source image is given, each line segment gets the color of the 
+    # source image pixel at its end point instead of the fixed color. 
+    # Functions in the consumers list are called with every flushed batch of 
+    # points (and colors), so the same path can be used for other outputs too. 
+    # Canvas can be None if only the consumers are needed. 
+
+    def __init__(self, canvas, color=(0, 0, 0), color_source=None, capacity=65536):
+        self.canvas = canvas
+        self.color = color
+        self.color_source = color_source
+        self.points = np.zeros((capacity, 2), dtype=np.float32)
+        self.count = 0
+        self.consumers = []
+
+        # Color that is used for the segments that end outside the source image 
+        # until some color can be picked. 
+        if(color_source is not None):
+            self.last_color = np.zeros(color_source.shape[2:], dtype=color_source.dtype)
+
+    def add(self, x, y):
+        # Add new point to the path. 
+        if(self.count == len(self.points)):
+            self.flush()
+        self.points[self.count] = (x, y)
+        self.count += 1
+
+    def flush(self):
+        # Draw the buffered path and start new batch from its last point.
+        if(self.count > 1):
+            points = self.points[:self.count]
+            if(self.color_source is None):
+                if(self.canvas is not None):
+                    cv2.polylines(self.canvas, [points.astype(np.int32)], False,\
+                        self.color, 1, lineType=cv2.LINE_AA)
+                for consumer in self.consumers:
+                    consumer(points)
+            else:
+                colors = self.pick_colors(points)
+                if(self.canvas is not None):
+                    draw_colored_segments(self.canvas, points, colors)
+                for consumer in self.consumers:
+                    consumer(points, colors)
+
+        if(self.count > 0):
+            self.points[0] = self.points[self.count - 1]
+            self.count = 1
+
+    def state(self):
+        # The buffered points and color, for checkpoints.
+        state = {'points': self.points[:self.count].copy()}
+        if(self.color_source is not None):
+            state['last_color'] = self.last_color.copy()
+        return state
+
+    def restore(self, state):
+        self.count = len(state['points'])
+        self.points[:self.count] = state['points']
+        if(self.color_source is not None):
+            self.last_color = state['last_color'].copy()
+
+    def pick_colors(self, points):
+        # Pick the colors of the points from the color source image. The points
+        # outside the image get the previous picked color. 
+        size_y = self.color_source.shape[0]
+        size_x = self.color_source.shape[1]
+        x = points[:, 0]
+        y = points[:, 1]
+        valid = (0 <= x) & (x < size_x) & (0 <= y) & (y < size_y)
+        index = np.where(valid, np.arange(len(points)), -1)
+        index = np.maximum.accumulate(index)
+
+        colors = np.empty((len(points),) + self.last_color.shape, dtype=self.last_color.dtype)
+        colors[:] = self.last_color
+        picked = index >= 0
+        colors[picked] = self.color_source[y[index[picked]].astype(int),\
+            x[index[picked]].astype(int)]
+        self.last_color = colors[-1].copy()
+        return colors
+
+
+def draw_colored_segments(canvas, points, colors):
+    # Draws the line segments between consecutive points so that each segment
+    # gets the color of its end point. Segments with the same color are drawn 
+    # with one cv2.polylines call. 
+    ipoints = points.astype(np.int32)
+    segments = np.stack((ipoints[1:], ipoints[:-1]), axis=1)
+    seg_colors = colors[1:]
+
+    # Group the segments by color
+    keys = seg_colors.astype(np.int64) @ (256 ** np.arange(seg_colors.shape[1]))
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)]
+
+    for start, end in zip(starts, ends):
+        group = order[start:end]
+        cv2.polylines(canvas, segments[group], False,\
+            seg_colors[group[0]].tolist(), 1, lineType=cv2.LINE_AA)
+
+
+class DarkPyramid(object):
+    # Min-pyramid over the working image of the scribble effects. The first level 
+    # holds the minimum value of each block x block pixel area and every next 
+    # level the minimum of 2x2 cells of the previous level, up to one root cell. 
+    # The image areas that are cleared during the drawing are marked dirty and 
+    # the pyramid is updated incrementally before it is used. 
+    # This is used to find the closest area that still needs drawing when there 
+    # is nothing left around the pen, and to check whether everything is drawn.
+
+    def __init__(self, pic, block=16, limit=255):
+        self.pic = pic
+        self.block = block
+        self.limit = limit # pixels below this value still need drawing
+        self.size_x = pic.shape[1]
+        self.size_y = pic.shape[0]
+        self.build()
+
+    def build(self):
+        # Compute the whole pyramid from the image. 
+        # The first level is computed in strips of 64 block rows, so that the
+        # padded copy of the image stays small with large images.
+        b = self.block
+        rows = -(-self.size_y // b)
+        cols = -(-self.size_x // b)
+        level = np.empty((rows, cols), dtype=self.pic.dtype)
+        for r1 in range(0, rows, 64):
+            r2 = min(r1 + 64, rows)
+            part = self.pic[r1*b:r2*b]
+            padded = np.full(((r2 - r1) * b, cols * b), 255, dtype=self.pic.dtype)
+            padded[:part.shape[0], :self.size_x] = part
+            level[r1:r2] = padded.reshape(r2 - r1, b, cols, b).min(axis=(1, 3))
+        self.levels = [level]
+
+        while(level.shape[0] > 1 or level.shape[1] > 1):
+            rows = -(-level.shape[0] // 2)
+            cols = -(-level.shape[1] // 2)
+            padded = np.full((rows * 2, cols * 2), 255, dtype=level.dtype)
+            padded[:level.shape[0], :level.shape[1]] = level
+            level = padded.reshape(rows, 2, cols, 2).min(axis=(1, 3))
+            self.levels.append(level)
+        self.dirty = np.zeros(self.levels[0].shape, dtype=bool)
+        self.changed = False
+
+    def mark(self, x, y, r):
+        # Mark the image area within radius r from location x, y changed.
+        b = self.block
+        x1 = max(int(x - r), 0) // b
+        x2 = min(int(x + r), self.size_x - 1) // b
+        y1 = max(int(y - r), 0) // b
+        y2 = min(int(y + r), self.size_y - 1) // b
+        self.dirty[y1:y2+1, x1:x2+1] = True
+        self.changed = True
+
+    def refresh(self):
+        # Update the pyramid cells above the dirty image blocks. 
+        if(not self.changed):
+            return
+        dirty_y, dirty_x = np.nonzero(self.dirty)
+        if(len(dirty_y) > self.dirty.size / 8):
+            # Many changes, faster to compute everything again.
+            self.build()
+            return
+
+        b = self.block
+        level = self.levels[0]
+        cells = list(zip(dirty_y.tolist(), dirty_x.tolist()))
+        for (by, bx) in cells:
+            level[by, bx] = self.pic[by*b:(by+1)*b, bx*b:(bx+1)*b].min()
+
+        for k in range(1, len(self.levels)):
+            lower = self.levels[k - 1]
+            level = self.levels[k]
+            cells = set((cy // 2, cx // 2) for (cy, cx) in cells)
+            for (cy, cx) in cells:
+                level[cy, cx] = lower[2*cy:2*cy+2, 2*cx:2*cx+2].min()
+        self.dirty[:] = False
+        self.changed = False
+
+    def root(self):
+        # Darkest value in the whole image.
+        self.refresh()
+        return int(self.levels[-1][0, 0])
+
+    def nearest(self, x, y):
+        # Returns the coordinates of the pixel closest to location x, y that still 
+        # needs drawing, or None if there is no such pixel. Best-first search 
+        # from the root, the cells are visited in the order of their smallest 
+        # possible distance to x, y.
+        if(self.root() >= self.limit):
+            return None
+        top = len(self.levels) - 1
+        heap = [(0.0, top, 0, 0)]
+
+        while(heap):
+            dist, k, cy, cx = heapq.heappop(heap)
+            if(k < 0):
+                # Exact pixel location, nothing can be closer than this. 
+                return cx, cy
+
+            if(k == 0):
+                # Find the closest pixel inside the image block. 
+                b = self.block
+                area = self.pic[cy*b:(cy+1)*b, cx*b:(cx+1)*b]
+                ys, xs = np.nonzero(area < self.limit)
+                ys = ys + cy * b
+                xs = xs + cx * b
+                d2 = (xs - x)**2 + (ys - y)**2
+                i = np.argmin(d2)
+                heapq.heappush(heap, (float(d2[i]), -1, int(ys[i]), int(xs[i])))
+                continue
+
+            # Add the child cells that contain pixels to be drawn. 
+            lower = self.levels[k - 1]
+            cell = self.block << (k - 1) # child cell size in pixels
+            for ny in (2*cy, 2*cy + 1):
+                for nx in (2*cx, 2*cx + 1):
+                    if(ny >= lower.shape[0] or nx >= lower.shape[1]):
+                        continue
+                    if(lower[ny, nx] >= self.limit):
+                        continue
+                    dx = max(nx * cell - x, 0, x - ((nx + 1) * cell - 1))
+                    dy = max(ny * cell - y, 0, y - ((ny + 1) * cell - 1))
+                    heapq.heappush(heap, (dx*dx + dy*dy, k - 1, ny, nx))
+
+        return None
@@ -0,0 +1,94 @@
+import numpy as np
+import os
+import instrument
+import largeformat
+from multi_pen import pen_pool
+from utils import ProgressReport
+
+
+# Colour-separation scribble. Each ink channel is drawn with its own
+# mono_scribble pen from the matching channel of the source image, all the
+# channels in parallel worker processes. This is how the drawing is plotted
+# with one pen per color, and unlike color_scribble, no color is picked for
+# the line segments.
+#   cmy   cyan, magenta and yellow lines on white. The ink of each channel
+#         absorbs one of the red, green and blue, so the multiplied layers are
+#         just the pen canvases of the channels stacked as the R, G and B.
+#   rgb   red, green and blue lines on black. The pens draw the inverted
+#         channels and the added light layers are the inverted canvases.
+
+
+SEPARATIONS = {
+    'cmy': {'inks': ((0, 255, 255), (255, 0, 255), (255, 255, 0)), 'invert': False},
+    'rgb': {'inks': ((255, 0, 0), (0, 255, 0), (0, 0, 255)), 'invert': True},
+}
+
+
+def separation_scribble(source_img, separation='cmy', vector_out=None, seed=None, workers=None):
+    # Draw the RGB source image with one pen per channel of the separation
+    # ('cmy' or 'rgb'). If vector_out writer is given, the lines of the pens
+    # are written to it one color after another and None is returned.
+    inks = SEPARATIONS[separation]['inks']
+    invert = SEPARATIONS[separation]['invert']
+    workers = workers or min(len(inks), os.cpu_count() or 1)
+    size_y = source_img.shape[0]
+    size_x = source_img.shape[1]
+
+    if(vector_out is None):
+        img = largeformat.empty((size_y, size_x, 3), dtype=np.uint8)
+    else:
+        img = None
+
+    status_print = ProgressReport(100 * len(inks), '{} separation scribble'.format(separation))
+    with pen_pool(workers) as pool:
+        futures = []
+        for k in range(len(inks)):
+            channel_seed = None if seed is None else seed * len(inks) + k
+            futures.append(pool.submit(k, draw_channel, np.ascontiguousarray(source_img[:, :, k]),\
+                invert, channel_seed, vector_out is not None))
+
+        # The progress is reported until all the pens are ready. The layers 
+        # are collected in the channel order, so that the vector output has 
+        # the lines of each pen together.
+        for future in pool.as_completed(futures, status_print):
+            pass
+        for k, future in enumerate(futures):
+            layer, counters = future.result()
+            if(vector_out is None):
+                if(invert):
+                    np.subtract(255, layer, out=img[:, :, k])
+                else:
+                    img[:, :, k] = layer
+            else:
+                for points in layer:
+                    vector_out.polyline(points, inks[k])
+            for name, value in counters.items():
+                instrument.count(name, value)
+            largeformat.trim()
+
+    status_print.finished()
+    return img
+
+
+class PathRecorder(object):
+    # Stands for the vector writer in the worker process and keeps the
+    # polylines, which are written to the real writer by the main process.
+
+    def __init__(self):
+        self.paths = []
+
+    def polyline(self, points, color=None, colors=None):
+        self.paths.append(np.array(points, dtype=np.float32))
+
+
+def draw_channel(channel_img, invert, seed, vector):
+    # Draw one channel with mono_scribble in the pen worker (see multi_pen.py). 
+    # Returns the grayscale canvas, or the polylines if vector is True.
+    from mono_scribble import mono_scribble
+    if(invert):
+        channel_img = 255 - channel_img
+    if(vector):
+        recorder = PathRecorder()
+        mono_scribble(channel_img, recorder, seed=seed)
+        return recorder.paths
+    return mono_scribble(channel_img, seed=seed)[:, :, 0]
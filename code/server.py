@@ -0,0 +1,574 @@
+# Standard modules
+import sys
+import os
+import os.path
+import io
+import json
+import time
+import base64
+import heapq
+import socket
+import tempfile
+import threading
+import itertools
+import contextlib
+import http.client
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+# Resident render server. The jobs are sent to the server over local HTTP
+# (TCP or Unix socket) and run in a pool of worker processes that have the
+# effect modules, NumPy, OpenCV and SciPy already imported, so a job does not
+# pay the start up time of a new interpreter.
+#
+# HTTP interface, all messages are JSON:
+#   POST   /jobs              submit job, returns {"id": ...}
+#   GET    /jobs              list of the jobs
+#   GET    /jobs/ID           job status
+#   GET    /jobs/ID/events    progress events of the job as JSON lines, the
+#                             response is streamed until the job is finished
+#   GET    /jobs/ID/result    result file of the finished job
+#   DELETE /jobs/ID           cancel the job
+#
+# The job is {"input": base64 image file, "effect": name, "seed": N,
+# "priority": N, "format": "png",
+# "params": {"preview": false, "size": N, "pens": N, "optimize_plot": false}}.
+# The jobs with higher priority are run first, jobs with the same priority in
+# the order of arrival. A running job is cancelled at its next progress
+# event.
+
+DEFAULT_PORT = 8765
+
+RASTER_FORMATS = ('png', 'jpg', 'jpeg', 'bmp', 'tif', 'tiff', 'webp')
+VECTOR_FORMATS = ('svg', 'hpgl', 'plt', 'gcode', 'nc')
+
+# Finished jobs are kept for the status and result requests until there are
+# more than this many of them.
+MAX_FINISHED_JOBS = 1000
+
+
+def main(argv):
+
+    # Parse the command line arguments
+    args = [a for a in argv if not a.startswith('--')]
+    options = dict((a[2:].split('=', 1) + [''])[:2] for a in argv if a.startswith('--'))
+    if(args or 'help' in options):
+        print_help()
+        sys.exit()
+    workers = int(options.get('workers') or os.cpu_count() or 1)
+    host = options.get('host') or '127.0.0.1'
+    port = int(options.get('port') or DEFAULT_PORT)
+    unix_socket = options.get('socket') or None
+
+    server = RenderServer(workers)
+    httpd = server.listen(host, port, unix_socket)
+    print('Render server with {} workers listening on {}'.format(workers,\
+        unix_socket or '{}:{}'.format(host, port)))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.shutdown()
+        if(unix_socket is not None and os.path.exists(unix_socket)):
+            os.remove(unix_socket)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+    # One render job and its state: queued, running, done, error or cancelled.
+
+    def __init__(self, job_id, request, priority, sequence):
+        self.id = job_id
+        self.request = request
+        self.priority = priority
+        self.sequence = sequence
+        self.state = 'queued'
+        self.error = None
+        self.result = None
+        self.events = []
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def finished_state(self):
+        return self.state in ('done', 'error', 'cancelled')
+
+    def summary(self):
+        return {'id': self.id, 'state': self.state, 'effect': self.request['effect'],\
+            'priority': self.priority, 'error': self.error,\
+            'queued_seconds': round((self.started or time.time()) - self.submitted, 4),\
+            'run_seconds': round((self.finished or time.time()) - self.started, 4)\
+                if self.started else None,\
+            'progress': self.events[-1].get('percent') if self.events else None}
+
+
+class RenderServer(object):
+    # Job queue and worker pool. Dispatcher threads take the jobs from the
+    # priority queue and run them in the worker processes, one job per worker
+    # at a time. The workers send their progress events through a queue that
+    # is read by the collector thread.
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Condition()
+        self.jobs = {}
+        self.queue = [] # heap of (-priority, sequence, job id)
+        self.counter = itertools.count()
+        self.closing = False
+
+        context = multiprocessing.get_context('spawn')
+        self.manager = context.Manager()
+        self.cancelled = self.manager.dict()
+        self.event_queue = context.Queue()
+        self.context = context
+        self.pool = self.new_pool()
+
+        self.threads = [threading.Thread(target=self.collect_events, daemon=True)]
+        self.threads += [threading.Thread(target=self.dispatch, daemon=True)\
+            for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def new_pool(self):
+        # Start the worker processes and wait until they have imported the
+        # modules.
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.context,\
+            initializer=init_worker, initargs=(self.event_queue, self.cancelled))
+        for future in [pool.submit(warm_up) for i in range(self.workers)]:
+            future.result()
+        return pool
+
+    def submit(self, request):
+        # Add job to the queue. Returns the job.
+        check_request(request)
+        with self.lock:
+            sequence = next(self.counter)
+            job = Job('{:06d}'.format(sequence), request, int(request.get('priority') or 0),\
+                sequence)
+            self.jobs[job.id] = job
+            heapq.heappush(self.queue, (-job.priority, job.sequence, job.id))
+            self.lock.notify_all()
+        return job
+
+    def cancel(self, job_id):
+        # Cancel queued or running job. Returns False if there is no such job.
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if(job is None):
+                return False
+            if(job.state == 'queued'):
+                self.finish(job, 'cancelled')
+            elif(job.state == 'running'):
+                self.cancelled[job_id] = True
+            return True
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return [job.summary() for job in self.jobs.values()]
+
+    def dispatch(self):
+        # Dispatcher thread: run the jobs from the queue one at a time.
+        while(True):
+            with self.lock:
+                while(not self.queue and not self.closing):
+                    self.lock.wait()
+                if(self.closing):
+                    return
+                job = self.jobs.get(heapq.heappop(self.queue)[2])
+                if(job is None or job.state != 'queued'):
+                    continue
+                job.state = 'running'
+                job.started = time.time()
+                pool = self.pool
+
+            try:
+                result = pool.submit(render_job, job.id, job.request).result()
+            except BrokenProcessPool:
+                result = {'state': 'error', 'error': 'worker process died'}
+                with self.lock:
+                    if(self.pool is pool):
+                        self.pool = self.new_pool()
+            except Exception as e:
+                result = {'state': 'error', 'error': repr(e)}
+
+            with self.lock:
+                job.result = result.get('data')
+                self.finish(job, result['state'], result.get('error'))
+
+    def finish(self, job, state, error=None):
+        # Called with the lock held.
+        job.state = state
+        job.error = error
+        job.finished = time.time()
+        job.events.append({'event': 'finished', 'name': job.id, 'state': state,\
+            'error': error, 'time': job.finished})
+        self.cancelled.pop(job.id, None)
+        self.forget_old_jobs()
+        self.lock.notify_all()
+
+    def forget_old_jobs(self):
+        finished = [job for job in self.jobs.values() if job.finished_state()]
+        for job in sorted(finished, key=lambda j: j.finished)[:-MAX_FINISHED_JOBS]:
+            del self.jobs[job.id]
+
+    def collect_events(self):
+        # Collector thread: add the progress events of the workers to the jobs.
+        while(True):
+            item = self.event_queue.get()
+            if(item is None):
+                return
+            job_id, event = item
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if(job is not None and not job.finished_state()):
+                    job.events.append(event)
+                    self.lock.notify_all()
+
+    def wait_events(self, job, first, timeout=None):
+        # Wait for the events of the job after index first. Returns the new
+        # events and whether the job is finished.
+        with self.lock:
+            if(len(job.events) <= first and not job.finished_state()):
+                self.lock.wait(timeout)
+            return job.events[first:], job.finished_state()
+
+    def wait(self, job, timeout=None):
+        # Wait until the job is finished.
+        end = time.time() + timeout if timeout is not None else None
+        with self.lock:
+            while(not job.finished_state()):
+                remaining = end - time.time() if end is not None else None
+                if(remaining is not None and remaining <= 0):
+                    break
+                self.lock.wait(remaining)
+            return job.finished_state()
+
+    def listen(self, host='127.0.0.1', port=DEFAULT_PORT, unix_socket=None):
+        # HTTP server for this render server. Serve it with serve_forever().
+        if(unix_socket is not None):
+            if(os.path.exists(unix_socket)):
+                os.remove(unix_socket)
+            httpd = UnixHTTPServer(unix_socket, RequestHandler)
+        else:
+            httpd = ThreadingHTTPServer((host, port), RequestHandler)
+        httpd.daemon_threads = True
+        httpd.render_server = self
+        return httpd
+
+    def shutdown(self):
+        with self.lock:
+            self.closing = True
+            for job in self.jobs.values():
+                if(job.state == 'running'):
+                    self.cancelled[job.id] = True
+            self.lock.notify_all()
+        self.pool.shutdown(wait=True)
+        self.event_queue.put(None)
+        self.manager.shutdown()
+
+
+def check_request(request):
+    # Raise ValueError if the job request is not valid.
+    import effects
+    if(not isinstance(request, dict)):
+        raise ValueError('Job request must be a JSON object')
+    if(not isinstance(request.get('params') or {}, dict)):
+        raise ValueError('Job params must be a JSON object')
+    if(request.get('effect') not in effects.names()):
+        raise ValueError('Unknown effect {}'.format(request.get('effect')))
+    if(not request.get('input')):
+        raise ValueError('Missing input image')
+    if(request.get('format', 'png') not in RASTER_FORMATS + VECTOR_FORMATS):
+        raise ValueError('Unknown format {}'.format(request.get('format')))
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        self.socket.bind(self.server_address)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if(self.path.rstrip('/') != '/jobs'):
+            return self.send_json(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length))
+            job = self.server.render_server.submit(request)
+        except (ValueError, TypeError, AttributeError) as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(201, job.summary())
+
+    def do_GET(self):
+        parts = [p for p in self.path.split('/') if p]
+        render_server = self.server.render_server
+        if(parts == ['jobs']):
+            return self.send_json(200, render_server.list())
+        if(len(parts) < 2 or parts[0] != 'jobs'):
+            return self.send_json(404, {'error': 'not found'})
+        job = render_server.get(parts[1])
+        if(job is None):
+            return self.send_json(404, {'error': 'unknown job'})
+        if(len(parts) == 2):
+            return self.send_json(200, job.summary())
+        if(parts[2] == 'result'):
+            if(job.state != 'done'):
+                return self.send_json(409, job.summary())
+            return self.send_data(200, job.result, 'application/octet-stream')
+        if(parts[2] == 'events'):
+            return self.stream_events(job)
+        self.send_json(404, {'error': 'not found'})
+
+    def do_DELETE(self):
+        parts = [p for p in self.path.split('/') if p]
+        if(len(parts) != 2 or parts[0] != 'jobs'):
+            return self.send_json(404, {'error': 'not found'})
+        if(not self.server.render_server.cancel(parts[1])):
+            return self.send_json(404, {'error': 'unknown job'})
+        self.send_json(200, self.server.render_server.get(parts[1]).summary())
+
+    def stream_events(self, job):
+        # Send the events as JSON lines with chunked transfer encoding until
+        # the job is finished.
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        sent = 0
+        finished = False
+        while(not finished):
+            events, finished = self.server.render_server.wait_events(job, sent, timeout=1.0)
+            sent += len(events)
+            if(events):
+                data = ''.join(json.dumps(e) + '\n' for e in events).encode('utf-8')
+                self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+                self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_json(self, status, data):
+        self.send_data(status, json.dumps(data).encode('utf-8'), 'application/json')
+
+    def send_data(self, status, data, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# Worker process state
+_event_queue = None
+_cancelled = None
+_current_job = None
+
+
+def init_worker(event_queue, cancelled):
+    # Worker processes never open a display. The progress events of the jobs
+    # are sent to the server, which also checks the cancellation.
+    global _event_queue, _cancelled
+    os.environ['MPLBACKEND'] = 'Agg'
+    _event_queue = event_queue
+    _cancelled = cancelled
+    import instrument
+    instrument.configure([instrument.CallbackSink(send_event, kinds=('progress', 'stage'))])
+
+
+def warm_up():
+    # Import the modules that the jobs need.
+    import numpy
+    import cv2
+    import effects
+    import artbot
+    import pipeline
+    effects.preload()
+    return os.getpid()
+
+
+def send_event(event):
+    if(_current_job is None):
+        return
+    _event_queue.put((_current_job, event))
+    if(event['event'] == 'progress' and _cancelled.get(_current_job)):
+        raise JobCancelled()
+
+
+def render_job(job_id, request):
+    # Run one job in the worker process. Returns dictionary with the state
+    # of the job and the result file content (data) or error message.
+    global _current_job
+    import instrument
+
+    _current_job = job_id
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), instrument.stage(request['effect']):
+            return {'state': 'done', 'data': render(request)}
+    except JobCancelled:
+        return {'state': 'cancelled'}
+    except Exception as e:
+        return {'state': 'error', 'error': repr(e)}
+    finally:
+        _current_job = None
+
+
+def render(request):
+    # Render the job request, returns the result file content.
+    import numpy as np
+    import cv2
+    from pipeline import Preprocessor
+    from vector_output import open_vector_writer
+    import artbot
+
+    data = np.frombuffer(base64.b64decode(request['input']), dtype=np.uint8)
+    img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if(img is None):
+        raise ValueError('Could not decode the input image')
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    effect = request['effect']
+    params = request.get('params') or {}
+    seed = request.get('seed')
+    out_format = request.get('format') or 'png'
+    inputs = Preprocessor(img).inputs(effect, params.get('preview', False), params.get('size'))
+
+    if(out_format in VECTOR_FORMATS):
+        # The vector writers write to a file
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'result.' + out_format)
+            size_y, size_x = inputs[0].shape[0:2]
+            writer = open_vector_writer(filename, size_x, size_y)
+            if(params.get('optimize_plot') and effect not in artbot.LINE_EFFECTS):
+                from plot_order import PlotOrderer
+                writer = PlotOrderer(writer)
+            with writer:
+                artbot.run_effect(inputs, effect, writer, seed)
+            with open(filename, 'rb') as f:
+                return f.read()
+
+    result = artbot.run_effect(inputs, effect, seed=seed, pens=params.get('pens', 1))
+    ok, encoded = cv2.imencode('.' + out_format, cv2.cvtColor(result, cv2.COLOR_RGB2BGR))
+    if(not ok):
+        raise ValueError('Could not encode the result as {}'.format(out_format))
+    return encoded.tobytes()
+
+
+class RenderClient(object):
+    # Client for the render server.
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, unix_socket=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.timeout = timeout
+
+    def connect(self):
+        if(self.unix_socket is not None):
+            return UnixHTTPConnection(self.unix_socket, self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, data=None):
+        connection = self.connect()
+        try:
+            body = json.dumps(data) if data is not None else None
+            connection.request(method, path, body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            content = response.read()
+        finally:
+            connection.close()
+        if(response.getheader('Content-Type') == 'application/json'):
+            content = json.loads(content)
+        if(response.status >= 400):
+            raise RuntimeError('{} {}: {}'.format(method, path, content))
+        return content
+
+    def submit(self, image_data, effect, seed=None, priority=0, out_format='png', params=None):
+        # Submit the image file content for rendering, returns the job id.
+        job = {'input': base64.b64encode(image_data).decode('ascii'), 'effect': effect,\
+            'seed': seed, 'priority': priority, 'format': out_format, 'params': params or {}}
+        return self.request('POST', '/jobs', job)['id']
+
+    def status(self, job_id):
+        return self.request('GET', '/jobs/{}'.format(job_id))
+
+    def cancel(self, job_id):
+        return self.request('DELETE', '/jobs/{}'.format(job_id))
+
+    def result(self, job_id):
+        return self.request('GET', '/jobs/{}/result'.format(job_id))
+
+    def events(self, job_id):
+        # Yields the events of the job until it is finished.
+        connection = self.connect()
+        try:
+            connection.request('GET', '/jobs/{}/events'.format(job_id))
+            response = connection.getresponse()
+            for line in response:
+                yield json.loads(line)
+        finally:
+            connection.close()
+
+    def wait(self, job_id):
+        # Wait until the job is finished, returns the final status.
+        for event in self.events(job_id):
+            pass
+        return self.status(job_id)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if(self.timeout is not None):
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def print_help():
+
+    docstring = """
+Start the render server using command:
+python3 server.py [--workers=N] [--host=127.0.0.1] [--port=8765] [--socket=path]
+
+where:
+    --workers is the number of worker processes, by default the number of
+        CPU cores. Each worker runs one job at a time.
+    --host and --port are the TCP address of the server.
+    --socket is Unix socket path to listen instead of TCP.
+
+Jobs are sent as JSON to POST /jobs, see server.py for the interface. The
+RenderClient class of server.py can be used as a client.
+    """
+    print(docstring)
+
+
+if(__name__ == "__main__"):
+    main(sys.argv[1:])
@@ -2,12 +2,18 @@
 import numpy as np
 import cv2
 from scipy.spatial import Delaunay
-from random import randrange
 
+import instrument
+import largeformat
 from utils import histogram_equalize, ProgressReport
 
 
-def render_triangles(points, canvas, ref_img, BW):
+# Image size (longest side) that the drawing parameters are tuned for. 
+REFERENCE_SIZE = 4000
+
+def render_triangles(points, canvas, ref_img, BW, vector_out=None):
+    # If vector_out writer is given, the triangle outlines are written to it
+    # instead of drawing them to the canvas and None is returned. 
 
     # Define color for triangle outlines.     
     if BW: 
@@ -15,131 +21,202 @@ def render_triangles(points, canvas, ref_img, BW):
     else:
         linecolor = (0, 0, 0)
 
-    x_max = canvas.shape[1]
-    y_max = canvas.shape[0]
+    x_max = ref_img.shape[1]
+    y_max = ref_img.shape[0]
 
     # Calculate the triangles from the point cloud using Delaunay algorithm. 
     point_list = np.array(points)
-    tri = Delaunay(point_list)
-    tri = tri.simplices.copy()
-
-    # Draw the filled triangles
-    status_print = ProgressReport(len(tri), 'triangle fill rendering')
-    i = 0
-    for triangle in tri: 
-
-        p0 = (point_list[triangle[0], 0], point_list[triangle[0], 1])
-        p1 = (point_list[triangle[1], 0], point_list[triangle[1], 1])
-        p2 = (point_list[triangle[2], 0], point_list[triangle[2], 1])
-        cp = [int((p0[0] + p1[0] + p2[0]) / 3), int((p0[1] + p1[1] + p2[1]) / 3)]
-        
-        if BW:
-            color = int(ref_img[cp[1], cp[0]])
-        else:
-            color = (int(ref_img[cp[1], cp[0], 0]),\
-                     int(ref_img[cp[1], cp[0], 1]),\
-                     int(ref_img[cp[1], cp[0], 2]))
-
-        cv2.fillConvexPoly(canvas, np.array([p0, p1, p2]), color=color)
-        
-        if i%1000 == 0:
-            status_print.update(i)
-        i += 1
-    status_print.finished()
-
-    # Draw the triangle outlines. This is done separately 
-    # in order to avoid the fill painting over outlines. 
-    status_print = ProgressReport(len(tri), 'triangle outline rendering')
-    i = 0
-    for triangle in tri: 
-
-        p0 = (point_list[triangle[0], 0], point_list[triangle[0], 1])
-        p1 = (point_list[triangle[1], 0], point_list[triangle[1], 1])
-        p2 = (point_list[triangle[2], 0], point_list[triangle[2], 1])
-
-        cv2.line(canvas, p0, p1, linecolor, thickness = 1, lineType=cv2.LINE_AA)
-        cv2.line(canvas, p1, p2, linecolor, thickness = 1, lineType=cv2.LINE_AA)
-        cv2.line(canvas, p2, p0, linecolor, thickness = 1, lineType=cv2.LINE_AA)
- 
-        if i%1000 == 0:
-            status_print.update(i)
-        i += 1
+    with instrument.stage('delaunay'):
+        tri = Delaunay(point_list)
+        tri = tri.simplices.copy()
+    instrument.count('triangles', len(tri))
+
+    if(vector_out is not None):
+        # Write the triangle outlines as closed polylines
+        for triangle in tri:
+            vector_out.polyline(point_list[[triangle[0], triangle[1], triangle[2], triangle[0]]])
+        print("Writing {} triangles".format(len(tri)))
+        return None
+
+    # Colors of all triangles from their center points
+    corners = point_list[tri]
+    cp = np.sum(corners, axis=1) // 3
+    colors = ref_img[cp[:, 1], cp[:, 0]]
+    if BW:
+        colors = colors[:, None]
+
+    # Triangles with the same color are drawn with one call, in the order
+    # of the colors. 
+    keys, group = np.unique(colors, axis=0, return_inverse=True)
+    group = group.ravel()
+    order = np.argsort(group, kind='stable')
+    corners = corners.astype(np.int32)
+
+    # The edges that are shared by two triangles are drawn only once. 
+    edges = np.concatenate((tri[:, [0, 1]], tri[:, [1, 2]], tri[:, [2, 0]]))
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    edge_points = point_list[edges].astype(np.int32)
+    instrument.count('edges', len(edges))
+
+    # The image is drawn in horizontal bands (one band in the normal mode,
+    # see largeformat.py). Each band gets the triangles and edges that touch
+    # it, moved to the band coordinates. 
+    tri_top = corners[:, :, 1].min(axis=1)
+    tri_bottom = corners[:, :, 1].max(axis=1)
+    edge_top = edge_points[:, :, 1].min(axis=1)
+    edge_bottom = edge_points[:, :, 1].max(axis=1)
+    offset = np.zeros(2, dtype=np.int32)
+    status_print = ProgressReport(y_max, 'triangle rendering')
+    for y1, y2 in largeformat.bands(canvas):
+        band = canvas[y1:y2]
+        offset[1] = y1
+
+        # Draw the filled triangles. 
+        band_order = order[(tri_bottom[order] >= y1 - 1) & (tri_top[order] <= y2)]
+        band_group = group[band_order]
+        bounds = np.flatnonzero(np.r_[True, band_group[1:] != band_group[:-1], True])
+        with instrument.stage('fill'):
+            for i in range(len(bounds) - 1):
+                color = [int(c) for c in keys[band_group[bounds[i]]]]
+                cv2.fillPoly(band, list(corners[band_order[bounds[i]:bounds[i + 1]]] - offset),\
+                    color=color)
+        instrument.count('fill_calls', len(bounds) - 1)
+
+        # Draw the triangle outlines. This is done separately 
+        # in order to avoid the fill painting over outlines. 
+        band_edges = (edge_bottom >= y1 - 2) & (edge_top <= y2 + 1)
+        with instrument.stage('outline'):
+            cv2.polylines(band, edge_points[band_edges] - offset, False, linecolor,\
+                thickness = 1, lineType=cv2.LINE_AA)
+        status_print.update(y2)
+        largeformat.trim(force=True)
     status_print.finished()
 
-
     print("Drawing the image using {} triangles".format(len(tri)))
 
     # Return the image in RGB format.
     if BW: 
-        return cv2.cvtColor(canvas, cv2.COLOR_GRAY2RGB)
+        result = largeformat.empty(canvas.shape + (3,))
+        for y1, y2 in largeformat.bands(result):
+            result[y1:y2] = canvas[y1:y2, :, None]
+            largeformat.trim(force=True)
+        return result
     else:
         return canvas
 
-def triangulate(source_img, BW):
+def triangulate(source_img, BW, vector_out=None, equalized=None, rand_points=None,\
+    seed=None, scale=None):
     # Calculate triangulated effect. Both colored and grayscale versions use this same code. 
     # BW = True for grayscale processing.
+    # If vector_out writer is given, the triangle outlines are written to it instead of 
+    # drawing the result image and None is returned. 
+    # Equalized is optional histogram equalized grayscale version of the source
+    # image, if that is already available. 
+    # Rand_points is the number of random locations that are tried for the triangle 
+    # corner points. Seed for the random numbers, same seed gives always the same result. 
+    # Triangle size is scaled by scale, by default it is relative to the image size, so 
+    # smaller image gives scaled down version of the result with the same number of 
+    # triangles. The random locations are spread over the whole image in every size, 
+    # so the default rand_points (million) does not depend on the scale. 
+    if(scale is None):
+        scale = max(source_img.shape[0], source_img.shape[1]) / REFERENCE_SIZE
+    if(rand_points is None):
+        rand_points = 1000000
 
     # Calculate temporary image that is used to calculate triangle points. 
-    tmp_img = cv2.cvtColor(source_img, cv2.COLOR_RGB2GRAY)
-    tmp_img = histogram_equalize(tmp_img)
+    if(equalized is None):
+        tmp_img = cv2.cvtColor(source_img, cv2.COLOR_RGB2GRAY)
+        tmp_img = histogram_equalize(tmp_img)
+    else:
+        tmp_img = equalized
 
     # Define the color reference images and canvas for the final image. 
     # Canvas is painted to the average gray value of the source image. 
+    # Canvas is not needed in vector output. 
+    # The reference images are only read. 
     if BW: 
-        ref_img = tmp_img.copy()
-        mean_color = np.mean(ref_img)
-        canvas = np.full(ref_img.shape, mean_color, dtype=np.uint8)
+        ref_img = tmp_img
+        mean_color = largeformat.mean(ref_img)
+        canvas_color = mean_color
     else:
-        ref_img = source_img.copy()
-        mean_color = np.mean(ref_img)
-        canvas = np.full(ref_img.shape, (mean_color, mean_color, mean_color), dtype=np.uint8)
+        ref_img = source_img
+        mean_color = largeformat.mean(ref_img)
+        canvas_color = (mean_color, mean_color, mean_color)
+    canvas = None
+    if(vector_out is None):
+        canvas = largeformat.full(ref_img.shape, canvas_color, dtype=np.uint8)
+
+    # The working image for the point sampling stores the gray value + 1 and
+    # 0 for the processed areas, see sample_points. 
+    work_img = largeformat.empty(tmp_img.shape, dtype=np.uint16)
+    for y1, y2 in largeformat.bands(work_img):
+        np.add(tmp_img[y1:y2], 1, out=work_img[y1:y2], dtype=np.uint16)
+    with instrument.stage('sample_points'):
+        point_list = sample_points(work_img, rand_points, np.random.default_rng(seed), scale)
 
-    y_max = tmp_img.shape[0]
-    x_max = tmp_img.shape[1]
-    point_list = []
-    tmp_img = tmp_img * 0.98
-    tmp_img = tmp_img + 2
-    rand_points = 1000000
+    # Render the triangles
+    result = render_triangles(point_list, canvas, ref_img, BW, vector_out)
+    return result
 
-    status_print = ProgressReport(rand_points, 'triangle corner points')
 
+def sample_points(work_img, rand_points, rng, scale=1.0, batch_size=65536):
     # Define the point cloud that is used to draw the triangles. 
-    # Million randomly located points are used in the process. Most of those are ignored. 
-    for pt in range(rand_points):
+    # Rand_points randomly located points are tried in the process. Most of those are ignored. 
+    # Work_img (uint16) holds the gray values + 1, the processed areas are marked 
+    # with 0 to it. The gray values are mapped to colors 2...252 with look-up table, 
+    # so that the working image takes only 2 bytes per pixel. 
+    # The random locations are drawn and filtered in batches. The image values only 
+    # decrease to 0 when areas are marked as processed, so the candidates that fail 
+    # the checks against the values at the start of the batch would fail those later 
+    # too. Only the remaining candidates are checked again one by one. 
+    y_max = work_img.shape[0]
+    x_max = work_img.shape[1]
+    point_list = []
+    color_table = np.r_[0.0, np.arange(256) * 0.98 + 2]
 
-        if pt%1000 == 0:
-            status_print.update(pt)
+    status_print = ProgressReport(rand_points, 'triangle corner points')
 
-        y = randrange(y_max)
-        x = randrange(x_max) 
+    for first in range(0, rand_points, batch_size):
+        status_print.update(first)
+        pt = np.arange(first, min(first + batch_size, rand_points))
+        y = rng.integers(y_max, size=len(pt))
+        x = rng.integers(x_max, size=len(pt))
 
-        # Pic color from temp image.
-        color = tmp_img[y, x]
+        # Pic colors from temp image.
+        color = color_table[work_img[y, x]]
 
         # Calculate upper limit for the color processnig. 
         # At the beginning of the processing only dark values are taken into account. 
         # Later the limit is increased towards light colors and finally all colors are analyzed. 
         limit = pt / 3000 + 1
-        if color > limit:
-            continue
 
         # Ignore colors that are below 2. Those are considered as already processed and this algorith
         # does process same location only once. 
-        if color < 2:
-            continue
-
-        # Calculate radius for the are that will be marked as processed to the temp image and 
-        # draw the area to the temp image. 
-        radius = int(color/6) + 5
-        cv2.circle(tmp_img, (x+2, y+2), radius, 0, thickness = -1)
-
-        # Add the poit location to point list. 
-        point_list.append([x, y])
+        keep = (color <= limit) & (color >= 2)
+
+        for x, y in zip(x[keep].tolist(), y[keep].tolist()):
+            color = color_table[work_img[y, x]]
+            if color < 2:
+                continue
+
+            # Calculate radius for the are that will be marked as processed to the temp image and 
+            # draw the area to the temp image. The area is marked with the pixels whose centers 
+            # are inside the circle. Unlike cv2.circle, that does not make the small circles 
+            # of the small scales relatively larger, so the point density follows the scale. 
+            radius = (int(color/6) + 5) * scale
+            cx = x + 2 * scale
+            cy = y + 2 * scale
+            y1, y2 = max(int(cy - radius), 0), min(int(cy + radius) + 2, y_max)
+            x1, x2 = max(int(cx - radius), 0), min(int(cx + radius) + 2, x_max)
+            dy = np.arange(y1, y2) - cy
+            dx = np.arange(x1, x2) - cx
+            area = work_img[y1:y2, x1:x2]
+            area[dy[:, None]**2 + dx[None, :]**2 <= radius**2] = 0
+
+            # Add the poit location to point list. 
+            point_list.append([x, y])
 
     status_print.finished()
-
-    # Render the triangles
-    result = render_triangles(point_list, canvas, ref_img, BW)
-    return result
-
-
+    instrument.count('trials', rand_points)
+    instrument.count('points', len(point_list))
+    return point_list
@@ -1,15 +1,18 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import cv2
 import time
 import math
 import sys
-from random import randrange
+
+import preprocess
+import instrument
 
 
 def load_image(filename):
     # Loads image file and returns it in RGB format numpy array.
     img = cv2.imread(filename)
+    if(img is None):
+        raise IOError('Could not read image file {}'.format(filename))
     if(len(img.shape) > 2 and img.shape[2] == 4):
         # Get rid of the aplha channel in PNG files. 
         img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
@@ -24,38 +27,21 @@ def save_image(filename, img):
     print('Saving the image to file {}'.format(filename))
     cv2.imwrite(filename, cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
 
-def add_dither_grayscale(img, amount):
+def add_dither_grayscale(img, amount, rng=None):
     # Add dither to image pixels. Some effect algorithms may need this
     # if the image contains large areas of same color. 
     # The dither is ~zero mean in evenly distributed range +/- amount/2.
-    # Currently works only with grayscale images. 
-
-    size_x = img.shape[1]
-    size_y = img.shape[0]
-    result = img.copy()
-
-    status_print = ProgressReport(size_y, 'dithering')
-
-    for y in range(size_y):
-        for x in range(size_x):
-            pixel = int(img[y, x] + randrange(amount) - amount/2)
-            if(pixel > 255): 
-                pixel = 255
-            elif(pixel < 0): 
-                pixel = 0
-            result[y, x] = pixel
-
-        if(y%50 == 0):
-            status_print.update(y)
-
-    status_print.finished()
-    return result
+    # See preprocess.dither, which works also with color images. 
+    print('Adding dither')
+    return preprocess.dither(img, amount, rng=rng)
 
 
 def plot_image(img):
     # Plot the image. This assumes that the image comes as numpy
     # array in RGB format. 
     print('Displaying image')
+    # Matplotlib is loaded only when something is displayed. 
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(9,6))
     plt.axis("off")
     plt.imshow(img)
@@ -94,20 +80,21 @@ def measure_time(method):
 
 
 class ProgressReport(object):
-    # This is used to report the processing progress to the user. 
+    # This is used to report the processing progress to the user. The progress 
+    # is passed to the instrumentation sinks (see instrument.py) whenever the 
+    # percentage changes. 
 
     def __init__(self, finish_value, name):
         self.finish_value = finish_value
-        sys.stdout.write('Computing ' + name + ':    ')
-        sys.stdout.flush()
+        self.name = name
+        self.percent = 0
+        instrument.progress(name, 0, finish_value)
     
     def update(self, status_value):
-        percent = status_value / self.finish_value * 100.0
-        if(percent > 99.0):
-            percent = 99.0
-        sys.stdout.write('\b\b\b{:2.0f}%'.format(percent))
-        sys.stdout.flush()
+        percent = int(status_value / self.finish_value * 100.0)
+        if(percent != self.percent):
+            self.percent = percent
+            instrument.progress(self.name, status_value, self.finish_value)
 
     def finished(self):
-        sys.stdout.write('\b\b\bDone \n')
-        sys.stdout.flush()        
+        instrument.progress(self.name, self.finish_value, self.finish_value, done=True)
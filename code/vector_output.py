@@ -0,0 +1,241 @@
+import numpy as np
+import os.path
+
+
+# Vector output backends for pen plotters. The effects write their drawing
+# primitives (polylines and circles) to the writer as soon as those are
+# generated and the writer streams them directly to the file, so memory use
+# does not depend on the number of primitives.
+# Coordinates are given in image pixels, x to right and y down.
+
+
+SVG_EXTENSIONS = ('.svg',)
+HPGL_EXTENSIONS = ('.hpgl', '.hpg', '.plt')
+GCODE_EXTENSIONS = ('.gcode', '.gco', '.nc')
+
+
+def is_vector_filename(filename):
+    # Check that does the file name have vector output file extension
+    ext = os.path.splitext(filename)[1].lower()
+    return ext in SVG_EXTENSIONS + HPGL_EXTENSIONS + GCODE_EXTENSIONS
+
+
+def open_vector_writer(filename, width, height):
+    # Open vector writer that matches the file extension.
+    ext = os.path.splitext(filename)[1].lower()
+    if(ext in SVG_EXTENSIONS):
+        return SvgWriter(filename, width, height)
+    if(ext in HPGL_EXTENSIONS):
+        return HpglWriter(filename, width, height)
+    if(ext in GCODE_EXTENSIONS):
+        return GcodeWriter(filename, width, height)
+    raise ValueError('Unknown vector file format: {}'.format(filename))
+
+
+class VectorWriter(object):
+    # Base class for the vector writers. Keeps track of the pen location,
+    # so that continuous polylines are drawn without lifting the pen.
+
+    def __init__(self, filename, width, height):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.file = open(filename, 'w')
+        self.pen_at = None # pen location when the pen is down
+        print('Writing vector output to file {}'.format(filename))
+        self.begin()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def polyline(self, points, color=None, colors=None):
+        # Draw line through the points (N x 2 array). Colors is optional
+        # N x 3 array of point colors, each line segment uses the color of
+        # its end point. Otherwise the whole line is drawn with color.
+        points = np.asarray(points)
+        if(len(points) < 2):
+            return
+        start = (float(points[0, 0]), float(points[0, 1]))
+        if(self.pen_at != start):
+            self.pen_up()
+            self.move_to(start)
+            self.pen_down()
+        self.line_to(points, color, colors)
+        self.pen_at = (float(points[-1, 0]), float(points[-1, 1]))
+
+    def circle(self, x, y, r, color=None, fill=False):
+        # Draw circle around x, y. Filled circles are drawn with concentric
+        # circles in the plotter formats.
+        self.pen_up()
+        self.draw_circle(x, y, r, color, fill)
+        self.pen_at = None
+
+    def close(self):
+        if(self.file is not None):
+            self.pen_up()
+            self.end()
+            self.file.close()
+            self.file = None
+
+    # Format specific methods
+    def begin(self):
+        pass
+
+    def end(self):
+        pass
+
+    def pen_up(self):
+        self.pen_at = None
+
+    def pen_down(self):
+        pass
+
+    def move_to(self, point):
+        pass
+
+    def line_to(self, points, color, colors):
+        pass
+
+    def draw_circle(self, x, y, r, color, fill):
+        pass
+
+
+def svg_color(color):
+    if(color is None):
+        return 'black'
+    return 'rgb({},{},{})'.format(int(color[0]), int(color[1]), int(color[2]))
+
+
+class SvgWriter(VectorWriter):
+    # SVG output. Each polyline call produces one polyline element, or one
+    # element per run of same colored segments.
+
+    def begin(self):
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.file.write('<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '\
+            'width="{0}" height="{1}" viewBox="0 0 {0} {1}">\n'.format(self.width, self.height))
+
+    def end(self):
+        self.file.write('</svg>\n')
+
+    def line_to(self, points, color, colors):
+        if(colors is None):
+            self.write_polyline(points, color)
+            return
+
+        # Split the line to runs of same colored segments
+        seg_colors = np.asarray(colors)[1:]
+        change = np.any(seg_colors[1:] != seg_colors[:-1], axis=1)
+        starts = np.r_[0, np.flatnonzero(change) + 1]
+        ends = np.r_[starts[1:], len(seg_colors)]
+        for start, end in zip(starts, ends):
+            self.write_polyline(points[start:end + 1], seg_colors[start])
+
+    def write_polyline(self, points, color):
+        coords = ' '.join('{:.1f},{:.1f}'.format(x, y) for x, y in points)
+        self.file.write('<polyline points="{}" fill="none" stroke="{}" '\
+            'stroke-width="1"/>\n'.format(coords, svg_color(color)))
+
+    def draw_circle(self, x, y, r, color, fill):
+        if(fill):
+            style = 'fill="{}" stroke="none"'.format(svg_color(color))
+        else:
+            style = 'fill="none" stroke="{}" stroke-width="1"'.format(svg_color(color))
+        self.file.write('<circle cx="{:.1f}" cy="{:.1f}" r="{:.1f}" {}/>\n'.\
+            format(x, y, r, style))
+
+
+class HpglWriter(VectorWriter):
+    # HPGL output for pen plotters. One image pixel is scale plotter units
+    # (default 10 units = 0.25 mm). Y axis points up in plotter coordinates.
+
+    def __init__(self, filename, width, height, scale=10, pen_width=10):
+        self.scale = scale
+        self.pen_width = pen_width # in plotter units, used for filling
+        VectorWriter.__init__(self, filename, width, height)
+
+    def xy(self, x, y):
+        return int(round(x * self.scale)), int(round((self.height - y) * self.scale))
+
+    def begin(self):
+        self.file.write('IN;SP1;\n')
+
+    def end(self):
+        self.file.write('PU;SP0;\n')
+
+    def move_to(self, point):
+        self.file.write('PU{},{};\n'.format(*self.xy(point[0], point[1])))
+
+    def line_to(self, points, color, colors):
+        coords = ','.join('{},{}'.format(*self.xy(x, y)) for x, y in points[1:])
+        self.file.write('PD{};\n'.format(coords))
+
+    def draw_circle(self, x, y, r, color, fill):
+        self.file.write('PU{},{};\n'.format(*self.xy(x, y)))
+        r = r * self.scale
+        while(r > 0):
+            self.file.write('CI{};\n'.format(int(round(r))))
+            if(not fill):
+                break
+            r -= self.pen_width
+
+
+class GcodeWriter(VectorWriter):
+    # G-code output for pen plotters and CNC machines. One image pixel is
+    # scale millimeters. The pen is moved with the Z axis by default, the
+    # commands can be changed for example to servo commands.
+
+    def __init__(self, filename, width, height, scale=0.1, pen_width=0.3,\
+        feed_rate=3000, pen_up_cmd='G0 Z5', pen_down_cmd='G1 Z0 F1000'):
+        self.scale = scale
+        self.pen_width = pen_width # in millimeters, used for filling
+        self.feed_rate = feed_rate
+        self.pen_up_cmd = pen_up_cmd
+        self.pen_down_cmd = pen_down_cmd
+        self.is_down = False
+        VectorWriter.__init__(self, filename, width, height)
+
+    def xy(self, x, y):
+        return x * self.scale, (self.height - y) * self.scale
+
+    def begin(self):
+        self.file.write('G21\nG90\n{}\n'.format(self.pen_up_cmd))
+
+    def end(self):
+        self.file.write('G0 X0 Y0\n')
+
+    def pen_up(self):
+        VectorWriter.pen_up(self)
+        if(self.is_down):
+            self.file.write(self.pen_up_cmd + '\n')
+            self.is_down = False
+
+    def pen_down(self):
+        if(not self.is_down):
+            self.file.write(self.pen_down_cmd + '\n')
+            self.is_down = True
+
+    def move_to(self, point):
+        self.file.write('G0 X{:.3f} Y{:.3f}\n'.format(*self.xy(point[0], point[1])))
+
+    def line_to(self, points, color, colors):
+        # Feed rate is modal, so it is given only once. 
+        feed = ' F{}'.format(self.feed_rate)
+        for x, y in points[1:]:
+            self.file.write('G1 X{:.3f} Y{:.3f}{}\n'.format(*(self.xy(x, y) + (feed,))))
+            feed = ''
+
+    def draw_circle(self, x, y, r, color, fill):
+        cx, cy = self.xy(x, y)
+        r = r * self.scale
+        while(r > 0):
+            self.file.write('G0 X{:.3f} Y{:.3f}\n'.format(cx + r, cy))
+            self.pen_down()
+            self.file.write('G2 X{:.3f} Y{:.3f} I{:.3f} J0 F{}\n'.format(cx + r, cy, -r, self.feed_rate))
+            self.pen_up()
+            if(not fill):
+                break
+            r -= self.pen_width